@@ -0,0 +1,35 @@
+"""
+Benchmark suites of hyp2k; results are printed and optionally written as JSON
+(--out) and compared with an earlier run (--baseline).
+
+    python -m hyp2k.bench [suite] [suite options]
+"""
+import importlib
+import sys
+
+SUITES = {
+    'step': 'moco_step',
+    'compile': 'compile',
+    'queue': 'queue_precision',
+    'comm': 'comm',
+    'shuffle_bn': 'shuffle_bn',
+    'import': 'import_time',
+    'shard': 'sharded_queue',
+    'optim': 'optim_step',
+    'resume': 'resume_check',
+    'curvature': 'curvature_check',
+}
+
+
+def main():
+    argv = sys.argv[1:]
+    suite = 'step'
+    if argv and argv[0] in SUITES:
+        suite, argv = argv[0], argv[1:]
+    elif argv and not argv[0].startswith('-'):
+        sys.exit('unknown suite {!r}, choose from {}'.format(argv[0], ', '.join(SUITES)))
+    importlib.import_module('.' + SUITES[suite], __package__).main(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Communication of one MoCo step across processes: the former exchange (all_gather
+of every image for the batch shuffle, then blocking all_gathers of the keys for
+the unshuffle and the enqueue) against CommScheduler (all_to_all of the needed
+images, one asynchronous key gather overlapping the query forward). Reports the
+time per step and the bytes received per step on each rank, and fails unless the
+all_to_all shuffle gives the same shuffled batch and unshuffled keys as the
+all_gather one. Runs on CPU with gloo.
+
+    python -m hyp2k.bench comm --world-size 4 --batch-size 32 --image-size 224
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from ..moco.comm import CommScheduler
+from .utils import emit, record
+
+
+def legacy_step(x, encode, query):
+    """The exchange of the original MoCo builders."""
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    gathered = [torch.ones_like(x) for _ in range(world_size)]
+    dist.all_gather(gathered, x)
+    x_gather = torch.cat(gathered)
+    idx_shuffle = torch.randperm(x_gather.size(0))
+    dist.broadcast(idx_shuffle, src=0)
+    idx_unshuffle = torch.argsort(idx_shuffle)
+    k = encode(x_gather[idx_shuffle.view(world_size, -1)[rank]])
+    for _ in range(2):  # unshuffle, then enqueue
+        gathered = [torch.ones_like(k) for _ in range(world_size)]
+        dist.all_gather(gathered, k)
+    k_all = torch.cat(gathered)
+    query()
+    return k_all[idx_unshuffle.view(world_size, -1)[rank]]
+
+
+def scheduled_step(comm, x, encode, query):
+    x_this = comm.shuffle(x).wait()
+    gathered = comm.gather_keys(encode(x_this))
+    query()
+    return gathered.wait()[0]
+
+
+def same_shuffle(x):
+    """
+    Whether the all_to_all and all_gather shuffles of `x` agree for the same
+    permutation: the same images on this rank (all_to_all receives them grouped by
+    the rank holding them, so they are compared sorted by their index in the global
+    batch), and the same unshuffled keys and keys of all ranks (the flattened images,
+    so the unshuffled keys must be those of `x`).
+    """
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    results = []
+    for use_all_to_all in (True, False):
+        comm = CommScheduler()
+        comm.use_all_to_all = use_all_to_all
+        torch.manual_seed(0)
+        shuffled = comm.shuffle(x).wait()
+        ids = comm._order.view(world_size, -1)[rank]
+        keys, keys_all = comm.gather_keys(shuffled.flatten(1)).wait()
+        results.append((ids.sort()[0], shuffled[ids.argsort()], keys, keys_all))
+    return (all(torch.equal(a, b) for a, b in zip(*results)) and
+            torch.equal(results[0][2], x.flatten(1)))
+
+
+def worker(rank, args, store, results):
+    dist.init_process_group('gloo', init_method='file://' + store, world_size=args.world_size,
+                            rank=rank)
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(rank)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    head = torch.randn(x[0].numel(), args.dim) / x[0].numel()**0.5
+    work = torch.randn(args.work, args.work)
+
+    def encode(im):
+        return im.flatten(1) @ head
+
+    def query():  # stands in for the query forward
+        if args.work:
+            work @ work
+
+    results['same_shuffle_{}'.format(rank)] = same_shuffle(x)
+    comm = CommScheduler()
+    cases = {
+        'all_gather (former)': lambda: legacy_step(x, encode, query),
+        'CommScheduler': lambda: scheduled_step(comm, x, encode, query),
+    }
+    for name, step in cases.items():
+        step()
+        comm.bytes.clear()
+        comm.legacy_bytes.clear()
+        times = []
+        for _ in range(args.iters):
+            dist.barrier()
+            start = time.perf_counter()
+            step()
+            times.append(time.perf_counter() - start)
+        if rank == 0:
+            results[name] = times
+            if name == 'CommScheduler':
+                results['bytes'] = (sum(comm.bytes.values()) / args.iters,
+                                    sum(comm.legacy_bytes.values()) / args.iters)
+    dist.destroy_process_group()
+
+
+def run(args):
+    results = mp.Manager().dict()
+    mp.spawn(worker, args=(args, tempfile.mktemp(prefix='hyp2k-comm-'), results),
+             nprocs=args.world_size)
+    params = dict(world_size=args.world_size, batch_size=args.batch_size,
+                  image_size=args.image_size, dim=args.dim)
+    if not all(results['same_shuffle_{}'.format(rank)] for rank in range(args.world_size)):
+        print('all_to_all and all_gather shuffles differ')
+        sys.exit(1)
+    new, old = results['bytes']
+    rows = []
+    for name in ('all_gather (former)', 'CommScheduler'):
+        row = record('comm', name, results[name], args.batch_size, 'img/s', **params)
+        row['mb_per_step'] = (old if 'former' in name else new) / 2**20
+        rows.append(row)
+    return rows
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='MoCo step communication benchmark')
+    parser.add_argument('--world-size', default=4, type=int)
+    parser.add_argument('--batch-size', default=32, type=int, help='per process')
+    parser.add_argument('--image-size', default=224, type=int)
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--work', default=512, type=int,
+                        help='size of the matmul standing in for the query forward')
+    parser.add_argument('--threads', default=1, type=int, help='torch threads per process')
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    rows = run(args)
+    emit(rows, args.out, args.baseline)
+    for row in rows:
+        print('{:<24} {:10.2f} MB received per step and rank'.format(row['case'],
+                                                                    row['mb_per_step']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Warm-up and steady-state throughput of the MoCo encoders in eager, channels_last
+and torch.compile modes. Runs on CPU.
+
+    python -m hyp2k.bench.compile --arch resnet18 --batch-size 32 --out compile.json
+"""
+import argparse
+
+import torch
+import torchvision.models as models
+
+from .utils import emit, measure, record
+
+MODES = {
+    'eager': (False, False),
+    'channels_last': (True, False),
+    'compile': (False, True),
+    'channels_last+compile': (True, True),
+}
+
+
+def build(args, channels_last, compile):
+    torch.manual_seed(0)
+    if args.hyper:
+        from ..hypmoco.builder import HyperMoCo
+        model = HyperMoCo(models.__dict__[args.arch], args.dim, args.k, mlp=True, hyper=True)
+    else:
+        from ..moco.builder import MoCo
+        model = MoCo(models.__dict__[args.arch], args.dim, args.k, mlp=True)
+    model.to(args.device).train()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if compile:
+        model.compile_encoders()
+    return model
+
+
+def run(args):
+    rows = []
+    fmt = {True: torch.channels_last, False: torch.contiguous_format}
+    for mode in args.modes:
+        channels_last, compile = MODES[mode]
+        model = build(args, channels_last, compile)
+
+        def batch(n):
+            x = torch.randn(n, 3, args.image_size, args.image_size, device=args.device)
+            return x.contiguous(memory_format=fmt[channels_last])
+
+        im_q, im_k = batch(args.batch_size), batch(args.batch_size)
+
+        def step(im_q=im_q, im_k=im_k):
+            model.encode_q(im_q).sum().backward()
+            with torch.no_grad():
+                model.encode_k(im_k)
+
+        first, times = measure(step, args.iters, args.warmup, args.device)
+        rows.append(
+            record('compile',
+                   mode,
+                   times,
+                   items=args.batch_size,
+                   first=first,
+                   arch=args.arch,
+                   hyper=args.hyper,
+                   batch_size=args.batch_size,
+                   image_size=args.image_size))
+
+        # a short last batch must not pay a second compilation
+        n = max(args.batch_size // 2 + 1, 2)
+        last_q, last_k = batch(n), batch(n)
+        first, times = measure(lambda: step(last_q, last_k), args.iters, 1, args.device)
+        rows.append(
+            record('compile',
+                   mode + ' (last batch)',
+                   times,
+                   items=n,
+                   first=first,
+                   arch=args.arch,
+                   hyper=args.hyper,
+                   batch_size=n,
+                   image_size=args.image_size))
+    return rows
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Encoder execution mode benchmark')
+    parser.add_argument('--arch', default='resnet18')
+    parser.add_argument('--hyper', action='store_true', help='use the HyperMoCo Poincare head')
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--k', default=4096, type=int)
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--image-size', default=112, type=int)
+    parser.add_argument('--iters', default=5, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--modes', nargs='*', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    emit(run(args), args.out, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
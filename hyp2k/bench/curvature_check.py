@@ -0,0 +1,85 @@
+"""
+Smoke check of a learnt curvature (--hyper --train-c): a small HyperMoCo trains a
+few steps on random images with the optimizer setup of main_moco (the curvature
+in its own parameter group, clamped after every step), under the default
+objective and the ball one (--ball-features --neg-distance). The loss and c must
+stay finite and c within its bounds; otherwise the check fails. Runs on CPU.
+
+    python -m hyp2k.bench curvature --steps 10
+"""
+import argparse
+import math
+import sys
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+from ..hypmoco.builder import HyperMoCo
+from ..optim import OPTIMIZERS, build_optimizer, param_groups
+from .utils import init_single_process_group
+
+OBJECTIVES = {
+    'default': dict(normalize=True, negative_distance=False, queue_radius=1.0),
+    'ball': dict(normalize=False, negative_distance=True, queue_radius=0.5),
+}
+
+
+def train(objective, args):
+    """(losses, curvatures) of `args.steps` steps"""
+    torch.manual_seed(0)
+    model = HyperMoCo(models.__dict__[args.arch], args.dim, args.k, mlp=True, hyper=True,
+                      c=args.curvature, train_c=True, riemannian=True, **OBJECTIVES[objective])
+    hyper = SimpleNamespace(lr=args.lr, momentum=0.9, weight_decay=1e-4, optimizer=args.optimizer,
+                            lars_eta=0.001, c_lr=args.c_lr)
+    optimizer = build_optimizer(param_groups(model, hyper), hyper)
+    criterion = nn.CrossEntropyLoss()
+    losses, curvatures = [], []
+    for _ in range(args.steps):
+        image = torch.randn(args.batch_size, 3, 32, 32)
+        output, target = model(im_q=image, im_k=image + 0.1 * torch.randn_like(image))[:2]
+        loss = criterion(output, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        model.curvature.clamp_()
+        losses.append(loss.item())
+        curvatures.append(model.curvature().item())
+    return losses, curvatures
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Learnt curvature smoke check')
+    parser.add_argument('--arch', default='resnet18')
+    parser.add_argument('--objectives', nargs='*', default=list(OBJECTIVES), choices=OBJECTIVES)
+    parser.add_argument('--optimizer', default='sgd', choices=OPTIMIZERS)
+    parser.add_argument('--curvature', default=1.0, type=float)
+    parser.add_argument('--lr', default=0.03, type=float)
+    parser.add_argument('--c-lr', default=1e-4, type=float)
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--k', default=256, type=int, help='queue size')
+    parser.add_argument('--batch-size', default=8, type=int)
+    parser.add_argument('--steps', default=10, type=int)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    init_single_process_group()
+    bounds = (args.curvature / 100 * (1 - 1e-6), args.curvature * 100 * (1 + 1e-6))
+    failed = False
+    for objective in args.objectives:
+        losses, curvatures = train(objective, args)
+        ok = (all(math.isfinite(x) for x in losses + curvatures) and
+              all(bounds[0] <= c <= bounds[1] for c in curvatures))
+        failed |= not ok
+        print('{:8} loss {:.3f} -> {:.3f}, c {:.4f} -> {:.4f}: {}'.format(
+            objective, losses[0], losses[-1], curvatures[0], curvatures[-1],
+            'ok' if ok else 'FAILED'))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Start-up cost of the hyp2k entry points: the wall time of importing main_moco and
+main_lincls, and of `main_moco --help`, each in a fresh interpreter as every
+spawned DDP worker pays it, against importing torch alone. Also lists the
+optional heavy modules (wandb, IPython, hyptorch) a plain import pulls in; with
+--check a non-empty list fails the run.
+
+    python -m hyp2k.bench import --iters 5 --check
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from .utils import emit, record
+
+CASES = {
+    'import torch': ['-c', 'import torch'],
+    'import hyp2k.main_moco': ['-c', 'import hyp2k.main_moco'],
+    'import hyp2k.main_lincls': ['-c', 'import hyp2k.main_lincls'],
+    'main_moco --help': ['-m', 'hyp2k.main_moco', '--help'],
+}
+# imported only when their flags (--wandb, --hyper) ask for them
+LAZY = ['wandb', 'IPython', 'hyptorch']
+
+
+def run_once(argv):
+    """Seconds to run `python argv` and the top-level modules it imported."""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        p for p in (root, os.environ.get('PYTHONPATH')) if p))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + argv,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            env=env,
+                            universal_newlines=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(argv), result.stderr[-2000:]))
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.rsplit('|', 1)[1].strip()
+            modules.add(name.split('.')[0])
+    return seconds, modules
+
+
+def run(args):
+    rows = []
+    for name in args.cases:
+        times, modules = [], set()
+        for _ in range(args.iters):
+            seconds, modules = run_once(CASES[name])
+            times.append(seconds)
+        row = record('import', name, times)
+        row['lazy_imported'] = [m for m in LAZY if m in modules]
+        rows.append(row)
+    return rows
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Start-up time of the hyp2k entry points')
+    parser.add_argument('--cases', nargs='*', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--iters', default=3, type=int)
+    parser.add_argument('--check', action='store_true',
+                        help='fail when an entry point imports ' + ', '.join(LAZY))
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    rows = run(args)
+    emit(rows, args.out, args.baseline)
+    eager = [(row['case'], row['lazy_imported']) for row in rows if row['lazy_imported']]
+    for case, modules in eager:
+        print('{!r} imports {}'.format(case, ', '.join(modules)))
+    if args.check and eager:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Per-phase and end-to-end timing of one MoCo / HyperMoCo pretraining step on
+synthetic data. Runs on CPU.
+
+    python -m hyp2k.bench step --out step.json
+    python -m hyp2k.bench step --baseline step.json  # compare against a saved run
+
+Phases: data loading (RP2K JPEG tree / CIFAR arrays), batch augmentation, query
+forward, key forward with batch shuffle, Euclidean vs Poincare logits over K and
+dim, the contrastive loss (concatenated logits vs fused InfoNCELoss), backward,
+momentum (EMA) update, enqueue, and the whole step.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models as models
+import torchvision.transforms as transforms
+from PIL import Image
+
+from ..data.CIFAR100 import CIFAR100
+from ..data.rp2k import RP2kDataset
+from ..moco.loader import moco_v1_augmentation
+from ..moco.loss import InfoNCELoss
+from .utils import emit, init_single_process_group, measure, record
+
+
+def synthetic_rp2k(root, classes, per_class, size):
+    """Writes a small RP2K-style tree of random JPEG product photos."""
+    rng = np.random.RandomState(0)
+    for c in range(classes):
+        d = os.path.join(root, 'train', str(c))
+        os.makedirs(d, exist_ok=True)
+        for i in range(per_class):
+            pixels = rng.randint(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(d, '{}.jpg'.format(i)), quality=90)
+    return root
+
+
+def synthetic_cifar(n, transform):
+    """A CIFAR100 dataset object over random arrays, bypassing the on-disk files."""
+    rng = np.random.RandomState(0)
+    dataset = CIFAR100.__new__(CIFAR100)
+    dataset.data = rng.randint(0, 255, (n, 32, 32, 3), dtype=np.uint8)
+    dataset.targets = rng.randint(0, 100, n).tolist()
+    dataset.extra_targets = [CIFAR100.MAP[t] for t in dataset.targets]
+    dataset.transform = transform
+    dataset.target_transform = None
+    dataset.train = True
+    return dataset
+
+
+def endless(dataset, args):
+    sampler = torch.utils.data.RandomSampler(dataset, replacement=True, num_samples=1 << 30)
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=args.batch_size,
+                                         sampler=sampler,
+                                         num_workers=args.workers,
+                                         drop_last=True)
+    return iter(loader)
+
+
+def bench_data(args):
+    rows = []
+    tmp = tempfile.mkdtemp(prefix='hyp2k-bench-')
+    try:
+        root = synthetic_rp2k(tmp, 4, max(args.batch_size // 2, 2), tuple(args.rp2k_size))
+        # JPEG draft decoding at the scale the crops need, against full decodes
+        for case, draft in (('rp2k decode+crop', True), ('rp2k full decode+crop', False)):
+            rp2k = RP2kDataset(root, 'train', SimpleNamespace(load_all=False), draft=draft)
+            it = endless(rp2k, args)
+            first, times = measure(lambda: next(it), args.iters)
+            rows.append(
+                record('data', case, times, args.batch_size, first=first,
+                       batch_size=args.batch_size, workers=args.workers, photo=args.rp2k_size))
+            del it
+    finally:
+        shutil.rmtree(tmp)
+
+    cifar = synthetic_cifar(4096, transforms.PILToTensor())
+    it = endless(cifar, args)
+    first, times = measure(lambda: next(it), args.iters)
+    rows.append(
+        record('data', 'cifar100', times, args.batch_size, first=first,
+               batch_size=args.batch_size, workers=args.workers))
+    return rows
+
+
+def build(args):
+    torch.manual_seed(0)
+    arch = models.__dict__[args.arch]
+    if args.hyper:
+        from ..hypmoco.builder import HyperMoCo
+        model = HyperMoCo(arch,
+                          args.dim,
+                          args.k,
+                          mlp=True,
+                          hyper=True,
+                          neg_mode=args.neg_mode,
+                          neg_count=args.neg_count)
+    else:
+        from ..moco.builder import MoCo
+        model = MoCo(arch, args.dim, args.k, mlp=True)
+    return model.to(args.device).train()
+
+
+def bench_step(args):
+    init_single_process_group()
+    model = build(args)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), 0.03, momentum=0.9, weight_decay=1e-4)
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    augment = moco_v1_augmentation(normalize)
+    image = torch.rand(args.batch_size, 3, 256, 256, device=args.device)
+    n, params = args.batch_size, dict(arch=args.arch, hyper=args.hyper, batch_size=args.batch_size)
+    if args.hyper:
+        params.update(neg_mode=args.neg_mode, neg_count=args.neg_count)
+    rows = []
+
+    def phase(case, fn, **kw):
+        first, times = measure(fn, args.iters, args.warmup, args.device, kw.pop('setup', None))
+        rows.append(record('step', case, times, n, first=first, **params))
+
+    with torch.no_grad():
+        im_q, im_k = augment(image), augment(image)
+
+    def augmentation():
+        with torch.no_grad():
+            augment(image), augment(image)
+
+    def key_forward():
+        with torch.no_grad():
+            x = model.comm.shuffle(im_k).wait()
+            model.comm.gather_keys(model.encode_k(x)).wait()
+
+    def loss():
+        output, target = model(im_q=im_q, im_k=im_k)[:2]
+        return criterion(output, target)
+
+    def full_step():
+        with torch.no_grad():
+            q, k = augment(image), augment(image)
+        output, target = model(im_q=q, im_k=k)[:2]
+        loss = criterion(output, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    keys = nn.functional.normalize(torch.randn(n, args.dim, device=args.device), dim=1)
+    phase('augmentation (2 views)', augmentation)
+    phase('query forward', lambda: model.encode_q(im_q))
+    phase('key forward + shuffle', key_forward)
+    phase('backward', lambda l: l.backward(), setup=loss)
+    phase('momentum update', model._momentum_update_key_encoder)
+    phase('enqueue', lambda: (model._dequeue_and_enqueue(keys), model.queue.flush()))
+    phase('end to end', full_step)
+    return rows
+
+
+def bench_logits(args):
+    try:
+        from hyptorch import pmath
+        from ..hypmoco.poincare import conformal_factor, dist_matrix
+    except ImportError:
+        print('=> hyptorch is not installed, skipping Poincare logits')
+        pmath = None
+    rows = []
+    n = args.batch_size
+    for dim in args.logit_dims:
+        for K in args.logit_ks:
+            torch.manual_seed(0)
+            q = nn.functional.normalize(torch.randn(n, dim, device=args.device), dim=1)
+            keys = nn.functional.normalize(torch.randn(K, dim, device=args.device), dim=1)
+            queue = keys.t().contiguous()  # former dim x K layout
+            params = dict(batch_size=n, dim=dim, K=K)
+            shape = ' K={} dim={}'.format(K, dim)
+
+            def case(name, fn):
+                first, times = measure(fn, args.iters)
+                rows.append(record('logits', name + shape, times, K * n, 'pairs/s', first,
+                                   **params))
+
+            with torch.no_grad():
+                case('euclidean einsum (dim x K)', lambda: torch.einsum('nc,ck->nk', [q, queue]))
+                case('euclidean mm (K x dim)', lambda: torch.mm(q, keys.t()))
+                if pmath is None:
+                    continue
+                # keep the points strictly inside the unit ball
+                qh, kh = q * 0.5, keys * 0.5
+                norm2 = kh.pow(2).sum(1)
+                lam = conformal_factor(norm2, 1.0)
+                case('poincare pmath.dist_matrix', lambda: pmath.dist_matrix(qh, kh, c=1.0))
+                case('poincare dist_matrix', lambda: dist_matrix(qh, kh, 1.0))
+                case('poincare dist_matrix cached stats',
+                     lambda: dist_matrix(qh, kh, 1.0, y_norm2=norm2, y_lambda=lam))
+    return rows
+
+
+def bench_loss(args):
+    """Forward and backward of the loss from l_pos and l_neg, as in the training step."""
+    rows = []
+    n, T = args.batch_size, 0.07
+    fused = InfoNCELoss(T)
+    cuda = torch.device(args.device).type == 'cuda'
+    for K in args.logit_ks:
+        torch.manual_seed(0)
+        l_pos = torch.randn(n, 1, device=args.device)
+        l_neg = torch.randn(n, K, device=args.device)
+        params = dict(batch_size=n, K=K)
+
+        def setup():
+            return l_pos.clone().requires_grad_(), l_neg.clone().requires_grad_()
+
+        def concatenated(x):
+            logits = torch.cat(x, dim=1)
+            logits /= T
+            labels = torch.zeros(n, dtype=torch.long, device=logits.device)
+            nn.functional.cross_entropy(logits, labels).backward()
+
+        def fused_loss(x):
+            fused(*x)[0].backward()
+
+        for name, fn in (('cat + cross_entropy', concatenated), ('fused InfoNCELoss', fused_loss)):
+            if cuda:
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+            first, times = measure(fn, args.iters, args.warmup, args.device, setup)
+            row = record('loss', '{} K={}'.format(name, K), times, n, first=first, **params)
+            if cuda:  # beyond the inputs, which both share
+                row['peak_mb'] = (torch.cuda.max_memory_allocated() - base) / 2**20
+            rows.append(row)
+    return rows
+
+
+PHASES = {'data': bench_data, 'step': bench_step, 'logits': bench_logits, 'loss': bench_loss}
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='MoCo step benchmark')
+    parser.add_argument('--phases', nargs='*', default=list(PHASES), choices=list(PHASES))
+    parser.add_argument('--arch', default='resnet18')
+    parser.add_argument('--hyper', action='store_true', help='benchmark HyperMoCo')
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--k', default=4096, type=int)
+    parser.add_argument('--neg-mode', default='all', choices=['all', 'sample', 'hard'],
+                        help='negatives of HyperMoCo (--hyper)')
+    parser.add_argument('--neg-count', default=1024, type=int)
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--workers', default=0, type=int)
+    parser.add_argument('--rp2k-size', default=[640, 480], nargs=2, type=int,
+                        help='width and height of the synthetic RP2K photos')
+    parser.add_argument('--logit-ks', default=[4096, 16384], nargs='*', type=int)
+    parser.add_argument('--logit-dims', default=[128, 256], nargs='*', type=int)
+    parser.add_argument('--iters', default=5, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def run(args):
+    rows = []
+    for name in args.phases:
+        rows += PHASES[name](args)
+    return rows
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    emit(run(args), args.out, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Time of one optimizer step over the parameters of a ResNet on CPU: SGD with its
+per-tensor, foreach and fused implementations, and LARS per tensor and with
+multi-tensor kernels. The two LARS implementations are checked to agree.
+
+    python -m hyp2k.bench optim --arch resnet50 --iters 20
+"""
+import argparse
+import copy
+import sys
+from types import SimpleNamespace
+
+import torch
+import torchvision.models as models
+
+from ..optim import LARS, build_optimizer, lars_groups
+from .utils import emit, measure, record
+
+
+def optimizers(params, args):
+    hyper = SimpleNamespace(lr=0.1, momentum=0.9, weight_decay=1e-4, lars_eta=0.001)
+    cases = {
+        'sgd': lambda: build_optimizer(params, SimpleNamespace(optimizer='sgd', **vars(hyper))),
+        'sgd foreach': lambda: build_optimizer(
+            params, SimpleNamespace(optimizer='sgd-foreach', **vars(hyper))),
+        'sgd fused': lambda: build_optimizer(
+            params, SimpleNamespace(optimizer='sgd-fused', **vars(hyper))),
+        'lars per tensor': lambda: LARS(lars_groups(params), 0.1, weight_decay=1e-4,
+                                        foreach=False),
+        'lars foreach': lambda: build_optimizer(params,
+                                                SimpleNamespace(optimizer='lars', **vars(hyper))),
+    }
+    return {name: cases[name] for name in args.cases}
+
+
+def lars_agree(model, steps=3):
+    """Max abs difference of the parameters after LARS steps per tensor and foreach"""
+    results = []
+    for foreach in (False, True):
+        torch.manual_seed(0)
+        m = copy.deepcopy(model)
+        params = list(m.parameters())
+        optimizer = LARS(lars_groups(params), 0.1, weight_decay=1e-4, foreach=foreach)
+        for _ in range(steps):
+            for p in params:
+                p.grad = torch.randn_like(p)
+            optimizer.step()
+        results.append(params)
+    return max((a - b).abs().max().item() for a, b in zip(*results))
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    model = models.__dict__[args.arch]()
+    params = list(model.parameters())
+    for p in params:
+        p.grad = torch.randn_like(p)
+    size = dict(arch=args.arch, tensors=len(params), threads=args.threads,
+                numel=sum(p.numel() for p in params))
+    rows = []
+    for name, make in optimizers(params, args).items():
+        try:
+            optimizer = make()
+            optimizer.step()
+        except (RuntimeError, TypeError) as e:  # e.g. no fused SGD on CPU in this version
+            print('{}: skipped ({})'.format(name, e))
+            continue
+        first, times = measure(optimizer.step, args.iters, args.warmup, 'cpu')
+        rows.append(record('optim', name, times, first=first, **size))
+    return rows, lars_agree(model)
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Optimizer step benchmark')
+    parser.add_argument('--arch', default='resnet50')
+    parser.add_argument('--cases', nargs='*', default=['sgd', 'sgd foreach', 'sgd fused',
+                                                       'lars per tensor', 'lars foreach'])
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    rows, error = run(args)
+    emit(rows, args.out, args.baseline)
+    print('lars per tensor vs foreach: max abs difference {:.2e}'.format(error))
+    if error > 1e-5:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
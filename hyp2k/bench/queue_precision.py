@@ -0,0 +1,150 @@
+"""
+Accuracy and cost of storing the MoCo queue in reduced precision: the contrastive
+acc1 / acc5 and loss of the same queries against float32, bfloat16, float16 and
+int8 queues, together with the queue memory and the time of the negative logits.
+Runs on CPU.
+
+    python -m hyp2k.bench queue --k 65536 --out queue.json
+    python -m hyp2k.bench queue --checkpoint checkpoint_train_0199.pth.tar
+
+The keys come from the queue of a pretraining checkpoint, or are synthetic
+clustered features. Held-out keys serve as positives and their noisy copies as
+queries, so the task has the hard negatives of a trained queue.
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from ..moco.queue import KeyQueue
+from .utils import emit, measure, record
+
+DTYPES = ['float32', 'bfloat16', 'float16', 'int8']
+
+
+def checkpoint_keys(path):
+    """The queue (K x dim) of a MoCo / HyperMoCo checkpoint, either layout."""
+    state_dict = torch.load(path, map_location='cpu')['state_dict']
+    for name, tensor in state_dict.items():
+        if name.endswith('queue.keys'):
+            scale = state_dict.get(name[:-len('keys')] + 'scale')
+            return tensor.float() * scale[:, None] if scale is not None else tensor.float()
+        if name.endswith('queue') and tensor.dim() == 2:
+            return tensor.t().float()
+    raise KeyError("no queue in '{}'".format(path))
+
+
+def synthetic_keys(n, dim, clusters, spread, hyper):
+    centers = nn.functional.normalize(torch.randn(clusters, dim), dim=1)
+    keys = centers[torch.randint(clusters, (n,))] + spread * torch.randn(n, dim)
+    keys = nn.functional.normalize(keys, dim=1)
+    if hyper:
+        # spread over the unit ball instead of its boundary
+        keys = keys * torch.empty(n, 1).uniform_(0.3, 0.9)
+    return keys
+
+
+def perturb(keys, noise, hyper):
+    queries = keys + noise * keys.norm(dim=1, keepdim=True) * torch.randn_like(keys)
+    if not hyper:
+        return nn.functional.normalize(queries, dim=1)
+    # rescale to the norms of the keys, which are inside the ball
+    return nn.functional.normalize(queries, dim=1) * keys.norm(dim=1, keepdim=True)
+
+
+def contrastive_logits(q, k, queue, hyper, c=1.0):
+    """Nx(1+K) logits of main_moco, before the temperature."""
+    if hyper:
+        from hyptorch import pmath
+        from ..hypmoco.poincare import conformal_factor, dist_matrix
+        l_pos = -pmath.dist(q, k, c=c).unsqueeze(-1)
+        l_neg = -dist_matrix(q,
+                             None,
+                             c,
+                             y_norm2=queue.norm2,
+                             y_lambda=conformal_factor(queue.norm2, c),
+                             xy=queue.mm(q))
+    else:
+        l_pos = torch.einsum('nc,nc->n', [q, k]).unsqueeze(-1)
+        l_neg = queue.mm(q)
+    return torch.cat([l_pos, l_neg], dim=1)
+
+
+def run(args):
+    torch.manual_seed(0)
+    n = args.queries
+    if args.checkpoint:
+        keys = checkpoint_keys(args.checkpoint)
+        print("=> {} keys of dim {} from '{}'".format(keys.size(0), keys.size(1), args.checkpoint))
+    else:
+        keys = synthetic_keys(args.k + n, args.dim, args.clusters, args.spread, args.hyper)
+    positives, keys = keys[:n], keys[n:]
+    queries = perturb(positives, args.noise, args.hyper)
+    K, dim = keys.shape
+    params = dict(K=K, dim=dim, queries=n, hyper=args.hyper, noise=args.noise,
+                  checkpoint=args.checkpoint or None)
+
+    rows, reference = [], None
+    for name in args.dtypes:
+        queue = KeyQueue(dim, K, dtype=getattr(torch, name))
+        queue.load_state_dict({'keys': keys, 'ptr': torch.zeros(1, dtype=torch.long)})
+        with torch.no_grad():
+            logits = contrastive_logits(queries, positives, queue, args.hyper) / args.t
+            first, times = measure(lambda: queue.mm(queries), args.iters)
+        # rank of the positive (column 0) among the 1+K logits
+        rank = (logits[:, 1:] > logits[:, :1]).sum(1)
+        row = record('queue', name, times, K * n, 'pairs/s', first, **params)
+        row.update(
+            acc1=100. * (rank < 1).float().mean().item(),
+            acc5=100. * (rank < 5).float().mean().item(),
+            loss=nn.functional.cross_entropy(logits, torch.zeros(n, dtype=torch.long)).item(),
+            queue_mb=sum(b.numel() * b.element_size()
+                         for b in (queue.keys, queue.scale) if b is not None) / 2**20)
+        if reference is None:
+            reference = logits
+        diff = (logits - reference).abs()
+        agree = (logits.argmax(1) == reference.argmax(1)).float().mean().item()
+        row.update(max_logit_err=diff.max().item(),
+                   mean_logit_err=diff.mean().item(),
+                   top1_agreement=100. * agree)
+        rows.append(row)
+    return rows
+
+
+def report(rows):
+    print('{:<10} {:>9} {:>8} {:>8} {:>8} {:>10} {:>11} {:>11}'.format(
+        'dtype', 'queue MB', 'acc1', 'acc5', 'loss', 'top1 agr.', 'max |dl|', 'mean |dl|'))
+    for row in rows:
+        print('{:<10} {:>9.1f} {:>8.2f} {:>8.2f} {:>8.4f} {:>9.2f}% {:>11.2e} {:>11.2e}'.format(
+            row['case'], row['queue_mb'], row['acc1'], row['acc5'], row['loss'],
+            row['top1_agreement'], row['max_logit_err'], row['mean_logit_err']))
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Reduced precision queue study')
+    parser.add_argument('--checkpoint', default='', help='take the queue of this checkpoint')
+    parser.add_argument('--hyper', action='store_true', help='Poincare logits (HyperMoCo)')
+    parser.add_argument('--dtypes', nargs='*', default=DTYPES, choices=DTYPES)
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--k', default=16384, type=int)
+    parser.add_argument('--queries', default=1024, type=int)
+    parser.add_argument('--clusters', default=256, type=int, help='synthetic key clusters')
+    parser.add_argument('--spread', default=0.5, type=float, help='synthetic cluster spread')
+    parser.add_argument('--noise', default=0.3, type=float,
+                        help='relative noise between a query and its positive key')
+    parser.add_argument('--t', default=0.07, type=float, help='softmax temperature')
+    parser.add_argument('--iters', default=5, type=int)
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    rows = run(args)
+    emit(rows, args.out, args.baseline)
+    report(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Round trip of a mid-epoch (--save-freq) checkpoint of main_moco: the training state
+of a small MoCo model is saved as main_moco does and read back with a plain
+torch.load (weights_only on recent PyTorch), then restored into fresh objects. The
+parameters, queue, optimizer, data position, the random transforms of the samples
+(drawn in loader workers) and the next draws of every RNG must match the saved run;
+any difference fails the check. Runs on CPU.
+
+    python -m hyp2k.bench resume
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torchvision.models as models
+
+from ..data.sampler import ResumableSampler, SeededDataset
+from ..main_moco import save_checkpoint, training_state
+from ..moco.builder import MoCo
+from ..runtime import set_rng_state
+
+
+def setup(args):
+    model = MoCo(models.__dict__[args.arch], 32, args.k, mlp=True)
+    optimizer = torch.optim.SGD(model.parameters(), 0.03, momentum=0.9, weight_decay=1e-4)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 600, 0.987)
+    sampler = ResumableSampler(Augmented(), num_replicas=1, rank=0, seed=0, seeded=True)
+    return model, optimizer, scheduler, sampler
+
+
+class Augmented(torch.utils.data.Dataset):
+    """Samples with a random transform"""
+
+    def __getitem__(self, index):
+        return torch.tensor([index, random.random(), torch.rand(1).item()])
+
+    def __len__(self):
+        return 1024
+
+
+def samples(sampler, workers=2):
+    loader = torch.utils.data.DataLoader(SeededDataset(sampler.dataset), batch_size=4,
+                                         sampler=sampler, num_workers=workers)
+    return torch.cat(list(loader))
+
+
+def draws():
+    return random.random(), float(np.random.rand()), torch.rand(1).item()
+
+
+def run(args):
+    torch.manual_seed(0)
+    model, optimizer, scheduler, sampler = setup(args)
+    sampler.set_epoch(3)
+    x = torch.randn(4, 3, 32, 32)
+    for _ in range(2):  # momentum buffers and an enqueued batch to save
+        optimizer.zero_grad()
+        logits, labels = model(im_q=x, im_k=x.flip(3))
+        torch.nn.functional.cross_entropy(logits, labels).backward()
+        optimizer.step()
+        scheduler.step()
+    np.random.seed(1)
+    run_args = SimpleNamespace(distributed=False, shard_queue=False, arch=args.arch,
+                               batch_size=4, rp2k_permute=1)
+    state = training_state(model, optimizer, scheduler, sampler, 3, 5, run_args)
+    expected = draws()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='hyp2k-resume-'), 'checkpoint_check_last.pth.tar')
+    save_checkpoint(state, False, path)
+    checkpoint = torch.load(path)
+    os.remove(path)
+
+    torch.manual_seed(1)
+    fresh, fresh_optimizer, fresh_scheduler, fresh_sampler = setup(args)
+    fresh.load_state_dict(checkpoint['state_dict'])
+    fresh_optimizer.load_state_dict(checkpoint['optimizer'])
+    fresh_scheduler.load_state_dict(checkpoint['scheduler'])
+    fresh_sampler.load_state_dict(checkpoint['sampler'])
+    set_rng_state(checkpoint['rng'][0])
+
+    failures = []
+    if draws() != expected:
+        failures.append('RNG draws')
+    saved = model.state_dict()
+    if any(not torch.equal(v, saved[k]) for k, v in fresh.state_dict().items()):
+        failures.append('model state')
+    if (fresh_optimizer.state_dict()['state'].keys() != optimizer.state_dict()['state'].keys()
+            or fresh_scheduler.get_last_lr() != scheduler.get_last_lr()):
+        failures.append('optimizer state')
+    if list(fresh_sampler) != list(sampler)[5 * 4:]:
+        failures.append('data position')
+    elif not torch.equal(samples(fresh_sampler), samples(sampler)[5 * 4:]):
+        failures.append('sample transforms')
+    return failures
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Mid-epoch checkpoint round trip')
+    parser.add_argument('--arch', default='resnet18')
+    parser.add_argument('--k', default=64, type=int, help='queue size')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    failures = run(args)
+    print('resume round trip: ' + ('ok' if not failures else 'differs in ' + ', '.join(failures)))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+The queue sharded across processes (--shard-queue): every process scores the
+queries of all processes against its K / world_size keys and the shards are
+combined by a distributed logsumexp. Checks the loss, the top-1 ranks and the
+query gradients of every process against InfoNCELoss on the whole queue, and
+times a forward and backward of each. Runs on CPU with gloo; a mismatch fails the run.
+
+    python -m hyp2k.bench shard --world-size 4 --batch-size 64 --moco-k 65536
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from ..moco.loss import InfoNCELoss
+from ..moco.sharded import sharded_negatives
+from .utils import emit, record
+
+
+def worker(rank, args, store, results):
+    dist.init_process_group('gloo', init_method='file://' + store, world_size=args.world_size,
+                            rank=rank)
+    torch.set_num_threads(args.threads)
+    # every process draws the whole queue and the queries of all processes alike
+    torch.manual_seed(0)
+    n, dtype = args.batch_size, torch.float64 if args.double else torch.float32
+    queue = torch.nn.functional.normalize(torch.randn(args.moco_k, args.dim, dtype=dtype), dim=1)
+    queries = torch.nn.functional.normalize(torch.randn(args.world_size * n, args.dim,
+                                                        dtype=dtype),
+                                            dim=1)
+    keys = torch.nn.functional.normalize(queries + 0.5 * torch.randn_like(queries), dim=1)
+    shard = queue.chunk(args.world_size)[rank]
+    own = slice(rank * n, (rank + 1) * n)
+    criterion = InfoNCELoss(args.moco_t)
+
+    def full():
+        q = queries[own].clone().requires_grad_()
+        loss, rank_ = criterion((q * keys[own]).sum(1, keepdim=True), q @ queue.t())
+        loss.backward()
+        return loss.detach(), rank_, q.grad
+
+    def sharded():
+        q = queries[own].clone().requires_grad_()
+        l_pos = (q * keys[own]).sum(1, keepdim=True)
+        l_neg, rank_ = sharded_negatives(q, l_pos, lambda x: x @ shard.t(), args.moco_t)
+        loss, rank_ = criterion(l_pos, l_neg, rank_)
+        loss.backward()
+        return loss.detach(), rank_, q.grad
+
+    expected, got = full(), sharded()
+    tol = 1e-10 if args.double else 1e-4
+    errors = [(a.double() - b.double()).abs().max().item() for a, b in zip(expected, got)]
+    ok = errors[0] <= tol and errors[1] == 0 and errors[2] <= tol
+    timings = {}
+    for name, step in (('whole queue', full), ('sharded', sharded)):
+        times = []
+        for _ in range(args.iters):
+            dist.barrier()
+            start = time.perf_counter()
+            step()
+            times.append(time.perf_counter() - start)
+        timings[name] = times
+    results[rank] = (ok, errors, timings)
+    dist.destroy_process_group()
+
+
+def run(args):
+    results = mp.Manager().dict()
+    mp.spawn(worker, args=(args, tempfile.mktemp(prefix='hyp2k-shard-'), results),
+             nprocs=args.world_size)
+    params = dict(world_size=args.world_size, batch_size=args.batch_size, moco_k=args.moco_k,
+                  dim=args.dim)
+    rows = []
+    for name, times in results[0][2].items():
+        row = record('shard', name, times, args.batch_size, 'queries/s', **params)
+        row['keys_per_process'] = args.moco_k // (args.world_size if name == 'sharded' else 1)
+        rows.append(row)
+    return rows, [results[rank] for rank in range(args.world_size)]
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Sharded queue check and benchmark')
+    parser.add_argument('--world-size', default=2, type=int)
+    parser.add_argument('--batch-size', default=32, type=int, help='per process')
+    parser.add_argument('--moco-k', default=16384, type=int)
+    parser.add_argument('--moco-t', default=0.07, type=float)
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--double', action='store_true', help='check in float64')
+    parser.add_argument('--threads', default=1, type=int, help='torch threads per process')
+    parser.add_argument('--iters', default=5, type=int)
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    assert args.moco_k % args.world_size == 0, 'moco-k must divide into world-size shards'
+    rows, checks = run(args)
+    emit(rows, args.out, args.baseline)
+    for rank, (ok, errors, _) in enumerate(checks):
+        print('rank {}: {} (max abs error: loss {:.2e}, rank {:.0f}, query grad {:.2e})'.format(
+            rank, 'ok' if ok else 'MISMATCH', *errors))
+    if not all(ok for ok, _, _ in checks):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
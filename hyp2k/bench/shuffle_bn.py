@@ -0,0 +1,119 @@
+"""
+Key encoder BatchNorm strategies of MoCo: batch shuffle across processes, BN
+statistics synchronized across processes, and split BN groups inside each
+process. Each one trains a small model for a few steps on a pool of synthetic
+images (instance discrimination), and reports the step throughput and the
+contrastive acc1 / loss of the last steps. Runs on CPU with gloo workers.
+
+    python -m hyp2k.bench shuffle_bn --world-size 2 --steps 40 --out bn.json
+"""
+import argparse
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torchvision.models as models
+import torchvision.transforms as transforms
+
+from ..moco.builder import MoCo
+from .utils import emit, record
+
+MODES = ['shuffle', 'sync', 'split']
+
+
+def worker(rank, args, store, results):
+    dist.init_process_group('gloo', init_method='file://' + store, world_size=args.world_size,
+                            rank=rank)
+    torch.set_num_threads(args.threads)
+    # the same image pool on every rank, different batches
+    pool = torch.rand(args.pool, 3, args.image_size + args.image_size // 8,
+                      args.image_size + args.image_size // 8,
+                      generator=torch.Generator().manual_seed(0))
+    augment = transforms.Compose([
+        transforms.RandomResizedCrop(args.image_size, scale=(0.2, 1.)),
+        transforms.RandomGrayscale(p=0.2),
+        transforms.ColorJitter(0.4, 0.4, 0.4, 0.4),
+        transforms.RandomHorizontalFlip(),
+    ])
+    for mode in args.modes:
+        torch.manual_seed(0)
+        model = MoCo(models.__dict__[args.arch],
+                     args.dim,
+                     args.k,
+                     mlp=True,
+                     shuffle_bn=mode,
+                     bn_splits=args.bn_splits)
+        model = nn.parallel.DistributedDataParallel(model)
+        model.module.queue.broadcast()
+        optimizer = torch.optim.SGD(model.parameters(), args.lr, momentum=0.9, weight_decay=1e-4)
+        generator = torch.Generator().manual_seed(rank)
+        times, acc1, losses = [], [], []
+        for step in range(args.steps):
+            image = pool[torch.randint(args.pool, (args.batch_size,), generator=generator)]
+            im_q, im_k = augment(image), augment(image)
+            start = time.perf_counter()
+            output, target = model(im_q, im_k)
+            loss = nn.functional.cross_entropy(output, target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            times.append(time.perf_counter() - start)
+            if step >= args.steps // 2:
+                acc1.append((output.argmax(1) == target).float().mean().item() * 100)
+                losses.append(loss.item())
+        stats = torch.tensor([sum(acc1) / len(acc1), sum(losses) / len(losses)])
+        dist.all_reduce(stats)
+        if rank == 0:
+            results[mode] = (times[1:], (stats / args.world_size).tolist())
+    dist.destroy_process_group()
+
+
+def run(args):
+    results = mp.Manager().dict()
+    mp.spawn(worker, args=(args, tempfile.mktemp(prefix='hyp2k-bn-'), results),
+             nprocs=args.world_size)
+    rows = []
+    for mode in args.modes:
+        times, (acc1, loss) = results[mode]
+        row = record('shuffle_bn', mode, times, args.batch_size * args.world_size, 'img/s',
+                     arch=args.arch, world_size=args.world_size, batch_size=args.batch_size,
+                     image_size=args.image_size, steps=args.steps, bn_splits=args.bn_splits)
+        row.update(acc1=acc1, loss=loss)
+        rows.append(row)
+    return rows
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Key encoder BatchNorm strategies')
+    parser.add_argument('--modes', nargs='*', default=MODES, choices=MODES)
+    parser.add_argument('--arch', default='resnet18')
+    parser.add_argument('--world-size', default=2, type=int)
+    parser.add_argument('--batch-size', default=32, type=int, help='per process')
+    parser.add_argument('--image-size', default=64, type=int)
+    parser.add_argument('--bn-splits', default=8, type=int)
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--k', default=1024, type=int)
+    parser.add_argument('--pool', default=256, type=int, help='number of synthetic images')
+    parser.add_argument('--steps', default=40, type=int)
+    parser.add_argument('--lr', default=0.03, type=float)
+    parser.add_argument('--threads', default=1, type=int, help='torch threads per process')
+    parser.add_argument('--out', default='', help='write JSON results here')
+    parser.add_argument('--baseline', default='', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    rows = run(args)
+    emit(rows, args.out, args.baseline)
+    print('{:<10} {:>8} {:>8}   (last {} steps)'.format('mode', 'acc1', 'loss',
+                                                       args.steps - args.steps // 2))
+    for row in rows:
+        print('{:<10} {:>8.2f} {:>8.4f}'.format(row['case'], row['acc1'], row['loss']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+
+def sync(device=None):
+    if torch.cuda.is_available() and (device is None or torch.device(device).type == 'cuda'):
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, iters=10, warmup=1, device=None, setup=None):
+    """
+    Times `fn()`. Returns (first_call_seconds, [seconds per steady-state call]); the
+    first call is part of the warm-up. With `setup`, each call is timed as
+    `fn(setup())` and the setup itself is not timed.
+    """
+
+    def call():
+        arg = setup() if setup is not None else None
+        sync(device)
+        start = time.perf_counter()
+        fn(arg) if setup is not None else fn()
+        sync(device)
+        return time.perf_counter() - start
+
+    first = call()
+    for _ in range(warmup - 1):
+        call()
+    return first, [call() for _ in range(iters)]
+
+
+def summarize(times):
+    """Mean and standard deviation in milliseconds."""
+    mean = sum(times) / len(times)
+    var = sum((t - mean)**2 for t in times) / max(len(times) - 1, 1)
+    return mean * 1e3, var**0.5 * 1e3
+
+
+def record(bench, case, times, items=None, unit='img/s', first=None, **params):
+    """One machine-readable result row."""
+    mean_ms, std_ms = summarize(times)
+    row = {
+        'bench': bench,
+        'case': case,
+        'params': params,
+        'iters': len(times),
+        'mean_ms': mean_ms,
+        'std_ms': std_ms,
+    }
+    if first is not None:
+        row['first_call_ms'] = first * 1e3
+    if items is not None:
+        row['throughput'] = items / (mean_ms / 1e3)
+        row['unit'] = unit
+    return row
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        'machine': platform.machine(),
+    }
+
+
+def compare(rows, baseline):
+    """Prints the mean time of each row relative to the same row in a saved run."""
+    with open(baseline) as f:
+        old = {_key(row): row for row in json.load(f)['results']}
+    print('=> relative to {}'.format(baseline))
+    for row in rows:
+        ref = old.get(_key(row))
+        if ref is None:
+            continue
+        print('{:<12} {:<36} {:6.3f}x'.format(row['bench'], row['case'],
+                                             row['mean_ms'] / ref['mean_ms']))
+
+
+def _key(row):
+    return row['bench'], row['case'], json.dumps(row['params'], sort_keys=True)
+
+
+def emit(rows, out=None, baseline=None):
+    """Prints result rows as a table and writes them as JSON when `out` is set."""
+    for row in rows:
+        line = '{:<12} {:<36} {:10.3f} ms +- {:8.3f}'.format(row['bench'], row['case'],
+                                                            row['mean_ms'], row['std_ms'])
+        if 'throughput' in row:
+            line += '  {:12.1f} {}'.format(row['throughput'], row['unit'])
+        if 'first_call_ms' in row:
+            line += '  (first call {:.1f} ms)'.format(row['first_call_ms'])
+        print(line)
+    if out:
+        with open(out, 'w') as f:
+            json.dump({'environment': environment(), 'results': rows}, f, indent=2)
+        print("=> wrote {} results to '{}'".format(len(rows), out))
+    if baseline:
+        compare(rows, baseline)
+
+
+def init_single_process_group(backend='gloo'):
+    """A world of one, so the DDP-only MoCo paths (batch shuffle, gathers) can run."""
+    import tempfile
+    import torch.distributed as dist
+    if not dist.is_initialized():
+        store = tempfile.NamedTemporaryFile(prefix='hyp2k-bench-', delete=False).name
+        dist.init_process_group(backend, init_method='file://' + store, world_size=1, rank=0)
@@ -1,9 +1,21 @@
 import argparse
-import torchvision.models as models
+import functools
 
-model_names = sorted(name for name in models.__dict__
-                     if name.islower() and not name.startswith("__")
-                     and callable(models.__dict__[name]))
+from .optim import OPTIMIZERS
+
+
+@functools.lru_cache(maxsize=None)
+def model_names():
+    """
+    Architectures of torchvision.models, looked up once and only when an --arch is
+    validated, so that parsing (and --help) does not walk the model registry.
+    """
+    import torchvision.models as models
+    if hasattr(models, 'list_models'):
+        return tuple(sorted(models.list_models(module=models)))
+    return tuple(
+        sorted(name for name in models.__dict__ if name.islower() and not name.startswith("__")
+               and callable(models.__dict__[name])))
 
 def parse_args():
     parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
@@ -11,9 +23,7 @@ def parse_args():
                         '--arch',
                         metavar='ARCH',
                         default='resnet50',
-                        choices=model_names,
-                        help='model architecture: ' + ' | '.join(model_names) +
-                        ' (default: resnet50)')
+                        help='model architecture, any of torchvision.models (default: resnet50)')
     parser.add_argument('-j',
                         '--workers',
                         default=32,
@@ -55,6 +65,16 @@ def parse_args():
                         type=float,
                         metavar='M',
                         help='momentum of SGD solver')
+    parser.add_argument('--optimizer',
+                        default='sgd',
+                        choices=OPTIMIZERS,
+                        help='sgd, its foreach or fused multi-tensor kernels, or lars: '
+                        'layer-wise adaptive rates, without adapting or decaying BN and '
+                        'bias parameters (default: sgd)')
+    parser.add_argument('--lars-eta',
+                        default=0.001,
+                        type=float,
+                        help='trust coefficient of --optimizer lars (default: 0.001)')
     parser.add_argument('--wd',
                         '--weight-decay',
                         default=1e-4,
@@ -72,7 +92,8 @@ def parse_args():
                         default='',
                         type=str,
                         metavar='PATH',
-                        help='path to latest checkpoint (default: none)')
+                        help='path to latest checkpoint, or auto for the newest '
+                        'checkpoint_<run-name>_*.pth.tar here (default: none)')
     parser.add_argument('-e',
                         '--evaluate',
                         dest='evaluate',
@@ -99,12 +120,57 @@ def parse_args():
                         type=int,
                         help='seed for initializing training. ')
     parser.add_argument('--gpu', default=None, type=int, help='GPU id to use.')
+    parser.add_argument('--channels-last',
+                        action='store_true',
+                        help='run the encoders and their inputs in channels_last layout')
+    parser.add_argument('--compile',
+                        action='store_true',
+                        help='torch.compile the encoder forward (query/key encoders with '
+                        'their heads for pretraining, the whole model for linear eval)')
+    parser.add_argument('--profile-steps',
+                        type=str,
+                        default='',
+                        help='global steps to record with the PyTorch profiler, e.g. '
+                        '"100-104,500" (default: none)')
+    parser.add_argument('--profile-dir',
+                        type=str,
+                        default='',
+                        help='where profiler traces and summaries go '
+                        '(default: profile_<run-name>)')
     parser.add_argument('--multiprocessing-distributed',
                         action='store_true',
                         help='Use multi-processing distributed training to launch '
                         'N processes per node, which has N GPUs. This is the '
                         'fastest way to use PyTorch for either single node or '
                         'multi node data parallel training')
+    parser.add_argument('--autotune-loader',
+                        action='store_true',
+                        help='time the first --autotune-steps steps and the loader on its own, '
+                        'then pick the workers, prefetch depth and worker persistence of the '
+                        'training loader for the following epochs')
+    parser.add_argument('--autotune-steps',
+                        default=50,
+                        type=int,
+                        metavar='N',
+                        help='steps timed by --autotune-loader (default: 50)')
+    parser.add_argument('--loader-cpus',
+                        default=0,
+                        type=int,
+                        metavar='N',
+                        help='most loader workers per process --autotune-loader may pick '
+                        '(default: 0, the cores of the process less its compute threads)')
+    parser.add_argument('--nproc-per-node',
+                        default=0,
+                        type=int,
+                        metavar='N',
+                        help='processes spawned per node by --multiprocessing-distributed, '
+                        'e.g. gloo workers on CPU (default: 0, one per GPU)')
+    parser.add_argument('--threads-per-proc',
+                        default=0,
+                        type=int,
+                        metavar='N',
+                        help='intra-op threads of each process when a node runs several '
+                        '(default: 0, the cores split evenly)')
 
     # moco specific configs:
     parser.add_argument('--moco-dim',
@@ -116,6 +182,74 @@ def parse_args():
         default=65536,
         type=int,
         help='queue size; number of negative keys (default: 65536)')
+    parser.add_argument('--queue-dtype',
+                        default='float32',
+                        choices=['float32', 'bfloat16', 'float16', 'int8'],
+                        help='storage precision of the queue; int8 keeps a scale per key, '
+                        'logits are always accumulated in fp32 (default: float32)')
+    parser.add_argument('--queue-check-freq',
+                        default=0,
+                        type=int,
+                        metavar='N',
+                        help='compare the queues of all processes every N steps and '
+                        'resynchronize them if they differ (default: 0, never)')
+    parser.add_argument('--shuffle-bn',
+                        default='shuffle',
+                        choices=['shuffle', 'sync', 'split'],
+                        help='BatchNorm of the key encoder: batch shuffle across processes, '
+                        'statistics synchronized across processes, or split into --bn-splits '
+                        'groups within each process, which needs no DDP (default: shuffle)')
+    parser.add_argument('--bn-splits',
+                        default=8,
+                        type=int,
+                        help='BN groups per process of --shuffle-bn split (default: 8)')
+    parser.add_argument('--fused-loss',
+                        action='store_true',
+                        help='compute the InfoNCE loss and accuracy tile by tile over the '
+                        'queue, without materializing the Nx(1+K) logits')
+    parser.add_argument('--neg-mode',
+                        default='all',
+                        choices=['all', 'sample', 'hard'],
+                        help='negatives of each query (--hyper): the whole queue, --neg-count '
+                        'sampled entries, or the --neg-count nearest ones plus --neg-tail '
+                        'sampled entries (default: all)')
+    parser.add_argument('--neg-count',
+                        default=4096,
+                        type=int,
+                        metavar='M',
+                        help='negatives scored per query by --neg-mode sample/hard')
+    parser.add_argument('--neg-tail',
+                        default=1024,
+                        type=int,
+                        help='sampled entries standing in for the rest of the queue in '
+                        '--neg-mode hard, 0 for none (default: 1024)')
+    parser.add_argument('--shard-queue',
+                        action='store_true',
+                        help='split the queue across processes, each holding moco-k / '
+                        'world-size keys, and combine the shards with a distributed '
+                        'logsumexp; implies --fused-loss')
+    parser.add_argument('--save-freq',
+                        default=0,
+                        type=int,
+                        metavar='N',
+                        help='every N steps, save checkpoint_<run-name>_last.pth.tar, which '
+                        '--resume continues mid-epoch (default: 0, epoch checkpoints only)')
+    parser.add_argument('--small-crops',
+                        default=0,
+                        type=int,
+                        metavar='M',
+                        help='multi-crop: M small views per image, encoded by the query '
+                        'encoder only and scored against the same key (default: 0)')
+    parser.add_argument('--small-crop-size',
+                        default=96,
+                        type=int,
+                        help='resolution of the small views (default: 96)')
+    parser.add_argument('--small-crop-scale',
+                        default=[0.05, 0.14],
+                        nargs=2,
+                        type=float,
+                        help='RandomResizedCrop scale range of the small views '
+                        '(default: 0.05 0.14)')
     parser.add_argument(
         '--moco-m',
         default=0.999,
@@ -146,6 +280,33 @@ def parse_args():
     parser.add_argument('--hyper',
                         action='store_true',
                         help='use hyperbolic momentum contrast')
+    parser.add_argument('--curvature',
+                        type=float,
+                        default=1.0,
+                        help='curvature c of the Poincare ball (default: 1.0)')
+    parser.add_argument('--train-c',
+                        action='store_true',
+                        help='learn the curvature (shared by the query and key heads), '
+                        'within a factor 100 of --curvature')
+    parser.add_argument('--c-lr',
+                        default=1e-4,
+                        type=float,
+                        help='learning rate of --train-c, without weight decay (default: 1e-4)')
+    # the objective of --hyper runs; the defaults are those of the original HyperMoCo,
+    # see "Hyperbolic objective" in the README before changing them on a resumed run
+    parser.add_argument('--ball-features',
+                        action='store_true',
+                        help='keep the points of the Poincare head instead of L2-normalizing '
+                        'them, which puts them on the boundary of the c = 1 ball')
+    parser.add_argument('--neg-distance',
+                        action='store_true',
+                        help='use minus the Poincare distances as logits, so that nearer keys '
+                        'score higher (default: the distances)')
+    parser.add_argument('--queue-radius',
+                        type=float,
+                        default=1.0,
+                        help='norm of the initial random queue entries of --hyper runs, e.g. '
+                        '0.5 / sqrt(curvature) to start inside the ball (default: 1.0)')
     parser.add_argument('--run-name',
                         type=str,
                         default='train',
@@ -158,6 +319,13 @@ def parse_args():
                         type=str,
                         default='/',
                         help='The dataset path')
+    parser.add_argument('--rp2k-permute',
+                        default=None,
+                        type=int,
+                        choices=[0, 1],
+                        help='1 to transpose height and width of RP2K images, as every run '
+                        'did so far, 0 to keep them upright; saved in the checkpoints '
+                        '(default: that of the resumed or --pretrained checkpoint, else 1)')
     parser.add_argument('--pretrained',
                         default='',
                         type=str,
@@ -168,6 +336,29 @@ def parse_args():
                         default='linear',
                         help='Train all network or train the linear layer only')
     parser.add_argument('--conv_lr', type=float, default=1e-3)
+    parser.add_argument('--sweep-lr',
+                        nargs='*',
+                        type=float,
+                        default=[],
+                        metavar='LR',
+                        help='linear evaluation: train one fc head per learning rate (and '
+                        '--sweep-wd) on a single backbone forward (default: --lr only)')
+    parser.add_argument('--sweep-wd',
+                        nargs='*',
+                        type=float,
+                        default=[],
+                        metavar='W',
+                        help='weight decays of the --sweep-lr heads, every combination gets '
+                        'a head (default: --wd only)')
+    parser.add_argument('--val-cache',
+                        type=str,
+                        default='',
+                        help='path of a uint8 cache of the preprocessed validation set, '
+                        'built on first use (default: none)')
     parser.add_argument('--shots', type=int, default=10)
     parser.add_argument('--num-class', type=int, default=2388)
-    return parser.parse_args()
\ No newline at end of file
+    args = parser.parse_args()
+    if args.arch not in model_names():
+        parser.error("argument -a/--arch: invalid choice: '{}' (choose from {})".format(
+            args.arch, ', '.join(model_names())))
+    return args
\ No newline at end of file
@@ -0,0 +1,113 @@
+import math
+import time
+
+import torch
+
+from ..launch import usable_cores
+
+
+def loader_cpus(procs_per_node):
+    """
+    Cores the loader workers of one process may use: its share of the node, less
+    the ones its own intra-op threads compute on when training on CPU.
+    """
+    cores = max(1, len(usable_cores()) // max(procs_per_node, 1))
+    busy = 1 if torch.cuda.is_available() else torch.get_num_threads()
+    return max(cores - busy, 0)
+
+
+class LoaderTuner(object):
+    """
+    Picks num_workers, prefetch_factor and persistent_workers of a training loader.
+
+    The first `steps` steps train with the loader as given, timing the compute of
+    each step (all but the wait for its batch) and how long it waited. Then loaders
+    with 0, 1, 2, 4, ... up to `cpus` workers are timed on their own, and the fewest
+    workers that produce a batch faster than a step computes are chosen (the fastest
+    ones if none does). The prefetch depth covers the longest gap between batches
+    seen, and workers persist across epochs when there is more than one left.
+
+    `make_loader(num_workers, prefetch_factor, persistent_workers, generator)`
+    builds the loader (`workers` the given one has); the new one is returned by
+    `loader()` once `observe` has returned True, to be used from the next epoch on.
+    """
+
+    def __init__(self, make_loader, workers, cpus, steps=50, epochs=1, probe_seconds=10.):
+        self.make_loader = make_loader
+        self.workers = workers
+        self.cpus = cpus
+        self.steps = steps
+        self.epochs = epochs
+        self.probe_seconds = probe_seconds
+        self.compute = []
+        self.waits = []
+        self.config = None
+
+    def observe(self, step_seconds, wait_seconds):
+        """Records a step; True once the loader is tuned."""
+        if self.config is not None:
+            return True
+        self.compute.append(max(step_seconds - wait_seconds, 0.))
+        self.waits.append(wait_seconds)
+        # the first steps also pay for worker start-up and warm-up
+        if len(self.compute) >= self.steps + 2:
+            self.tune()
+        return self.config is not None
+
+    def probe(self, num_workers):
+        """(seconds to the first batch, seconds between the later ones) of a fresh loader"""
+        loader = self.make_loader(num_workers, None, False, torch.Generator())
+        start = time.time()
+        batches = iter(loader)
+        startup, gaps, last = 0., [], None
+        for _ in range(max(2 * num_workers, 8) + 1):
+            try:
+                next(batches)
+            except StopIteration:
+                break
+            now = time.time()
+            if last is None:
+                startup = now - start
+            else:
+                gaps.append(now - last)
+            last = now
+            if now - start > self.probe_seconds and len(gaps) >= 2:
+                break
+        del batches
+        return startup, gaps[num_workers // 2:] or gaps or [startup]
+
+    def tune(self):
+        compute = sorted(self.compute[2:])[len(self.compute[2:]) // 2]
+        waits = sum(self.waits[2:])
+        bound = waits / max(waits + sum(self.compute[2:]), 1e-9)
+        counts = sorted({0, self.cpus} | {2**i for i in range(8) if 2**i < self.cpus})
+        trials = {}
+        for num_workers in counts:
+            startup, gaps = self.probe(num_workers)
+            trials[num_workers] = (startup, sum(gaps) / len(gaps), max(gaps))
+            if trials[num_workers][1] <= compute:
+                break
+        fast = [w for w, (_, mean, _) in trials.items() if mean <= compute]
+        num_workers = min(fast) if fast else min(trials, key=lambda w: trials[w][1])
+        startup, mean, longest = trials[num_workers]
+        prefetch = None
+        if num_workers:
+            # batches in flight cover the longest gap between two of them
+            prefetch = min(max(math.ceil((longest / max(compute, 1e-6) + 1) / num_workers), 2), 8)
+        self.config = {
+            'num_workers': num_workers,
+            'prefetch_factor': prefetch,
+            'persistent_workers': num_workers > 0 and self.epochs > 1,
+        }
+        print('=> loader autotune: {:.1f} ms compute per step, {:.0%} of step time spent waiting '
+              'for data with {} workers; cpu budget {}'.format(compute * 1e3, bound, self.workers,
+                                                               self.cpus))
+        for w, (start, mean, _) in trials.items():
+            print('   {:>3} workers: {:8.1f} ms per batch, {:6.2f} s to start'.format(
+                w, mean * 1e3, start))
+        print('=> loader autotune: {num_workers} workers, prefetch {prefetch_factor}, '
+              'persistent {persistent_workers}; expect {bound:.0%} waiting for data'.format(
+                  bound=max(mean - compute, 0) / max(mean, compute), **self.config))
+
+    def loader(self, generator=None):
+        return self.make_loader(generator=generator, **self.config)
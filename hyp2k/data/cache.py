@@ -0,0 +1,121 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader
+
+
+def _first_view(image):
+    # datasets of several views per sample (e.g. RP2k) are cached by their first
+    return image[0] if isinstance(image, (list, tuple)) else image
+
+
+def _to_uint8(image, transform):
+    if image.dtype == torch.uint8:
+        image = image.float().div_(255)
+    if transform is not None:
+        image = transform(image)
+    return image.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def cache_header(dataset, transform=None):
+    """
+    What a cache of `dataset` depends on besides its samples: the sample and batch
+    transforms (and whether RP2K images are transposed) and the cached image shape
+    (of the first sample).
+    """
+    sample_transform = getattr(dataset, 'transform', None) or getattr(dataset, 'aug', None)
+    image = _to_uint8(_first_view(dataset[0][0]).unsqueeze(0), transform)
+    return {
+        'num_samples': len(dataset),
+        'transform': '{!r} | {!r}'.format(sample_transform, transform) +
+                     (' | transposed' if getattr(dataset, 'permute', False) else ''),
+        'image_shape': tuple(image.shape[1:]),
+    }
+
+
+def build_eval_cache(dataset, path, transform=None, batch_size=256, num_workers=0):
+    """
+    Run `dataset` (and an optional deterministic batch `transform`) once and store
+    the resulting images as uint8 together with the targets.
+
+    The dataset must yield (image, *targets) with uint8 images or float images in [0, 1].
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    images, targets = None, None
+    offset = 0
+    for i, (image, *target) in enumerate(loader):
+        image = _to_uint8(_first_view(image), transform)
+        if images is None:
+            images = torch.empty((len(dataset),) + image.shape[1:], dtype=torch.uint8)
+            targets = [torch.empty(len(dataset), dtype=torch.long) for _ in target]
+        images[offset:offset + image.size(0)] = image
+        for buf, t in zip(targets, target):
+            buf[offset:offset + image.size(0)] = t
+        offset += image.size(0)
+        if (i + 1) % 20 == 0:
+            print("---> Cached {}/{} evaluation samples".format(offset, len(dataset)))
+
+    tmp = path + '.tmp'
+    torch.save(dict(cache_header(dataset, transform), images=images, targets=targets), tmp)
+    os.replace(tmp, path)
+
+
+def _load(path):
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except TypeError:  # torch < 2.1 has no mmap loading
+        return torch.load(path, map_location='cpu')
+
+
+def _stale(path, header):
+    """Why the cache at `path` cannot serve `header`, or '' if it can"""
+    if not os.path.isfile(path):
+        return 'no cache yet'
+    cache = _load(path)
+    for key, value in header.items():
+        if key not in cache:
+            return 'no {} recorded'.format(key)
+        if cache[key] != value:
+            return '{} changed'.format(key)
+    return ''
+
+
+class CachedEvalDataset(Dataset):
+    """
+    Evaluation set read back from `build_eval_cache`. Items are (uint8 image, *targets);
+    the conversion to float and normalization are left to the consumer.
+    """
+
+    def __init__(self, path, num_samples=None):
+        cache = _load(path)
+        if num_samples is not None and cache['num_samples'] != num_samples:
+            raise RuntimeError("Evaluation cache '{}' holds {} samples but the dataset has {}, "
+                               "remove it to rebuild.".format(path, cache['num_samples'],
+                                                             num_samples))
+        self.images = cache['images']
+        self.targets = cache['targets']
+
+    def __getitem__(self, index):
+        return (self.images[index],) + tuple(t[index] for t in self.targets)
+
+    def __len__(self):
+        return self.images.size(0)
+
+
+def load_eval_cache(path, dataset, transform=None, batch_size=256, num_workers=0):
+    """
+    Returns a CachedEvalDataset for `dataset`, building the cache first if needed,
+    or again when it was built with other transforms or for another dataset size.
+    Under torch.distributed only global rank 0 writes it, the other ranks wait.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    if not distributed or dist.get_rank() == 0:
+        stale = _stale(path, cache_header(dataset, transform))
+        if stale:
+            print("=> building evaluation cache '{}' ({})".format(path, stale))
+            build_eval_cache(dataset, path, transform, batch_size, num_workers)
+    if distributed:
+        dist.barrier()
+    print("=> loading evaluation cache '{}'".format(path))
+    return CachedEvalDataset(path, len(dataset))
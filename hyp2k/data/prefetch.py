@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+
+import torch
+
+from ..profiling import phase
+
+
+class DataPrefetcher(object):
+    """
+    Wraps a DataLoader and stages the next batch while the current one is used.
+
+    On CUDA the copy runs on a side stream, on CPU a background thread prepares the
+    batches. Every tensor of a batch is moved to `device`; batched images (4-dim
+    tensors) stored as uint8 are scaled to [0, 1] floats and, if `mean`
+    and `std` are given, normalized there, so loaders can hand over uint8 data. They
+    are also laid out in `memory_format` (e.g. torch.channels_last).
+
+    After each step `wait_time` holds the seconds the consumer was blocked waiting
+    for that batch.
+    """
+
+    def __init__(self,
+                 loader,
+                 device,
+                 mean=None,
+                 std=None,
+                 depth=2,
+                 memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.memory_format = memory_format
+        if mean is not None:
+            self.mean = torch.tensor(mean, dtype=torch.float32, device=self.device).view(-1, 1, 1)
+            self.std = torch.tensor(std, dtype=torch.float32, device=self.device).view(-1, 1, 1)
+        else:
+            self.mean = self.std = None
+        self.wait_time = 0.
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _prepare(self, batch, non_blocking=False):
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._prepare(b, non_blocking) for b in batch)
+        if not torch.is_tensor(batch):
+            return batch
+        batch = batch.to(self.device, non_blocking=non_blocking)
+        if batch.dim() == 4:
+            if batch.dtype == torch.uint8:
+                batch = batch.float().div_(255)
+            if self.mean is not None:
+                batch = batch.sub_(self.mean).div_(self.std)
+            batch = batch.contiguous(memory_format=self.memory_format)
+        return batch
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        loader_iter = iter(self.loader)
+
+        def preload():
+            try:
+                with phase('data/next'):
+                    batch = next(loader_iter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream), phase('data/to_device'):
+                return self._prepare(batch, non_blocking=True)
+
+        next_batch = preload()
+        while next_batch is not None:
+            start = time.time()
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = next_batch
+            # memory was allocated on the side stream but is consumed on this one
+            _record_stream(batch, current)
+            next_batch = preload()
+            self.wait_time = time.time() - start
+            yield batch
+
+    def _iter_thread(self):
+        done = object()
+        stop = threading.Event()
+        batches = queue.Queue(maxsize=self.depth)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put(self._prepare(batch)):
+                        return
+                put(done)
+            except Exception as e:  # re-raised in the consumer
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                with phase('data/wait'):
+                    batch = batches.get()
+                self.wait_time = time.time() - start
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif torch.is_tensor(batch):
+        batch.record_stream(stream)
@@ -1,16 +1,90 @@
+import math
 import os
 from logging import log, INFO
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
+from torchvision.transforms import functional as F
 from PIL import Image
 import json
 
-def loadimg(path: str, permute=bool, aug=None):
-    trans = transforms.Compose(aug)
-    img = Image.open(path).convert('RGB')
-    img = trans(img)
-    img = img.permute(0, 2, 1)
-    return img
+
+def _transforms(aug):
+    return list(aug.transforms) if isinstance(aug, transforms.Compose) else list(aug or [])
+
+
+def uint8_augmentation(aug):
+    """
+    `aug` (a list or Compose of PIL transforms) ending in PILToTensor, so samples stay
+    uint8, and its Normalize, to be applied on the device (e.g. by DataPrefetcher).
+    """
+    kept, normalize = [], None
+    for t in _transforms(aug):
+        if isinstance(t, transforms.Normalize):
+            normalize = t
+        elif not isinstance(t, (transforms.ToTensor, transforms.PILToTensor)):
+            kept.append(t)
+    return kept + [transforms.PILToTensor()], normalize
+
+
+def _reduction(size, out):
+    """Largest downscale of a `size` (h, w) region that still covers `out` pixels"""
+    out = (out, out) if isinstance(out, int) else tuple(out)
+    if len(out) == 1:  # Resize to a shorter side
+        return min(size) / out[0]
+    return min(size[0] / out[0], size[1] / out[1])
+
+
+def loadviews(path: str, aug=None, views=1, permute=True, draft=True, small_aug=None,
+              small_views=0):
+    """
+    `views` samples of `aug` (a list or Compose of PIL transforms) of the image at
+    `path`, followed by `small_views` samples of `small_aug` (the small views of the
+    multi-crop mode), all from one decode. With `draft`, a JPEG is decoded in the DCT
+    domain at the smallest scale (1/2, 1/4 or 1/8) that still gives every view the
+    output resolution of its leading RandomResizedCrop (whose crops are drawn first)
+    or Resize. `permute` transposes height and width, as RP2K runs always have.
+    """
+    img = Image.open(path)
+    width, height = img.size  # read from the header, before decoding
+    plan = []  # (leading crop or None, its box, remaining transforms) of every view
+    for view_aug, count in ((aug, views), (small_aug, small_views)):
+        trans = _transforms(view_aug)
+        first = trans[0] if trans else None
+        for _ in range(count):
+            if isinstance(first, transforms.RandomResizedCrop):
+                box = first.get_params(img, first.scale, first.ratio)
+                plan.append((first, box, trans[1:]))
+            else:
+                plan.append((None, None, trans))
+    if draft and img.format == 'JPEG':
+        scale = float('inf')
+        for crop, box, trans in plan:
+            if crop is not None:
+                scale = min(scale, _reduction(box[2:], crop.size))
+            elif trans and isinstance(trans[0], transforms.Resize):
+                scale = min(scale, _reduction((height, width), trans[0].size))
+            else:
+                scale = 1
+        if 2 <= scale < float('inf'):
+            img.draft('RGB', (math.ceil(width / scale), math.ceil(height / scale)))
+    img = img.convert('RGB')
+    out = []
+    for crop, box, trans in plan:
+        view = img
+        if crop is not None:
+            # the crop drawn on the full image, in the pixels of the decoded one
+            i, j, h, w = box
+            sy, sx = img.size[1] / height, img.size[0] / width
+            view = F.resized_crop(img, round(i * sy), round(j * sx), max(round(h * sy), 1),
+                                  max(round(w * sx), 1), crop.size, crop.interpolation,
+                                  crop.antialias)
+        view = transforms.Compose(trans)(view)
+        out.append(view.transpose(1, 2).contiguous() if permute else view)
+    return out
+
+
+def loadimg(path: str, permute=True, aug=None, draft=True):
+    return loadviews(path, aug, 1, permute, draft)[0]
 
 
 class RP2kDataset(Dataset):
@@ -21,15 +95,26 @@ class RP2kDataset(Dataset):
             args,
             num=-1,
             aug=[transforms.RandomResizedCrop(224),
-                 transforms.ToTensor()]):
+                 transforms.PILToTensor()],
+            permute=True,
+            draft=True,
+            small_aug=None,
+            small_views=0):
         '''
         mode: Dataset type, 'train' / 'eval'
         num: Number of samples for each class, -1 means all samples
+        permute: transpose height and width of the images, as runs always have
+        draft: decode JPEGs at reduced scale where aug allows, see loadviews
+        small_aug, small_views: extra small views of every sample (multi-crop)
         '''
         self.len = 0
         self.data = []
         self.config = args
         self.aug = aug
+        self.permute = permute
+        self.draft = draft
+        self.small_aug = small_aug
+        self.small_views = small_views
         if mode != 'train' and mode != 'val':
             raise RuntimeError("Please specify train/val set! (train/val)")
 
@@ -45,11 +130,8 @@ class RP2kDataset(Dataset):
                 if num == -1:
                     for img_name in os.listdir(subdir):
                         if self.config.load_all:
-                            img0 = loadimg(os.path.join(subdir, img_name),
-                                           aug=self.aug)
-                            img1 = loadimg(os.path.join(subdir, img_name),
-                                           aug=self.aug)
-                            self.data.append(((img0, img1), dir))
+                            imgs = self.load(os.path.join(subdir, img_name))
+                            self.data.append((tuple(imgs), dir))
                         else:
                             self.data.append((os.path.join(subdir,
                                                            img_name), dir))
@@ -57,11 +139,8 @@ class RP2kDataset(Dataset):
                 else:
                     for img_name in os.listdir(subdir)[:num]:
                         if self.config.load_all:
-                            img0 = loadimg(os.path.join(subdir, img_name),
-                                           aug=self.aug)
-                            img1 = loadimg(os.path.join(subdir, img_name),
-                                           aug=self.aug)
-                            self.data.append(((img0, img1), dir))
+                            imgs = self.load(os.path.join(subdir, img_name))
+                            self.data.append((tuple(imgs), dir))
                         else:
                             self.data.append((os.path.join(subdir,
                                                            img_name), dir))
@@ -73,10 +152,14 @@ class RP2kDataset(Dataset):
             cate = self.data[index][1]
             return (imgs, int(cate))
         else:
-            img0 = loadimg(self.data[index][0], aug=self.aug)
-            img1 = loadimg(self.data[index][0], aug=self.aug)
+            imgs = self.load(self.data[index][0])
             cate = self.data[index][1]
-            return ((img0, img1), int(cate))
+            return (tuple(imgs), int(cate))
+
+    def load(self, path):
+        # both views, and the small ones, come from one decode
+        return loadviews(path, self.aug, 2, self.permute, self.draft, self.small_aug,
+                         self.small_views)
 
     def __len__(self):
         return self.len
@@ -0,0 +1,108 @@
+import random
+
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+class DistributedEvalSampler(DistributedSampler):
+    """
+    Sequential DistributedSampler for evaluation.
+
+    Every rank gets a disjoint, strided slice of the dataset. Like the parent class,
+    the shorter slices are padded with samples from the start of the dataset so that
+    all ranks run the same number of batches (collectives inside DDP forward would
+    hang otherwise). Padding only ever sits at the tail of a rank's slice, so the
+    first `num_valid` samples a rank sees are the ones it must count.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        super(DistributedEvalSampler, self).__init__(dataset,
+                                                     num_replicas=num_replicas,
+                                                     rank=rank,
+                                                     shuffle=False,
+                                                     drop_last=False)
+        self.num_valid = len(range(self.rank, len(self.dataset), self.num_replicas))
+
+
+class ResumableSampler(DistributedSampler):
+    """
+    Training DistributedSampler that can start an epoch part-way through.
+
+    The order of an epoch only depends on (seed, epoch), so skipping the samples a
+    preempted run already consumed continues it exactly. `set_epoch` starts the next
+    epoch from its beginning. With num_replicas=1 and rank=0 it also serves
+    single-process training. A state saved with another number of replicas resumes
+    at the same position of the epoch's global order.
+
+    With `seeded`, it yields (index, seed) pairs for a SeededDataset, where the seed
+    of every sample only depends on (seed, epoch, index): the random augmentation of
+    the loader workers then continues exactly too, whatever the workers.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None, seed=0, seeded=False):
+        super(ResumableSampler, self).__init__(dataset,
+                                               num_replicas=num_replicas,
+                                               rank=rank,
+                                               shuffle=True,
+                                               seed=seed)
+        self.start = 0
+        self.seeded = seeded
+
+    def set_epoch(self, epoch):
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start = 0
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())[self.start:]
+        if self.seeded:
+            g = torch.Generator()
+            g.manual_seed(2**32 + self.seed + self.epoch)  # not the generator of the order
+            seeds = torch.randint(2**62, (len(self.dataset),), generator=g).tolist()
+            return iter([(i, seeds[i]) for i in indices])
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def state_dict(self, start=None):
+        """State of the sampler, positioned at sample `start` of the epoch (if given)"""
+        start = self.start if start is None else start
+        return {
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'start': start,
+            'num_replicas': self.num_replicas
+        }
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'])
+        # every replica has consumed `start` samples of the strided global order
+        consumed = state['start'] * state.get('num_replicas', self.num_replicas)
+        self.start = min(consumed // self.num_replicas, self.num_samples)
+
+
+class SeededDataset(Dataset):
+    """
+    Samples of `dataset` for the (index, seed) pairs of a seeded ResumableSampler:
+    the python and torch RNGs draw the random transforms of each sample from its
+    seed, and are restored afterwards (for a loader without workers).
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, item):
+        index, seed = item
+        state = random.getstate()
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            random.seed(seed)
+            try:
+                return self.dataset[index]
+            finally:
+                random.setstate(state)
+
+    def __len__(self):
+        return len(self.dataset)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+Evaluates every checkpoint of a pretraining run and prints accuracy against epoch.
+
+    python -m hyp2k.evaluate_run train --dir . --dataset cifar100 --dataset-dir ~/data
+
+Finds the checkpoint_<run>_<epoch>.pth.tar files written by main_moco. It scores
+the frozen encoder_q backbone of each one with a weighted kNN classifier and a
+linear probe. Both are trained on center-crop features, so the probe is a quick
+proxy for main_lincls, not a replacement.
+
+Checkpoints are spread over a pool of processes. Each process is pinned to its
+own group of cores. Results are cached by checkpoint content (and evaluation
+settings) in a JSON file, so re-runs only evaluate new checkpoints. The decoded
+dataset is stored once as uint8 caches that all workers share. These hold the
+center crops of image folders, and the 32px images of CIFAR, which are resized
+in batches.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import math
+import multiprocessing as mp
+import os
+import re
+import time
+
+import torch
+import torch.nn as nn
+import torchvision.datasets as datasets
+import torchvision.models as models
+import torchvision.transforms as transforms
+
+from .data.CIFAR100 import CIFAR100
+from .data.cache import CachedEvalDataset, load_eval_cache
+
+MEAN, STD = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Evaluate all checkpoints of a MoCo run')
+    parser.add_argument('run', help='run name, as --run-name of main_moco')
+    parser.add_argument('--dir', default='.', help='directory of the checkpoints')
+    parser.add_argument('-a', '--arch', default='resnet50')
+    parser.add_argument('--dataset', default='cifar100', choices=['cifar100', 'folder'],
+                        help='cifar100, or an image folder with train/ and val/ (e.g. RP2k)')
+    parser.add_argument('--dataset-dir', default='/', help='the dataset path')
+    parser.add_argument('--image-size', default=224, type=int,
+                        help='center crop size, after resizing to 8/7 of it')
+    parser.add_argument('--cache-dir', default='eval_cache',
+                        help='uint8 center crops of the dataset and the results cache')
+    parser.add_argument('--knn-k', default=200, type=int, help='neighbours of the kNN')
+    parser.add_argument('--knn-t', default=0.07, type=float, help='kNN similarity temperature')
+    parser.add_argument('--probe-epochs', default=50, type=int)
+    parser.add_argument('--probe-lr', default=0.1, type=float)
+    parser.add_argument('--probe-wd', default=0., type=float)
+    parser.add_argument('-b', '--batch-size', default=256, type=int)
+    parser.add_argument('--jobs', default=0, type=int,
+                        help='evaluations run in parallel (default: all cores / --threads)')
+    parser.add_argument('--threads', default=4, type=int, help='cores of each evaluation')
+    parser.add_argument('--device', default='cpu',
+                        help='cpu, or cuda for one GPU per job (round robin)')
+    parser.add_argument('--out', default='', help='write the table as JSON here')
+    return parser
+
+
+def discover(directory, run):
+    """{epoch: path} of the epoch checkpoints of `run`."""
+    pattern = re.compile(r'checkpoint_{}_(\d+)\.pth\.tar$'.format(re.escape(run)))
+    found = {}
+    for path in glob.glob(os.path.join(glob.escape(directory), 'checkpoint_*.pth.tar')):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            found[int(match.group(1))] = path
+    return dict(sorted(found.items()))
+
+
+def file_hash(path, hashes):
+    """sha256 of a file, reused from `hashes` while its size and mtime are unchanged."""
+    stat = os.stat(path)
+    entry = hashes.get(path)
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime]:
+        return entry[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 22), b''):
+            digest.update(chunk)
+    hashes[path] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def settings_key(args):
+    """The settings that change an evaluation result."""
+    keys = ('arch', 'dataset', 'dataset_dir', 'image_size', 'knn_k', 'knn_t', 'probe_epochs',
+            'probe_lr', 'probe_wd', 'batch_size')
+    return json.dumps({k: getattr(args, k) for k in keys}, sort_keys=True)
+
+
+def load_cache(path):
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'hashes': {}, 'results': {}}
+
+
+def save_cache(cache, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def center_crop(args):
+    return transforms.Compose([
+        transforms.Resize(args.image_size * 8 // 7),
+        transforms.CenterCrop(args.image_size),
+    ])
+
+
+def build_caches(args):
+    """Paths of the uint8 caches of the train and val sets, built if needed."""
+    to_tensor = transforms.PILToTensor()
+    if args.dataset == 'cifar100':
+        splits = {
+            'train': CIFAR100(args.dataset_dir, train=True, transform=to_tensor),
+            'val': CIFAR100(args.dataset_dir, train=False, transform=to_tensor),
+        }
+        name = 'cifar100_{}.pth'
+    else:
+        crop = transforms.Compose([center_crop(args), to_tensor])
+        splits = {
+            split: datasets.ImageFolder(os.path.join(args.dataset_dir, split), crop)
+            for split in ('train', 'val')
+        }
+        name = 'folder_{}_' + str(args.image_size) + '.pth'
+    paths = []
+    for split, dataset in splits.items():
+        path = os.path.join(args.cache_dir, name.format(split))
+        load_eval_cache(path, dataset, batch_size=args.batch_size)
+        paths.append(path)
+    return paths
+
+
+def load_backbone(path, arch):
+    """encoder_q of a MoCo / HyperMoCo checkpoint, without its embedding head."""
+    model = models.__dict__[arch]()
+    model.fc = nn.Identity()
+    state_dict = torch.load(path, map_location='cpu')['state_dict']
+    backbone = {}
+    for k, v in state_dict.items():
+        k = k[len('module.'):] if k.startswith('module.') else k
+        if k.startswith('encoder_q.') and not k.startswith('encoder_q.fc.'):
+            backbone[k[len('encoder_q.'):]] = v
+    model.load_state_dict(backbone)
+    return model.eval()
+
+
+@torch.no_grad()
+def extract(model, cache, args, device):
+    """Features and labels of a uint8 image cache."""
+    dataset = CachedEvalDataset(cache)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+    crop = center_crop(args)
+    mean = torch.tensor(MEAN, device=device).view(-1, 1, 1)
+    std = torch.tensor(STD, device=device).view(-1, 1, 1)
+    features, labels = [], []
+    for image, label, *_ in loader:
+        image = image.to(device).float().div_(255)
+        if args.dataset == 'cifar100':
+            image = crop(image)
+        else:  # as in main_lincls, only RP2k images are normalized
+            image = image.sub_(mean).div_(std)
+        features.append(model(image).float().cpu())
+        labels.append(label)
+    return torch.cat(features), torch.cat(labels)
+
+
+@torch.no_grad()
+def knn(train_x, train_y, val_x, val_y, k, t, chunk=1024):
+    """Top-1 / top-5 accuracy of a similarity-weighted kNN on L2-normalized features."""
+    train_x = nn.functional.normalize(train_x, dim=1)
+    val_x = nn.functional.normalize(val_x, dim=1)
+    num_classes = int(train_y.max()) + 1
+    hits = torch.zeros(2)
+    for start in range(0, val_x.size(0), chunk):
+        sim, idx = (val_x[start:start + chunk] @ train_x.t()).topk(min(k, train_x.size(0)), dim=1)
+        votes = torch.zeros(sim.size(0), num_classes).scatter_add_(1, train_y[idx],
+                                                                   (sim / t).exp())
+        hits += topk_hits(votes, val_y[start:start + chunk])
+    return (hits * 100. / val_x.size(0)).tolist()
+
+
+def topk_hits(output, target, topk=(1, 5)):
+    pred = output.topk(min(max(topk), output.size(1)), dim=1)[1]
+    correct = pred.eq(target.view(-1, 1))
+    return torch.stack([correct[:, :k].any(1).sum() for k in topk]).float()
+
+
+def linear_probe(train_x, train_y, val_x, val_y, args, device):
+    """Top-1 / top-5 accuracy of a softmax classifier trained on frozen features."""
+    mean, std = train_x.mean(0), train_x.std(0).clamp_min(1e-6)
+    train_x, val_x = (train_x - mean) / std, (val_x - mean) / std
+    train_x, train_y = train_x.to(device), train_y.to(device)
+    fc = nn.Linear(train_x.size(1), int(train_y.max()) + 1).to(device)
+    optimizer = torch.optim.SGD(fc.parameters(), args.probe_lr, momentum=0.9,
+                                weight_decay=args.probe_wd)
+    steps = args.probe_epochs * math.ceil(train_x.size(0) / args.batch_size)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, steps)
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(args.probe_epochs):
+        for idx in torch.randperm(train_x.size(0), generator=generator).split(args.batch_size):
+            idx = idx.to(device)
+            loss = nn.functional.cross_entropy(fc(train_x[idx]), train_y[idx])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+    with torch.no_grad():
+        hits = topk_hits(fc(val_x.to(device)).cpu(), val_y)
+    return (hits * 100. / val_x.size(0)).tolist()
+
+
+def init_worker(groups, device):
+    """Pins this pool process to the next free core group (and GPU)."""
+    index, cores = groups.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    if device == 'cuda':
+        device = 'cuda:{}'.format(index % torch.cuda.device_count())
+    global worker_device
+    worker_device = torch.device(device)
+
+
+def evaluate(task):
+    epoch, path, key, caches, args = task
+    start = time.time()
+    model = load_backbone(path, args.arch).to(worker_device)
+    train_x, train_y = extract(model, caches[0], args, worker_device)
+    val_x, val_y = extract(model, caches[1], args, worker_device)
+    knn1, knn5 = knn(train_x, train_y, val_x, val_y, args.knn_k, args.knn_t)
+    probe1, probe5 = linear_probe(train_x, train_y, val_x, val_y, args, worker_device)
+    result = {
+        'knn_acc1': knn1,
+        'knn_acc5': knn5,
+        'probe_acc1': probe1,
+        'probe_acc5': probe5,
+        'seconds': time.time() - start,
+    }
+    return epoch, key, result
+
+
+def core_groups(jobs, threads, tasks):
+    """Disjoint groups of the usable cores, one per pool process."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(
+        range(os.cpu_count()))
+    jobs = min(jobs or max(1, len(cores) // threads), tasks)
+    size = max(1, len(cores) // jobs)
+    return [cores[i * size:(i + 1) * size] or cores for i in range(jobs)]
+
+
+def report(rows):
+    print('{:>6} {:>9} {:>9} {:>9} {:>9}  {}'.format('epoch', 'kNN@1', 'kNN@5', 'probe@1',
+                                                    'probe@5', 'checkpoint'))
+    for row in rows:
+        print('{:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}'.format(
+            row['epoch'], row['knn_acc1'], row['knn_acc5'], row['probe_acc1'],
+            row['probe_acc5'], os.path.basename(row['checkpoint'])))
+
+
+def main():
+    args = parser().parse_args()
+    checkpoints = discover(args.dir, args.run)
+    if not checkpoints:
+        raise SystemExit("no checkpoint_{}_<epoch>.pth.tar in '{}'".format(args.run, args.dir))
+    os.makedirs(args.cache_dir, exist_ok=True)
+    cache_path = os.path.join(args.cache_dir, 'results.json')
+    cache = load_cache(cache_path)
+    settings = settings_key(args)
+    keys = {}
+    for epoch, path in checkpoints.items():
+        keys[epoch] = hashlib.sha256(
+            (file_hash(path, cache['hashes']) + settings).encode()).hexdigest()
+    todo = [epoch for epoch in checkpoints if keys[epoch] not in cache['results']]
+    print('=> {} checkpoints of run {!r}, {} cached, {} to evaluate'.format(
+        len(checkpoints), args.run, len(checkpoints) - len(todo), len(todo)))
+
+    if todo:
+        caches = build_caches(args)
+        groups = core_groups(args.jobs, args.threads, len(todo))
+        context = mp.get_context('spawn')
+        queue = context.Queue()
+        for group in enumerate(groups):
+            queue.put(group)
+        print('=> {} workers on cores {}'.format(len(groups), groups))
+        tasks = [(epoch, checkpoints[epoch], keys[epoch], caches, args) for epoch in todo]
+        with context.Pool(len(groups), init_worker, (queue, args.device)) as pool:
+            for epoch, key, result in pool.imap_unordered(evaluate, tasks):
+                cache['results'][key] = result
+                save_cache(cache, cache_path)
+                print('=> epoch {}: kNN@1 {:.2f} probe@1 {:.2f} ({:.0f}s)'.format(
+                    epoch, result['knn_acc1'], result['probe_acc1'], result['seconds']))
+    save_cache(cache, cache_path)
+
+    rows = [dict(epoch=epoch, checkpoint=path, **cache['results'][keys[epoch]])
+            for epoch, path in checkpoints.items()]
+    report(rows)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
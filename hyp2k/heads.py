@@ -0,0 +1,25 @@
+import torch
+import torch.nn as nn
+
+
+class MultiHeadLinear(nn.Module):
+    """
+    `num_heads` independent linear classifiers on the same features, for sweeping
+    linear evaluation hyper-parameters in one pass over the data. The heads are
+    separate modules, so each can have its own optimizer parameter group, and are
+    evaluated together as one matmul. Returns N x num_heads x out_features logits.
+    """
+
+    def __init__(self, in_features, out_features, num_heads):
+        super(MultiHeadLinear, self).__init__()
+        self.out_features = out_features
+        self.heads = nn.ModuleList(nn.Linear(in_features, out_features) for _ in range(num_heads))
+        for head in self.heads:
+            head.weight.data.normal_(mean=0.0, std=0.01)
+            head.bias.data.zero_()
+
+    def forward(self, x):
+        weight = torch.cat([head.weight for head in self.heads])
+        bias = torch.cat([head.bias for head in self.heads])
+        return nn.functional.linear(x, weight, bias).view(x.size(0), len(self.heads),
+                                                          self.out_features)
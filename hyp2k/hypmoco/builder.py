@@ -1,9 +1,16 @@
-from hyptorch.nn import HyperbolicMLR, ToPoincare, HypLinear
+import math
+
 from hyptorch import pmath
 import torch
 from torch import nn
 
-from IPython import embed
+from .poincare import Curvature, ToPoincare, conformal_factor, dist_matrix, mobius_dist_matrix
+from ..moco.batchnorm import KeySyncBatchNorm, SplitBatchNorm, convert_batchnorm
+from ..moco.comm import CommScheduler
+from ..moco.queue import KeyQueue, upgrade_queue_state_dict
+from ..moco.sharded import num_shards, sharded_negatives
+from ..profiling import phase
+from ..runtime import compile_batch_dynamic
 
 
 class HyperMoCo(nn.Module):
@@ -18,14 +25,42 @@ class HyperMoCo(nn.Module):
                  c=1.0,
                  train_c=False,
                  train_x=False,
-                 riemannian=False) -> None:
+                 riemannian=False,
+                 normalize=True,
+                 negative_distance=False,
+                 queue_radius=1.0,
+                 queue_dtype=torch.float32,
+                 shuffle_bn='shuffle',
+                 bn_splits=8,
+                 fused_loss=False,
+                 neg_mode='all',
+                 neg_count=4096,
+                 neg_tail=1024,
+                 shard_queue=False) -> None:
         super(HyperMoCo, self).__init__()
 
         self.K = K
         self.m = m
         self.T = T
+        self.fused_loss = fused_loss
+        # negatives scored per query: the whole queue, or a subset of neg_count entries,
+        # see _negative_logits
+        assert neg_mode in ('all', 'sample', 'hard'), neg_mode
+        self.neg_mode = neg_mode
+        self.neg_count = neg_count
+        self.neg_tail = neg_tail
+        # K / world_size entries per process, see MoCo
+        assert fused_loss or not shard_queue, 'a sharded queue needs the fused loss'
+        assert neg_mode == 'all' or not shard_queue, 'a sharded queue scores all negatives'
+        self.shard_queue = shard_queue
         self.hyp = hyper
-        self.c = c
+        # the objective: features L2-normalized (for the ball too, as they always were),
+        # logits the Poincare distances or, with negative_distance, minus them, and the
+        # norm of the initial queue entries
+        self.normalize = normalize
+        self.negative_distance = negative_distance
+        # one curvature for both heads (and the queue), optionally learnt
+        self.curvature = Curvature(c, learnable=train_c)
         # create the encoders
         # num_classes is the output fc dimension
         self.encoder_q = base_encoder(num_classes=embedding_dim)
@@ -37,194 +72,297 @@ class HyperMoCo(nn.Module):
                 nn.Linear(dim_mlp_in, dim_mlp_in),
                 nn.ReLU(),
                 self.encoder_q.fc,
-                ToPoincare(c,
-                           train_c,
-                           train_x,
-                           embedding_dim,
-                           riemannian=riemannian),
-                # HypLinear(embedding_dim, embedding_dim, c),
+                ToPoincare(self.curvature, train_x, embedding_dim, riemannian=riemannian),
             )
             self.encoder_k.fc = nn.Sequential(
                 nn.Linear(dim_mlp_in, dim_mlp_in),
                 nn.ReLU(),
                 self.encoder_k.fc,
-                ToPoincare(c,
-                           train_c,
-                           train_x,
-                           embedding_dim,
-                           riemannian=riemannian),
-                # HypLinear(embedding_dim, embedding_dim, c),
+                ToPoincare(self.curvature, train_x, embedding_dim, riemannian=riemannian),
             )
         elif hyper:
             self.encoder_q.fc = nn.Sequential(
                 self.encoder_q.fc,
-                ToPoincare(c,
-                           train_c,
-                           train_x,
-                           embedding_dim,
-                           riemannian=riemannian),
-                # HypLinear(embedding_dim, embedding_dim, c),
+                ToPoincare(self.curvature, train_x, embedding_dim, riemannian=riemannian),
             )
             self.encoder_k.fc = nn.Sequential(
                 self.encoder_k.fc,
-                ToPoincare(c,
-                           train_c,
-                           train_x,
-                           embedding_dim,
-                           riemannian=riemannian),
-                # HypLinear(embedding_dim, embedding_dim, c),
+                ToPoincare(self.curvature, train_x, embedding_dim, riemannian=riemannian),
             )
 
+        # BN of the key encoder: shuffled across processes (see forward), synchronized
+        # across them, or split into groups within this process
+        assert shuffle_bn in ('shuffle', 'sync', 'split'), shuffle_bn
+        self.shuffle_bn = shuffle_bn
+        if shuffle_bn == 'sync':
+            self.encoder_k = convert_batchnorm(self.encoder_k, KeySyncBatchNorm)
+        elif shuffle_bn == 'split':
+            self.encoder_k = convert_batchnorm(self.encoder_k, SplitBatchNorm, num_splits=bn_splits)
+
         for param_q, param_k in zip(self.encoder_q.parameters(),
                                     self.encoder_k.parameters()):
             param_k.data.copy_(param_q.data)  # initialize
             param_k.requires_grad = False  # not update by gradient
 
         # create the queue
-        self.register_buffer("queue", torch.randn(embedding_dim, K))
-        self.queue = nn.functional.normalize(self.queue, dim=0)
+        self.queue = KeyQueue(embedding_dim,
+                              K // num_shards() if shard_queue else K,
+                              radius=queue_radius if hyper else 1.0,
+                              dtype=queue_dtype)
+        self._register_load_state_dict_pre_hook(upgrade_queue_state_dict)
 
-        self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
+        # batch shuffle and key gathering across processes
+        self.comm = CommScheduler()
 
-    @torch.no_grad()
-    def _momentum_update_key_encoder(self):
+    def encode_q(self, im):
         """
-        Momentum update of the key encoder
+        Query features: encoder (including the Poincare head) and normalization.
+        Without normalize, the points of the ball are left as is, as normalizing
+        puts them on (or outside) its boundary.
         """
-        for param_q, param_k in zip(self.encoder_q.parameters(),
-                                    self.encoder_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-
-    @torch.no_grad()
-    def _dequeue_and_enqueue(self, keys):
-        # gather keys before updating queue
-        keys = concat_all_gather(keys)
-
-        batch_size = keys.shape[0]
+        q = self.encoder_q(im)
+        return nn.functional.normalize(q, dim=1) if self.normalize or not self.hyp else q
 
-        ptr = int(self.queue_ptr)
-        assert self.K % batch_size == 0  # for simplicity
+    def encode_k(self, im):
+        """
+        Key features, see encode_q
+        """
+        k = self.encoder_k(im)
+        return nn.functional.normalize(k, dim=1) if self.normalize or not self.hyp else k
 
-        # replace the keys at ptr (dequeue and enqueue)
-        self.queue[:, ptr:ptr + batch_size] = keys.T
-        ptr = (ptr + batch_size) % self.K  # move pointer
+    def _queue_lambda(self, c):
+        """
+        Conformal factors of the queue entries for curvature c, None for normalized
+        features (see _similarity)
+        """
+        if self.normalize:
+            return None
+        if torch.is_tensor(c) and c.requires_grad:
+            # learnt curvature: O(K) from the cached norms, inside the graph
+            return conformal_factor(self.queue.norm2, c)
+        return self.queue.stat(lambda norm2: conformal_factor(norm2, c), self.curvature.version())
+
+    def _similarity(self, q, xy, norm2, lam, c):
+        """
+        Logits of queries q against entries with inner products xy, squared norms norm2
+        and conformal factors lam: Poincare distances (negated with negative_distance),
+        or xy itself. Normalized features lie on the boundary of the c = 1 ball, where
+        only hyptorch's damped distance is finite.
+        """
+        if not self.hyp:
+            return xy
+        if self.normalize:
+            d = mobius_dist_matrix(q, c, xy, norm2)
+            return -d if self.negative_distance else d
+        d = dist_matrix(q, None, c, y_norm2=norm2, y_lambda=lam, xy=xy)
+        # entries outside the ball of the current curvature (see conformal_factor) are
+        # left out of the negatives until the queue replaces them
+        return (-d if self.negative_distance else d).masked_fill(lam == 0, float('-inf'))
+
+    def _negative_logits(self, q, c, l_pos):
+        """
+        Negative logits of the queries, and the ranks of their positives l_pos among
+        the unshifted negatives when some are shifted (else None).
+
+        - all: every queue entry, NxK.
+        - sample: neg_count entries drawn uniformly (the same for every query), shifted
+          by T * log(K / neg_count) so that their softmax mass estimates the whole
+          queue's.
+        - hard: the neg_count highest scoring entries of each query (the nearest ones
+          with negative_distance), scored exactly, followed by neg_tail uniformly
+          drawn entries that stand in for the rest of the queue (shifted by
+          T * log(K / neg_tail), the hard ones among them masked out). The candidates
+          come from the queue inner products: on the ball the distance to a key only
+          depends on (|q|^2 + |k|^2 - 2 q.k) * lambda_k, so the prefilter ranks
+          exactly and the costly part (arcosh and its backward) only runs on the
+          candidates.
+
+        Contrastive accuracy is measured among the scored negatives, before the shift,
+        which only enters the loss. For hard it matches the whole queue's up to top
+        neg_count; for sample it is among neg_count entries only (logged as such by
+        main_moco).
+        """
+        K, M = self.queue.K, self.neg_count
+        lam = self._queue_lambda(c) if self.hyp else None
+        if self.neg_mode == 'all' or M >= K:
+            return self._similarity(q, self.queue.mm(q), self.queue.norm2, lam, c), None
+
+        if self.neg_mode == 'sample':
+            idx = torch.randperm(K, device=q.device)[:M]
+            l_neg = self._similarity(q, torch.mm(q, self.queue.rows(idx).t()),
+                                     self.queue.norm2[idx],
+                                     lam[idx] if lam is not None else None, c)
+            return l_neg + self.T * math.log(K / M), self._rank(l_pos, l_neg)
+
+        xy = self.queue.mm(q)
+        with torch.no_grad():
+            if self.hyp:
+                # increasing with the distance
+                if self.normalize:
+                    score = mobius_dist_matrix(q, c, xy, self.queue.norm2)
+                else:
+                    score = (q.pow(2).sum(1, keepdim=True) + self.queue.norm2 - 2 * xy) * lam
+                    # never candidates, see _similarity
+                    score.masked_fill_(lam == 0,
+                                       float('inf') if self.negative_distance else float('-inf'))
+                idx = score.topk(M, dim=1, largest=not self.negative_distance)[1]
+            else:
+                idx = xy.topk(M, dim=1)[1]
+        l_neg = self._similarity(q, xy.gather(1, idx), self.queue.norm2[idx],
+                                 lam[idx] if lam is not None else None, c)
+        if not self.neg_tail:
+            return l_neg, None
+        tail = torch.randperm(K, device=q.device)[:self.neg_tail]
+        l_tail = self._similarity(q, xy[:, tail], self.queue.norm2[tail],
+                                  lam[tail] if lam is not None else None, c)
+        hard = torch.zeros_like(xy, dtype=torch.bool).scatter_(1, idx, True)[:, tail]
+        l_tail = l_tail.masked_fill(hard, float('-inf'))
+        rank = self._rank(l_pos, l_neg, l_tail)
+        return torch.cat([l_neg, l_tail + self.T * math.log(K / self.neg_tail)], dim=1), rank
+
+    @staticmethod
+    @torch.no_grad()
+    def _rank(l_pos, *l_negs):
+        """Negatives scoring above each positive, see InfoNCELoss"""
+        return sum((l_neg > l_pos).sum(1) for l_neg in l_negs)
 
-        self.queue_ptr[0] = ptr
+    def _encode_extra(self, views):
+        """
+        Query features of a list of extra views, one encoder pass per resolution
+        """
+        groups = {}
+        for i, view in enumerate(views):
+            groups.setdefault(tuple(view.shape[-2:]), []).append(i)
+        q = [None] * len(views)
+        for idx in groups.values():
+            out = self.encode_q(torch.cat([views[i] for i in idx]))
+            for i, q_i in zip(idx, out.split([views[i].size(0) for i in idx])):
+                q[i] = q_i
+        return q
+
+    def compile_encoders(self, **kwargs):
+        """
+        Replace encode_q / encode_k with torch.compile'd versions. The state dict is
+        unchanged, and a smaller last batch reuses the compiled graphs.
+        """
+        self.encode_q = compile_batch_dynamic(self.encode_q, **kwargs)
+        self.encode_k = compile_batch_dynamic(self.encode_k, **kwargs)
 
     @torch.no_grad()
-    def _batch_shuffle_ddp(self, x):
+    def _momentum_update_key_encoder(self):
         """
-        Batch shuffle, for making use of BatchNorm.
-        *** Only support DistributedDataParallel (DDP) model. ***
+        Momentum update of the key encoder
         """
-        # gather from all gpus
-        batch_size_this = x.shape[0]
-        x_gather = concat_all_gather(x)
-        batch_size_all = x_gather.shape[0]
-
-        num_gpus = batch_size_all // batch_size_this
-
-        # random shuffle index
-        idx_shuffle = torch.randperm(batch_size_all).cuda()
-
-        # broadcast to all gpus
-        torch.distributed.broadcast(idx_shuffle, src=0)
-
-        # index for restoring
-        idx_unshuffle = torch.argsort(idx_shuffle)
-
-        # shuffled index for this gpu
-        gpu_idx = torch.distributed.get_rank()
-        idx_this = idx_shuffle.view(num_gpus, -1)[gpu_idx]
-
-        return x_gather[idx_this], idx_unshuffle
+        for param_q, param_k in zip(self.encoder_q.parameters(),
+                                    self.encoder_k.parameters()):
+            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
 
     @torch.no_grad()
-    def _batch_unshuffle_ddp(self, x, idx_unshuffle):
+    def _dequeue_and_enqueue(self, keys):
         """
-        Undo batch shuffle.
-        *** Only support DistributedDataParallel (DDP) model. ***
+        keys: the keys of all processes, see CommScheduler.gather_keys
         """
-        # gather from all gpus
-        batch_size_this = x.shape[0]
-        x_gather = concat_all_gather(x)
-        batch_size_all = x_gather.shape[0]
-
-        num_gpus = batch_size_all // batch_size_this
+        self.queue.push(keys)
 
-        # restored index for this gpu
-        gpu_idx = torch.distributed.get_rank()
-        idx_this = idx_unshuffle.view(num_gpus, -1)[gpu_idx]
-
-        return x_gather[idx_this]
-
-    def forward(self, im_q, im_k):
+    def forward(self, im_q, im_k, im_extra=None):
         """
         Input:
             im_q: a batch of query images
             im_k: a batch of key images
+            im_extra: optional list of batches of further (e.g. small) views, used as
+                      queries only and scored against the same keys and queue
         Output:
-            logits, targets
+            logits, targets (the rows of im_q first, then those of each extra view),
+            or unscaled l_pos (Nx1) and l_neg (NxK) with fused_loss,
+            or l_pos, l_neg (Nx1) and rank with shard_queue, see sharded_negatives;
+            with the shifted negatives of neg_mode sample/hard, the ranks of the positives
+            among the unshifted ones follow (for accuracy, see _negative_logits)
         """
 
-        # compute query features
-        q = self.encoder_q(im_q)  # queries: NxC
-        q = nn.functional.normalize(q, dim=1)
-
         # compute key features
         with torch.no_grad():  # no gradient to keys
-            self._momentum_update_key_encoder()  # update the key encoder
+            # shuffle for making use of BN, exchanged during the momentum update
+            if self.shuffle_bn == 'shuffle':
+                with phase('moco/batch_shuffle'):
+                    shuffled = self.comm.shuffle(im_k)
 
-            # shuffle for making use of BN
-            im_k, idx_unshuffle = self._batch_shuffle_ddp(im_k)
+            with phase('moco/momentum_update'):
+                self._momentum_update_key_encoder()  # update the key encoder
 
-            k = self.encoder_k(im_k)  # keys: NxC
-            k = nn.functional.normalize(k, dim=1)
+            with phase('moco/batch_shuffle'):
+                if self.shuffle_bn == 'shuffle':
+                    im_k = shuffled.wait()
+                elif self.shuffle_bn == 'split':
+                    # random BN groups within this process
+                    idx_shuffle = torch.randperm(im_k.size(0), device=im_k.device)
+                    im_k = im_k[idx_shuffle]
 
-            # undo shuffle
-            k = self._batch_unshuffle_ddp(k, idx_unshuffle)
+            with phase('moco/encode_k'):
+                k = self.encode_k(im_k)  # keys: NxC
 
-        # compute logits
-        # Einstein sum is more intuitive
-        # positive logits: Nx1
-        if self.hyp:
-            l_pos = pmath.dist(q, k, c=self.c).unsqueeze(-1)
-            l_neg = pmath.dist_matrix(q, self.queue.clone().detach().T, c=self.c)
-        else:
-            l_pos = torch.einsum('nc,nc->n', [q, k]).unsqueeze(-1)
-            l_neg = torch.einsum('nc,ck->nk', [q, self.queue.clone().detach()])
+            if self.shuffle_bn == 'split':
+                k = k[torch.argsort(idx_shuffle)]
 
-        # negative logits: NxK
+            # gathered during the query forward (and unshuffled)
+            with phase('moco/all_gather'):
+                gathered = self.comm.gather_keys(k, shuffled=self.shuffle_bn == 'shuffle')
 
-        # print(f"{q.shape}, {k.shape}, {self.queue.shape}, {l_pos.shape}, {l_neg.shape}")
+        # compute query features
+        with phase('moco/encode_q'):
+            q = self.encode_q(im_q)  # queries: NxC
+            if im_extra:
+                q = torch.cat([q] + self._encode_extra(im_extra))  # (1+M)NxC
 
-        # logits: Nx(1+K)
-        logits = torch.cat([l_pos, l_neg], dim=1)
+        with phase('moco/all_gather'):
+            k, keys = gathered.wait()
+        k_pos = k.repeat(q.size(0) // k.size(0), 1) if q.size(0) != k.size(0) else k
 
-        # apply temperature
-        logits = logits / self.T
+        # compute logits
+        with phase('moco/logits'):
+            # positive logits: Nx1, negative logits: NxK (or fewer, see neg_mode)
+            self.queue.flush()
+            if self.hyp:
+                # logits are distances on the ball, see _similarity
+                c = self.curvature()
+                l_pos = pmath.dist(q, k_pos, c=c).unsqueeze(-1)
+                if self.negative_distance:
+                    l_pos = -l_pos
+            else:
+                c = None
+                l_pos = torch.einsum('nc,nc->n', [q, k_pos]).unsqueeze(-1)
+            if self.shard_queue:
+                lam = self._queue_lambda(c) if self.hyp else None
+                l_neg, rank = sharded_negatives(
+                    q, l_pos, lambda x: self._similarity(x, self.queue.mm(x), self.queue.norm2,
+                                                         lam, c), self.T)
+            else:
+                l_neg, rank = self._negative_logits(q, c, l_pos)
+
+            # print(f"{q.shape}, {k.shape}, {self.queue.shape}, {l_pos.shape}, {l_neg.shape}")
+
+        if self.shard_queue:
+            with phase('moco/enqueue'):
+                # every shard takes the keys of its own process
+                self._dequeue_and_enqueue(k)
+            return l_pos, l_neg, rank
+
+        if self.fused_loss:
+            with phase('moco/enqueue'):
+                self._dequeue_and_enqueue(keys)
+            return (l_pos, l_neg) if rank is None else (l_pos, l_neg, rank)
+
+        with phase('moco/logits'):
+            # logits: Nx(1+K)
+            logits = torch.cat([l_pos, l_neg], dim=1)
+
+            # apply temperature
+            logits /= self.T
 
         # labels: positive key indicators
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).cuda()
+        labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
 
         # dequeue and enqueue
-        self._dequeue_and_enqueue(k)
-
-        return logits, labels
-
-
-# utils
-@torch.no_grad()
-def concat_all_gather(tensor):
-    """
-    Performs all_gather operation on the provided tensors.
-    *** Warning ***: torch.distributed.all_gather has no gradient.
-    """
-    tensors_gather = [
-        torch.ones_like(tensor)
-        for _ in range(torch.distributed.get_world_size())
-    ]
-    torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
-
-    output = torch.cat(tensors_gather, dim=0)
-    return output
+        with phase('moco/enqueue'):
+            self._dequeue_and_enqueue(keys)
+
+        return (logits, labels) if rank is None else (logits, labels, rank)
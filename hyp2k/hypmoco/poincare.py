@@ -0,0 +1,148 @@
+import math
+
+import torch
+from torch import nn
+from hyptorch import pmath
+
+
+class Curvature(nn.Module):
+    """
+    Curvature c of the Poincare ball, shared by the query and key heads.
+    A learnable curvature is stored as log(c) so that it stays positive, and kept
+    within a factor `span` of its initial value by clamp_.
+    """
+
+    def __init__(self, c=1.0, learnable=False, span=100.):
+        super(Curvature, self).__init__()
+        self.learnable = learnable
+        if learnable:
+            self.log_c = nn.Parameter(torch.tensor(math.log(c)))
+            self.log_bounds = (math.log(c / span), math.log(c * span))
+        else:
+            self.value = float(c)
+
+    def forward(self):
+        return self.log_c.exp() if self.learnable else self.value
+
+    @torch.no_grad()
+    def clamp_(self):
+        """Brings a learnt log_c back within its bounds, after an optimizer step"""
+        if self.learnable:
+            self.log_c.clamp_(*self.log_bounds)
+
+    def version(self):
+        """Changes whenever c does; the optimizer updates log_c in place."""
+        return self.log_c._version if self.learnable else self.value
+
+    def extra_repr(self):
+        return 'learnable=True' if self.learnable else 'c={}'.format(self.value)
+
+
+class RiemannianGradient(torch.autograd.Function):
+    """
+    Identity whose backward rescales the Euclidean gradient to the Riemannian one of
+    the ball, ((1 - c||x||^2) / 2)^2. Unlike hyptorch's version c is an argument, not
+    a class attribute, so every head can use its (possibly learnt) curvature.
+    """
+
+    @staticmethod
+    def forward(ctx, x, c):
+        ctx.save_for_backward(x, torch.as_tensor(c, dtype=x.dtype, device=x.device).detach())
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, c = ctx.saved_tensors
+        scale = (1 - c * x.pow(2).sum(-1, keepdim=True)).pow(2) / 4
+        return grad_output * scale, None
+
+
+class ToPoincare(nn.Module):
+    """
+    Maps Euclidean features onto the Poincare ball of a shared Curvature, through the
+    exponential map at the origin (or at a learnt point with train_x).
+    """
+
+    def __init__(self, curvature, train_x=False, ball_dim=None, riemannian=True):
+        super(ToPoincare, self).__init__()
+        # kept out of the submodules: the curvature belongs to the model, and
+        # registering it here would let the key encoder's momentum update overwrite it
+        object.__setattr__(self, 'curvature', curvature)
+        if train_x:
+            self.xp = nn.Parameter(torch.zeros((ball_dim,)))
+        else:
+            self.register_parameter("xp", None)
+        self.riemannian = riemannian
+
+    def forward(self, x):
+        c = self.curvature()
+        if self.xp is not None:
+            xp = pmath.project(pmath.expmap0(self.xp, c=c), c=c)
+            x = pmath.expmap(xp, x, c=c)
+        else:
+            x = pmath.expmap0(x, c=c)
+        x = pmath.project(x, c=c)
+        if self.riemannian:
+            x = RiemannianGradient.apply(x, c)
+        return x
+
+
+def conformal_factor(norm2, c):
+    """
+    lambda_x = 2 / (1 - c||x||^2) from precomputed squared norms, and 0 for the points
+    outside the ball (c||x||^2 >= 1), which have none: e.g. queue entries written
+    under a smaller learnt curvature. dist_matrix puts them infinitely far.
+    """
+    gap = 1 - c * norm2
+    inside = gap > 0
+    return (2 / torch.where(inside, gap, torch.ones_like(gap))).masked_fill(~inside, 0)
+
+
+def dist_matrix(x, y, c, y_norm2=None, y_lambda=None, xy=None):
+    """
+    Poincare distance between every row of x (N x D) and of y (K x D):
+
+        d(x, y) = arcosh(1 + c/2 * lambda_x * lambda_y * ||x - y||^2) / sqrt(c)
+
+    ||x - y||^2 comes from one N x K matmul, so with the per-row statistics of y
+    given (squared norms, conformal factors) no N x K x D tensor is formed and y is
+    only read once. Equal to hyptorch's pmath.dist_matrix up to its 1e-5 damping;
+    points outside the ball (conformal factor 0) are infinitely far. The inner
+    products x @ y.T can be given as `xy` (then y may be None), e.g. from a queue
+    stored in reduced precision.
+    """
+    if y_norm2 is None:
+        y_norm2 = y.pow(2).sum(-1)
+    if y_lambda is None:
+        y_lambda = conformal_factor(y_norm2, c)
+    x_norm2 = x.pow(2).sum(-1, keepdim=True)
+    x_lambda = conformal_factor(x_norm2, c)
+
+    if xy is None:
+        sq_dist = torch.addmm(x_norm2 + y_norm2, x, y.t(), alpha=-2)
+    else:
+        sq_dist = (x_norm2 + y_norm2).sub_(xy, alpha=2)
+    sq_dist = sq_dist.clamp_min_(0)
+    # clamped away from 0, where the arcosh gradient is infinite
+    delta = (sq_dist * (x_lambda * (0.5 * c)) * y_lambda).clamp_min(1e-12)
+    # arcosh(1 + delta), written to stay accurate for small delta
+    d = torch.log1p(delta + torch.sqrt(delta * (delta + 2))) / c**0.5
+    return d.masked_fill((x_lambda == 0) | (y_lambda == 0), float('inf'))
+
+
+def mobius_dist_matrix(x, c, xy, y_norm2):
+    """
+    hyptorch's pmath.dist_matrix(x, y, c), damping included, from the inner products
+    xy = x @ y.T and the squared norms of y: the norm of the Mobius sum (-x) + y
+    expands into N x K terms, so no N x K x D tensor is formed. Unlike dist_matrix it
+    stays finite on the boundary of the ball, where L2-normalized features lie for
+    c = 1.
+    """
+    x_norm2 = x.pow(2).sum(-1, keepdim=True)
+    # (-x) + y = (a * -x + b * y) / denom
+    a = 1 - 2 * c * xy + c * y_norm2
+    b = 1 - c * x_norm2
+    num2 = a * a * x_norm2 - 2 * a * b * xy + b * b * y_norm2
+    denom = 1 - 2 * c * xy + c**2 * x_norm2 * y_norm2
+    norm = num2.clamp_min(1e-12).sqrt() / (denom + 1e-5).abs()
+    return 2 / c**0.5 * pmath.artanh(c**0.5 * norm)
@@ -0,0 +1,131 @@
+"""
+Starting the processes of main_moco and main_lincls, which call
+launch(main_worker, args):
+
+    # one process per GPU, or --nproc-per-node CPU processes on gloo
+    python -m hyp2k.main_moco --multiprocessing-distributed --world-size 1 --rank 0 \
+        --dist-url tcp://localhost:23456 [--nproc-per-node 4] ...
+    # torchrun, elastic: restarted workers continue from the latest checkpoint
+    torchrun --nnodes 1:4 --nproc-per-node 8 --max-restarts 3 --rdzv-backend c10d \
+        --rdzv-endpoint host:29400 -m hyp2k.main_moco --resume auto ...
+"""
+import glob
+import os
+import pickle
+import re
+
+import torch
+import torch.multiprocessing as mp
+
+
+def launched_by_torchrun():
+    return all(name in os.environ for name in ('LOCAL_RANK', 'RANK', 'WORLD_SIZE'))
+
+
+def usable_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def partition_threads(local_rank, nprocs, args):
+    """
+    Gives every process of a node its own share of the cores: --threads-per-proc
+    intra-op threads, by default the usable cores split evenly. CPU processes are
+    also pinned to their share, so their thread pools do not compete.
+    """
+    cores = usable_cores()
+    threads = args.threads_per_proc or max(1, len(cores) // nprocs)
+    torch.set_num_threads(threads)
+    if not torch.cuda.is_available() and hasattr(os, 'sched_setaffinity'):
+        share = cores[local_rank * threads:(local_rank + 1) * threads]
+        if len(share) == threads:
+            os.sched_setaffinity(0, share)
+    return threads
+
+
+def run_checkpoints(run_name, directory='.'):
+    """
+    The checkpoint_<run_name>_<epoch>.pth.tar and the mid-epoch
+    checkpoint_<run_name>_last.pth.tar, most recently written first.
+    """
+    pattern = re.compile(r'checkpoint_{}_(\d+|last)\.pth\.tar$'.format(re.escape(run_name)))
+    paths = [
+        path for path in glob.glob(os.path.join(directory, 'checkpoint_*.pth.tar'))
+        if pattern.match(os.path.basename(path))
+    ]
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def load_checkpoint(path, map_location=None, fallback=()):
+    """
+    torch.load of `path`, or, if that fails, of the first of the `fallback` paths
+    that loads (e.g. an epoch checkpoint when a mid-epoch one written by an older
+    version does not). Returns (path, checkpoint); raises the first error if none
+    loads.
+    """
+    error = None
+    for candidate in [path] + [p for p in fallback if p != path]:
+        try:
+            return candidate, torch.load(candidate, map_location=map_location)
+        except (RuntimeError, EOFError, OSError, pickle.UnpicklingError) as e:
+            print("=> cannot load checkpoint '{}': {}".format(candidate, str(e).splitlines()[0]))
+            error = error or e
+    raise error
+
+
+def _setup(local_rank, nprocs, gpu, args):
+    """Backend and threads of the process `local_rank` of a node; returns its GPU"""
+    args.local_rank = local_rank
+    args.resume_fallback = []
+    if args.resume == 'auto':
+        # checkpoints are saved atomically, so the newest one is complete; the older
+        # ones are tried in turn if it cannot be loaded, see load_checkpoint
+        args.resume_fallback = run_checkpoints(args.run_name)
+        args.resume = args.resume_fallback[0] if args.resume_fallback else ''
+        print('=> resuming from {}'.format(args.resume or 'scratch, no checkpoint found'))
+    if not torch.cuda.is_available():
+        if args.dist_backend == 'nccl':
+            args.dist_backend = 'gloo'
+        gpu = None
+    if nprocs > 1:
+        threads = partition_threads(local_rank, nprocs, args)
+        if local_rank == 0:
+            print('=> {} processes per node, {} threads each'.format(nprocs, threads))
+    return gpu
+
+
+def _spawned(local_rank, main_worker, nprocs, args):
+    main_worker(_setup(local_rank, nprocs, local_rank, args), nprocs, args)
+
+
+def launch(main_worker, args):
+    """
+    Runs main_worker(gpu, processes_per_node, args) in every process of the job,
+    with gpu None on CPU. Under torchrun, rank and world size come from its env://
+    variables and this process is the worker; with --multiprocessing-distributed
+    the workers of this node are spawned here, one per GPU or --nproc-per-node.
+    """
+    if launched_by_torchrun():
+        args.dist_url = 'env://'
+        args.world_size = int(os.environ['WORLD_SIZE'])
+        args.rank = int(os.environ['RANK'])
+        args.distributed = args.world_size > 1
+        # ranks are global already
+        args.multiprocessing_distributed = False
+        nprocs = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        local_rank = int(os.environ['LOCAL_RANK'])
+        main_worker(_setup(local_rank, nprocs, local_rank, args), nprocs, args)
+        return
+
+    if args.dist_url == 'env://' and args.world_size == -1:
+        args.world_size = int(os.environ['WORLD_SIZE'])
+    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
+    nprocs = args.nproc_per_node or max(torch.cuda.device_count(), 1)
+    if args.multiprocessing_distributed:
+        # Since we have nprocs processes per node, the total world_size
+        # needs to be adjusted accordingly
+        args.world_size = nprocs * args.world_size
+        mp.spawn(_spawned, nprocs=nprocs, args=(main_worker, nprocs, args))
+    else:
+        main_worker(_setup(0, 1, args.gpu, args), nprocs, args)
@@ -2,30 +2,37 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import argparse
 import builtins
+import itertools
 import os
 import random
 
 import shutil
 import time
 import warnings
-from IPython import embed
 import torch
 import torch.nn as nn
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 import torch.optim
-import torch.multiprocessing as mp
 import torch.utils.data
 import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
-import wandb
 
 from .cli import parse_args
+from .optim import build_optimizer
+from .launch import launch, load_checkpoint
+from .data.autotune import LoaderTuner, loader_cpus
 from .data.rp2k import RP2kDataset
 from .data.CIFAR100 import CIFAR100
+from .data.cache import load_eval_cache
+from .data.prefetch import DataPrefetcher
+from .data.sampler import DistributedEvalSampler
+from .heads import MultiHeadLinear
+from .metrics import FineCoarseAccuracy, MultiHeadAccuracy, reduction_device
+from .runtime import compile_forward, memory_format
 
 best_acc1 = 0
 train_step = 0
@@ -50,22 +57,8 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
-    if args.dist_url == "env://" and args.world_size == -1:
-        args.world_size = int(os.environ["WORLD_SIZE"])
-
-    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
-
-    ngpus_per_node = torch.cuda.device_count()
-    if args.multiprocessing_distributed:
-        # Since we have ngpus_per_node processes per node, the total world_size
-        # needs to be adjusted accordingly
-        args.world_size = ngpus_per_node * args.world_size
-        # Use torch.multiprocessing.spawn to launch distributed processes: the
-        # main_worker process function
-        mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args))
-    else:
-        # Simply call main_worker function
-        main_worker(args.gpu, ngpus_per_node, args)
+    # torchrun workers, spawned workers (one per GPU or --nproc-per-node), or this process
+    launch(main_worker, args)
 
 
 def main_worker(gpu, ngpus_per_node, args):
@@ -73,7 +66,7 @@ def main_worker(gpu, ngpus_per_node, args):
     args.gpu = gpu
 
     # suppress printing if not master
-    if args.multiprocessing_distributed and args.gpu != 0:
+    if args.distributed and args.local_rank != 0:
 
         def print_pass(*args):
             pass
@@ -89,7 +82,7 @@ def main_worker(gpu, ngpus_per_node, args):
         if args.multiprocessing_distributed:
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
-            args.rank = args.rank * ngpus_per_node + gpu
+            args.rank = args.rank * ngpus_per_node + args.local_rank
         dist.init_process_group(backend=args.dist_backend,
                                 init_method=args.dist_url,
                                 world_size=args.world_size,
@@ -107,6 +100,15 @@ def main_worker(gpu, ngpus_per_node, args):
     model.fc = torch.nn.Linear(in_features=2048, out_features=args.num_class, bias=True)
     model.fc.weight.data.normal_(mean=0.0, std=0.01)
     model.fc.bias.data.zero_()
+    # --sweep-lr / --sweep-wd: one head per (lr, weight decay), all trained on the same
+    # backbone forward
+    args.sweep = sweep_grid(args)
+    if args.sweep:
+        if args.require_grad != 'linear':
+            raise ValueError('a sweep needs --require_grad linear, its heads would otherwise '
+                             'train a shared backbone')
+        model.fc = MultiHeadLinear(model.fc.in_features, args.num_class, len(args.sweep))
+        print("=> sweeping {} linear heads (lr, wd): {}".format(len(args.sweep), args.sweep))
 
     # load from pre-trained, before DistributedDataParallel constructor
     if args.pretrained:
@@ -125,18 +127,35 @@ def main_worker(gpu, ngpus_per_node, args):
                 del state_dict[k]
 
             args.start_epoch = 0
+            if args.rp2k_permute is None:
+                # the RP2K images as the backbone was pretrained on
+                args.rp2k_permute = checkpoint.get('rp2k_permute')
             msg = model.load_state_dict(state_dict, strict=False)
-            assert set(msg.missing_keys) == {"fc.weight", "fc.bias"}
+            assert set(msg.missing_keys) == {k for k in model.state_dict() if k.startswith('fc.')}
 
             print("=> loaded pre-trained model '{}'".format(args.pretrained))
         else:
             print("=> no checkpoint found at '{}'".format(args.pretrained))
 
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if args.compile:
+        if not args.distributed and args.gpu is None:
+            # DataParallel replicas would keep calling the original module's forward
+            warnings.warn('--compile is not supported with DataParallel, running eagerly.')
+        else:
+            compile_forward(model)
+
     if args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
         # DistributedDataParallel will use all available devices.
-        if args.gpu is not None:
+        if not torch.cuda.is_available():
+            # gloo processes on CPU, each with its share of the batch and the cores
+            args.batch_size = int(args.batch_size / ngpus_per_node)
+            args.workers = int((args.workers + ngpus_per_node - 1) / ngpus_per_node)
+            model = torch.nn.parallel.DistributedDataParallel(model)
+        elif args.gpu is not None:
             torch.cuda.set_device(args.gpu)
             model.cuda(args.gpu)
             # When using a single GPU per process and per
@@ -169,26 +188,30 @@ def main_worker(gpu, ngpus_per_node, args):
     parameters = list(
         filter(lambda p: p.requires_grad and id(p) not in linear_params, model.parameters()))
     # assert len(parameters) == 2  # fc.weight, fc.bias
-    optimizer = torch.optim.SGD([{
+    if args.sweep:
+        # each head decays from its own learning rate, with its own weight decay
+        fc_groups = [{
+            'params': head.parameters(),
+            'lr': lr,
+            'sweep_lr': lr,
+            'weight_decay': wd
+        } for head, (lr, wd) in zip(model.module.fc.heads, args.sweep)]
+    else:
+        fc_groups = [{
+            'params': model.module.fc.parameters(),
+        }]
+    optimizer = build_optimizer([{
         'params': parameters,
         'lr': args.conv_lr
-    }, {
-        'params': model.module.fc.parameters(),
-    }],
-                                args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    }] + fc_groups, args)
 
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            if args.gpu is None:
-                checkpoint = torch.load(args.resume)
-            else:
-                # Map model to be loaded to specified single gpu.
-                loc = 'cuda:{}'.format(args.gpu)
-                checkpoint = torch.load(args.resume, map_location=loc)
+            # Map model to be loaded to specified single gpu.
+            loc = None if args.gpu is None else 'cuda:{}'.format(args.gpu)
+            args.resume, checkpoint = load_checkpoint(args.resume, loc, args.resume_fallback)
             args.start_epoch = checkpoint['epoch']
             best_acc1 = checkpoint['best_acc1']
             if args.gpu is not None:
@@ -215,6 +238,9 @@ def main_worker(gpu, ngpus_per_node, args):
     #         normalize,
     #     ]))
     if args.dataset == 'RP2k':
+        if args.rp2k_permute is None:  # transposed, as every run before the flag
+            args.rp2k_permute = 1
+        print('=> RP2K images {}'.format('transposed' if args.rp2k_permute else 'upright'))
         train_dataset = RP2kDataset(
             '/root/rp2k/data',
             'train',
@@ -223,33 +249,35 @@ def main_worker(gpu, ngpus_per_node, args):
             aug=[
                 transforms.RandomResizedCrop(224),
                 transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
+                transforms.PILToTensor(),  # uint8, normalized on device by the prefetcher
             ],
+            permute=bool(args.rp2k_permute),
         )  # For each class select up to 10 samples
         val_dataset = RP2kDataset(
             '/root/rp2k/data',
             'val',
             args,
             aug=[
-                transforms.RandomResizedCrop(224),
-                transforms.ToTensor(),
-                normalize,
+                transforms.Resize(256),
+                transforms.CenterCrop(224),
+                transforms.PILToTensor(),
             ],
+            permute=bool(args.rp2k_permute),
         )
     elif args.dataset == 'cifar100':
+        # uint8 images, converted on device by the prefetcher
         train_dataset = CIFAR100(
             args.dataset_dir,
             train=True,
             transform=transforms.Compose([
-                transforms.ToTensor(),
+                transforms.PILToTensor(),
             ]),
         )
         val_dataset = CIFAR100(
             args.dataset_dir,
             train=False,
             transform=transforms.Compose([
-                transforms.ToTensor(),
+                transforms.PILToTensor(),
             ]),
         )
 
@@ -257,38 +285,99 @@ def main_worker(gpu, ngpus_per_node, args):
         transforms.RandomResizedCrop(224),
         transforms.RandomHorizontalFlip(),
     ])
-    val_augmentation = transforms.Compose([
-        transforms.RandomResizedCrop(224),
-    ])
+    # evaluation is deterministic: resize + center crop, then normalize (on device,
+    # by the prefetcher) if the training pipeline does; RP2k crops arrive as uint8
+    if args.dataset == 'RP2k':
+        val_crop = transforms.Compose([])  # done per sample by the dataset
+        val_mean, val_std = normalize.mean, normalize.std
+        train_mean, train_std = normalize.mean, normalize.std
+    else:
+        val_crop = transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+        ])
+        val_mean, val_std = None, None
+        train_mean, train_std = None, None
+    if args.val_cache:
+        # cropped uint8 images are computed once, validation streams them as is
+        val_dataset = load_eval_cache(args.val_cache,
+                                      val_dataset,
+                                      val_crop,
+                                      batch_size=args.batch_size,
+                                      num_workers=args.workers)
+        val_augmentation = transforms.Compose([])
+    else:
+        val_augmentation = val_crop
 
     if args.dataset == 'RP2k':
         import json
         with open('/root/rp2k-moco/mapper.json', 'r') as f:
             mapper = torch.tensor(json.load(f))
+    else:
+        mapper = CIFAR100.MAP
+    # fine/coarse hit counters, each keeps its own on-device copy of the mapping
+    if args.sweep:
+        train_acc = MultiHeadAccuracy(mapper, len(args.sweep), topk=(1, 5))
+        val_acc = MultiHeadAccuracy(mapper, len(args.sweep), topk=(1, 5))
+    else:
+        train_acc = FineCoarseAccuracy(mapper, topk=(1, 5))
+        val_acc = FineCoarseAccuracy(mapper, topk=(1, 5))
 
     if args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        # each rank evaluates its own slice, the counts are summed in validate()
+        val_sampler = DistributedEvalSampler(val_dataset)
     else:
         train_sampler = None
-
-    train_loader = torch.utils.data.DataLoader(train_dataset,
-                                               batch_size=args.batch_size,
-                                               shuffle=(train_sampler is None),
-                                               num_workers=args.workers,
-                                               pin_memory=True,
-                                               sampler=train_sampler)
+        val_sampler = None
+
+    def make_loader(num_workers, prefetch_factor=None, persistent_workers=False, generator=None):
+        return torch.utils.data.DataLoader(train_dataset,
+                                           batch_size=args.batch_size,
+                                           shuffle=(train_sampler is None),
+                                           num_workers=num_workers,
+                                           prefetch_factor=prefetch_factor,
+                                           persistent_workers=persistent_workers,
+                                           pin_memory=True,
+                                           sampler=train_sampler,
+                                           generator=generator)
+
+    train_loader = make_loader(args.workers)
+    tuner = None
+    if args.autotune_loader:
+        tuner = LoaderTuner(make_loader,
+                            args.workers,
+                            args.loader_cpus or loader_cpus(ngpus_per_node),
+                            steps=args.autotune_steps,
+                            epochs=args.epochs - args.start_epoch)
 
     val_loader = torch.utils.data.DataLoader(val_dataset,
                                              batch_size=args.batch_size,
                                              shuffle=False,
                                              num_workers=args.workers,
-                                             pin_memory=True)
+                                             pin_memory=True,
+                                             sampler=val_sampler)
+
+    # copy the next batch to the model's device while the current step runs
+    device = next(model.parameters()).device
+    train_loader = DataPrefetcher(train_loader,
+                                  device,
+                                  mean=train_mean,
+                                  std=train_std,
+                                  memory_format=memory_format(args))
+    val_loader = DataPrefetcher(val_loader,
+                                device,
+                                mean=val_mean,
+                                std=val_std,
+                                memory_format=memory_format(args))
 
     if args.evaluate:
-        validate(val_loader, model, criterion, val_augmentation, args)
+        validate(val_loader, model, criterion, val_augmentation, val_acc, args)
         return
 
     if args.wandb and args.rank == 0:
+        # imported on use: wandb is slow to import and optional
+        import wandb
         wandb.init(project='hyp-moco-finetune', entity='air-sun')
         wandb.config.update(args)
         wandb.watch(model)
@@ -298,13 +387,20 @@ def main_worker(gpu, ngpus_per_node, args):
         if args.distributed:
             train_sampler.set_epoch(epoch)
         adjust_learning_rate(optimizer, epoch, args)
+        if tuner is not None and tuner.config is not None:
+            # the tuned loader takes over from the epoch after tuning
+            train_loader.loader = tuner.loader()
+            tuner = None
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, train_augmentation, args)
+        train(train_loader, model, criterion, optimizer, epoch, train_augmentation, train_acc,
+              tuner, args)
 
         if (epoch + 1) % 5 == 0:
             # evaluate on validation set
-            acc1 = validate(val_loader, model, criterion, val_augmentation, args)
+            acc1 = validate(val_loader, model, criterion, val_augmentation, val_acc, args)
+            if args.sweep:
+                report_sweep(val_acc, args)
 
             # remember best acc@1 and save checkpoint
             is_best = acc1 > best_acc1
@@ -326,24 +422,19 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.distributed:
         dist.destroy_process_group()
     if args.wandb and args.rank == 0:
+        import wandb
         wandb.finish()
 
 
-def train(train_loader, model, criterion, optimizer, epoch, augment, args):
+def train(train_loader, model, criterion, optimizer, epoch, augment, acc, tuner, args):
     global train_step
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
+    acc.reset()
 
-    fine_top1 = AverageMeter('Fine-Acc@1', ':6.2f')
-    fine_top5 = AverageMeter('Fine-Acc@5', ':6.2f')
-    coarse_top1 = AverageMeter('Coarse-Acc@1', ':6.2f')
-    coarse_top5 = AverageMeter('Coarse-Acc@5', ':6.2f')
-
-    progress = ProgressMeter(
-        len(train_loader),
-        [batch_time, data_time, losses, fine_top1, fine_top5, coarse_top1, coarse_top5],
-        prefix="Epoch: [{}]".format(epoch))
+    progress = ProgressMeter(len(train_loader), [batch_time, data_time, losses, acc],
+                             prefix="Epoch: [{}]".format(epoch))
     """
     Switch to eval mode:
     Under the protocol of linear classification on frozen features/models,
@@ -362,45 +453,41 @@ def train(train_loader, model, criterion, optimizer, epoch, augment, args):
     end = time.time()
     for i, (image, fine_target, coarse_target) in enumerate(train_loader):
         train_step += 1
-        # measure data loading time
-        data_time.update(time.time() - end)
-
-        if args.gpu is not None:
-            image = image.cuda(args.gpu, non_blocking=True)
-        fine_target = fine_target.cuda(args.gpu, non_blocking=True)
-        coarse_target = coarse_target.cuda(args.gpu, non_blocking=True)
+        # measure how long this step waited for its batch
+        data_time.update(train_loader.wait_time)
 
-        image = augment(image)
+        image = augment(image).contiguous(memory_format=memory_format(args))
 
         # compute output
         output = model(image)
-        loss = criterion(output, fine_target)
-        losses.update(loss.item(), image.size(0))
+        if args.sweep:
+            # the heads are independent, so the sum gives each the gradient of its own loss
+            loss = sweep_loss(output, fine_target).sum()
+            loss_value = loss.item() / output.size(1)
+        else:
+            loss = criterion(output, fine_target)
+            loss_value = loss.item()
+        losses.update(loss_value, image.size(0))
 
         # measure accuracy and record loss
-        fine_acc1, fine_acc5 = accuracy(output, fine_target, topk=(1, 5))
-        fine_top1.update(fine_acc1[0], image.size(0))
-        fine_top5.update(fine_acc5[0], image.size(0))
-
-        coarse_acc1, coarse_acc5 = accuracy(output,
-                                            coarse_target,
-                                            topk=(1, 5),
-                                            apply=train_loader.dataset.map)
-        coarse_top1.update(coarse_acc1[0], image.size(0))
-        coarse_top5.update(coarse_acc5[0], image.size(0))
+        hits = acc.update(output, fine_target, coarse_target)
 
         if args.wandb and args.rank == 0:
+            import wandb
+            batch_acc = hits.double() * (100.0 / image.size(0))
+            (fine_acc1, fine_acc5), (coarse_acc1, coarse_acc5) = batch_acc.tolist()
+            (fine_avg1, fine_avg5), (coarse_avg1, coarse_avg5) = acc.percent()
             wandb.log({
-                'loss': loss.item(),
+                'loss': loss_value,
                 'loss_avg': losses.avg,
-                'fine_acc1': fine_acc1[0].item(),
-                'fine_acc5': fine_acc5[0].item(),
-                'fine_acc1_avg': fine_top1.avg,
-                'fine_acc5_avg': fine_top5.avg,
-                'coarse_acc1': coarse_acc1[0].item(),
-                'coarse_acc5': coarse_acc5[0].item(),
-                'coarse_acc1_avg': coarse_top1.avg,
-                'coarse_acc5_avg': coarse_top5.avg,
+                'fine_acc1': fine_acc1,
+                'fine_acc5': fine_acc5,
+                'fine_acc1_avg': fine_avg1,
+                'fine_acc5_avg': fine_avg5,
+                'coarse_acc1': coarse_acc1,
+                'coarse_acc5': coarse_acc5,
+                'coarse_acc1_avg': coarse_avg1,
+                'coarse_acc5_avg': coarse_avg5,
                 'train_step': train_step,
             })
 
@@ -411,68 +498,73 @@ def train(train_loader, model, criterion, optimizer, epoch, augment, args):
 
         # measure elapsed time
         batch_time.update(time.time() - end)
+        if tuner is not None:
+            tuner.observe(batch_time.val, data_time.val)
         end = time.time()
 
         if i % args.print_freq == 0:
             progress.display(i)
 
 
-def validate(val_loader, model, criterion, augment, args):
+def validate(val_loader, model, criterion, augment, acc, args):
     global val_step
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
+    acc.reset()
 
-    fine_top1 = AverageMeter('Acc@1', ':6.2f')
-    fine_top5 = AverageMeter('Acc@5', ':6.2f')
-    coarse_top1 = AverageMeter('Acc@1', ':6.2f')
-    coarse_top5 = AverageMeter('Acc@5', ':6.2f')
-
-    progress = ProgressMeter(len(val_loader),
-                             [batch_time, losses, fine_top1, fine_top5, coarse_top1, coarse_top5],
-                             prefix='Test: ')
+    progress = ProgressMeter(len(val_loader), [batch_time, losses, acc], prefix='Test: ')
 
     # switch to evaluate mode
     model.eval()
 
+    # samples of this rank left before the sampler's padding starts
+    remaining = getattr(val_loader.sampler, 'num_valid', len(val_loader.dataset))
+
     with torch.no_grad():
         end = time.time()
         for i, (image, fine_target, coarse_target) in enumerate(val_loader):
             val_step += 1
 
-            if args.gpu is not None:
-                image = image.cuda(args.gpu, non_blocking=True)
-            fine_target = fine_target.cuda(args.gpu, non_blocking=True)
-            coarse_target = coarse_target.cuda(args.gpu, non_blocking=True)
+            image = augment(image).contiguous(memory_format=memory_format(args))
 
             # compute output
             output = model(image)
-            loss = criterion(output, fine_target)
+
+            # drop padded duplicates, they are counted by the rank that owns them
+            valid = min(image.size(0), remaining)
+            remaining -= valid
+            if valid == 0:
+                continue
+            if valid < image.size(0):
+                image = image[:valid]
+                output = output[:valid]
+                fine_target = fine_target[:valid]
+                coarse_target = coarse_target[:valid]
+
+            if args.sweep:
+                loss = sweep_loss(output, fine_target).mean()
+            else:
+                loss = criterion(output, fine_target)
             losses.update(loss.item(), image.size(0))
 
             # measure accuracy and record loss
-            # measure accuracy and record loss
-            fine_acc1, fine_acc5 = accuracy(output, fine_target, topk=(1, 5))
-            fine_top1.update(fine_acc1[0], image.size(0))
-            fine_top5.update(fine_acc5[0], image.size(0))
-
-            coarse_acc1, coarse_acc5 = accuracy(output,
-                                                coarse_target,
-                                                topk=(1, 5),
-                                                apply=val_loader.dataset.map)
-            coarse_top1.update(coarse_acc1[0], image.size(0))
-            coarse_top5.update(coarse_acc5[0], image.size(0))
+            hits = acc.update(output, fine_target, coarse_target)
             if args.wandb and args.rank == 0:
+                import wandb
+                batch_acc = hits.double() * (100.0 / image.size(0))
+                (fine_acc1, fine_acc5), (coarse_acc1, coarse_acc5) = batch_acc.tolist()
+                (fine_avg1, fine_avg5), (coarse_avg1, coarse_avg5) = acc.percent()
                 wandb.log({
                     'val_loss': loss.item(),
                     'val_loss_avg': losses.avg,
-                    'val_fine_acc1': fine_acc1[0].item(),
-                    'val_fine_acc5': fine_acc5[0].item(),
-                    'val_fine_acc1_avg': fine_top1.avg,
-                    'val_fine_acc5_avg': fine_top5.avg,
-                    'val_coarse_acc1': coarse_acc1[0].item(),
-                    'val_coarse_acc5': coarse_acc5[0].item(),
-                    'val_coarse_acc1_avg': coarse_top1.avg,
-                    'val_coarse_acc5_avg': coarse_top5.avg,
+                    'val_fine_acc1': fine_acc1,
+                    'val_fine_acc5': fine_acc5,
+                    'val_fine_acc1_avg': fine_avg1,
+                    'val_fine_acc5_avg': fine_avg5,
+                    'val_coarse_acc1': coarse_acc1,
+                    'val_coarse_acc5': coarse_acc5,
+                    'val_coarse_acc1_avg': coarse_avg1,
+                    'val_coarse_acc5_avg': coarse_avg5,
                     'val_step': val_step,
                 })
 
@@ -483,7 +575,54 @@ def validate(val_loader, model, criterion, augment, args):
             if i % args.print_freq == 0:
                 progress.display(i)
 
-    return fine_top1.avg
+    if args.distributed:
+        acc.all_reduce()
+        totals = torch.tensor([losses.sum, losses.count],
+                              dtype=torch.float64,
+                              device=reduction_device())
+        dist.all_reduce(totals)
+        losses.sum, losses.count = totals.tolist()
+        losses.avg = losses.sum / max(losses.count, 1)
+
+    (fine_acc1, fine_acc5), (coarse_acc1, coarse_acc5) = acc.percent()
+    print(' * Loss {:.4e} Fine-Acc@1 {:.3f} Fine-Acc@5 {:.3f} Coarse-Acc@1 {:.3f} '
+          'Coarse-Acc@5 {:.3f} ({} samples)'.format(losses.avg, fine_acc1, fine_acc5, coarse_acc1,
+                                                   coarse_acc5, acc.count))
+    return fine_acc1
+
+
+def sweep_grid(args):
+    """(lr, weight decay) of each head of a --sweep-lr / --sweep-wd run, or []."""
+    if not args.sweep_lr and not args.sweep_wd:
+        return []
+    return list(itertools.product(args.sweep_lr or [args.lr], args.sweep_wd or [args.weight_decay]))
+
+
+def sweep_loss(output, target):
+    """Cross-entropy of each head of N x H x C logits."""
+    return nn.functional.cross_entropy(output.transpose(1, 2),
+                                       target.view(-1, 1).expand(-1, output.size(1)),
+                                       reduction='none').mean(0)
+
+
+def report_sweep(acc, args):
+    """Validation accuracy of every sweep head, and the best one."""
+    print('{:>4} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'head', 'lr', 'wd', 'Fine@1', 'Fine@5', 'Coarse@1', 'Coarse@5'))
+    for h, ((lr, wd), head) in enumerate(zip(args.sweep, acc.heads)):
+        (fine1, fine5), (coarse1, coarse5) = head.percent()
+        print('{:>4} {:>10.4g} {:>10.4g} {:>10.3f} {:>10.3f} {:>12.3f} {:>12.3f}'.format(
+            h, lr, wd, fine1, fine5, coarse1, coarse5))
+    best = acc.best()
+    lr, wd = args.sweep[best]
+    print(' * Best head {}: lr {:g} wd {:g} Fine-Acc@1 {:.3f}'.format(best, lr, wd,
+                                                                   acc.percent()[0][0]))
+    if args.wandb and args.rank == 0:
+        import wandb
+        log = {'val_fine_acc1/head{}'.format(h): head.percent()[0][0]
+               for h, head in enumerate(acc.heads)}
+        log.update(val_best_head=best, val_best_lr=lr, val_best_wd=wd, val_step=val_step)
+        wandb.log(log)
 
 
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
@@ -561,32 +700,12 @@ class ProgressMeter(object):
 
 def adjust_learning_rate(optimizer, epoch, args):
     """Decay the learning rate based on schedule"""
-    lr = args.lr
-    conv_lr = args.conv_lr
+    decay = 1.
     for milestone in args.schedule:
-        lr *= 0.9 if epoch >= milestone else 1.
-        conv_lr *= 0.9 if epoch >= milestone else 1.
+        decay *= 0.9 if epoch >= milestone else 1.
     for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
-def accuracy(output, target, topk=(1,), apply=None):
-    """Computes the accuracy over the k top predictions for the specified values of k"""
-    with torch.no_grad():
-        maxk = max(topk)
-        batch_size = target.size(0)
-
-        _, pred = output.topk(maxk, 1, True, True)
-        if apply is not None:
-            pred = apply(pred)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-        res = []
-        for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(100.0 / batch_size))
-        return res
+        # the heads of a sweep decay from their own learning rate
+        param_group['lr'] = param_group.get('sweep_lr', args.lr) * decay
 
 
 if __name__ == '__main__':
@@ -15,7 +15,6 @@ import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 import torch.optim
-import torch.multiprocessing as mp
 import torch.utils.data
 import torch.utils.data.distributed
 import torchvision
@@ -26,13 +25,18 @@ import torchvision.models as models
 from .moco import loader
 
 from .moco import builder as MoCoBuilder
-from .hypmoco import builder as HyperMoCoBuilder
+from .moco.loss import InfoNCELoss, rank_accuracy
+from .moco.queue import queue_buffers, sharded_state_dict
 
-from .data.rp2k import RP2kDataset
+from .data.autotune import LoaderTuner, loader_cpus
+from .data.rp2k import RP2kDataset, uint8_augmentation
+from .data.prefetch import DataPrefetcher
+from .data.sampler import ResumableSampler, SeededDataset
 from .cli import parse_args
-from IPython import embed
-
-import wandb
+from .optim import build_optimizer, param_groups
+from .launch import launch, load_checkpoint
+from .runtime import memory_format, rng_state, set_rng_state
+from .profiling import StepProfiler, phase
 
 
 def main():
@@ -51,29 +55,15 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
-    if args.dist_url == "env://" and args.world_size == -1:
-        args.world_size = int(os.environ["WORLD_SIZE"])
-
-    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
-
-    ngpus_per_node = torch.cuda.device_count()
-    if args.multiprocessing_distributed:
-        # Since we have ngpus_per_node processes per node, the total world_size
-        # needs to be adjusted accordingly
-        args.world_size = ngpus_per_node * args.world_size
-        # Use torch.multiprocessing.spawn to launch distributed processes: the
-        # main_worker process function
-        mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args))
-    else:
-        # Simply call main_worker function
-        main_worker(args.gpu, ngpus_per_node, args)
+    # torchrun workers, spawned workers (one per GPU or --nproc-per-node), or this process
+    launch(main_worker, args)
 
 
 def main_worker(gpu, ngpus_per_node, args):
     args.gpu = gpu
 
     # suppress printing if not master
-    if args.multiprocessing_distributed and args.gpu != 0:
+    if args.distributed and args.local_rank != 0:
 
         def print_pass(*args):
             pass
@@ -89,14 +79,19 @@ def main_worker(gpu, ngpus_per_node, args):
         if args.multiprocessing_distributed:
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
-            args.rank = args.rank * ngpus_per_node + gpu
+            args.rank = args.rank * ngpus_per_node + args.local_rank
         dist.init_process_group(backend=args.dist_backend,
                                 init_method=args.dist_url,
                                 world_size=args.world_size,
                                 rank=args.rank)
+    if args.shard_queue and not args.fused_loss:
+        print('=> --shard-queue computes the loss with --fused-loss')
+        args.fused_loss = True
     # create model
     print("=> creating model '{}'".format(args.arch))
     if args.hyper:
+        # hyptorch is only needed (and imported) for hyperbolic runs
+        from .hypmoco import builder as HyperMoCoBuilder
         model = HyperMoCoBuilder.HyperMoCo(models.__dict__[args.arch],
                                            args.moco_dim,
                                            args.moco_k,
@@ -104,19 +99,58 @@ def main_worker(gpu, ngpus_per_node, args):
                                            args.moco_t,
                                            args.mlp,
                                            hyper=args.hyper,
+                                           c=args.curvature,
+                                           train_c=args.train_c,
                                            train_x=False,
-                                           riemannian=True)
+                                           riemannian=True,
+                                           normalize=not args.ball_features,
+                                           negative_distance=args.neg_distance,
+                                           queue_radius=args.queue_radius,
+                                           queue_dtype=getattr(torch, args.queue_dtype),
+                                           shuffle_bn=args.shuffle_bn,
+                                           bn_splits=args.bn_splits,
+                                           fused_loss=args.fused_loss,
+                                           neg_mode=args.neg_mode,
+                                           neg_count=args.neg_count,
+                                           neg_tail=args.neg_tail,
+                                           shard_queue=args.shard_queue)
     else:
-        model = MoCoBuilder.MoCo(models.__dict__[args.arch], args.moco_dim, args.moco_k,
-                                 args.moco_m, args.moco_t, args.mlp)
+        if args.neg_mode != 'all':
+            warnings.warn('--neg-mode is only supported with --hyper, scoring the whole queue.')
+        if args.ball_features or args.neg_distance:
+            warnings.warn('--ball-features and --neg-distance only apply to --hyper.')
+        model = MoCoBuilder.MoCo(models.__dict__[args.arch],
+                                 args.moco_dim,
+                                 args.moco_k,
+                                 args.moco_m,
+                                 args.moco_t,
+                                 args.mlp,
+                                 queue_dtype=getattr(torch, args.queue_dtype),
+                                 shuffle_bn=args.shuffle_bn,
+                                 bn_splits=args.bn_splits,
+                                 fused_loss=args.fused_loss,
+                                 shard_queue=args.shard_queue)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if args.compile:
+        model.compile_encoders()
 
     print(model)
 
     if args.distributed:
+        # every rank enqueues the same gathered keys, so the queue is left out of the
+        # buffer broadcast before each forward (it is synchronized once below)
+        torch.nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(
+            model, queue_buffers(model))
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
         # DistributedDataParallel will use all available devices.
-        if args.gpu is not None:
+        if not torch.cuda.is_available():
+            # gloo processes on CPU, each with its share of the batch and the cores
+            args.batch_size = int(args.batch_size / ngpus_per_node)
+            args.workers = int((args.workers + ngpus_per_node - 1) / ngpus_per_node)
+            model = torch.nn.parallel.DistributedDataParallel(model)
+        elif args.gpu is not None:
             torch.cuda.set_device(args.gpu)
             model.cuda(args.gpu)
             # When using a single GPU per process and per
@@ -130,6 +164,8 @@ def main_worker(gpu, ngpus_per_node, args):
             # DistributedDataParallel will divide and allocate batch_size to all
             # available GPUs if device_ids are not set
             model = torch.nn.parallel.DistributedDataParallel(model)
+        if not args.shard_queue:  # the shards differ by design
+            model.module.queue.broadcast()
     elif args.gpu is not None:
         torch.cuda.set_device(args.gpu)
         model = model.cuda(args.gpu)
@@ -141,29 +177,33 @@ def main_worker(gpu, ngpus_per_node, args):
         # raise NotImplementedError("Only DistributedDataParallel is supported.")
         pass
     # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda(args.gpu)
+    if args.fused_loss:
+        criterion = InfoNCELoss(args.moco_t)
+    else:
+        criterion = nn.CrossEntropyLoss().cuda(args.gpu)
 
-    optimizer = torch.optim.SGD(model.parameters(),
-                                args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    optimizer = build_optimizer(param_groups(model, args), args)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 600, 0.987)
 
     # optionally resume from a checkpoint
+    sampler_state, rng_states = None, None
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            if args.gpu is None:
-                checkpoint = torch.load(args.resume)
-            else:
-                # Map model to be loaded to specified single gpu.
-                loc = 'cuda:{}'.format(args.gpu)
-                checkpoint = torch.load(args.resume, map_location=loc)
+            # Map model to be loaded to specified single gpu.
+            loc = None if args.gpu is None else 'cuda:{}'.format(args.gpu)
+            args.resume, checkpoint = load_checkpoint(args.resume, loc, args.resume_fallback)
             args.start_epoch = checkpoint['epoch']
             model.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
             scheduler.load_state_dict(checkpoint['scheduler'])
-            print("=> loaded checkpoint '{}' (epoch {})".format(args.resume, checkpoint['epoch']))
+            # mid-epoch checkpoints (--save-freq) also hold the data order and RNG states
+            sampler_state = checkpoint.get('sampler')
+            rng_states = checkpoint.get('rng')
+            if args.rp2k_permute is None:
+                args.rp2k_permute = checkpoint.get('rp2k_permute')
+            print("=> loaded checkpoint '{}' (epoch {}, batch {})".format(
+                args.resume, checkpoint['epoch'], checkpoint.get('batch', 0)))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
@@ -189,98 +229,187 @@ def main_worker(gpu, ngpus_per_node, args):
         ]
     else:
         # MoCo v1's aug: the same as InstDisc https://arxiv.org/abs/1805.01978
-        augmentation = transforms.Compose([
-            transforms.RandomResizedCrop(224, scale=(0.2, 1.)),
-            transforms.RandomGrayscale(p=0.2),
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.4),
-            transforms.RandomHorizontalFlip(), normalize
-        ])
+        augmentation = loader.moco_v1_augmentation(normalize)
+    # multi-crop: small views for the query encoder only
+    small_augmentation = None
+    if args.small_crops:
+        small_augmentation = loader.moco_v1_augmentation(normalize, args.small_crop_size,
+                                                         tuple(args.small_crop_scale))
 
     # train_dataset = datasets.ImageFolder(
     #     traindir,
     #     moco.loader.TwoCropsTransform(transforms.Compose(augmentation)))
+    mean, std = None, None
     if args.dataset == 'RP2k':
-        train_dataset = RP2kDataset('/root/rp2k/data', 'train', args, aug=augmentation)
+        # uint8 views, normalized on device by the prefetcher
+        rp2k_augmentation, rp2k_normalize = uint8_augmentation(augmentation)
+        mean, std = rp2k_normalize.mean, rp2k_normalize.std
+        # the dataset makes the small views too, from the same decode
+        rp2k_small = uint8_augmentation(small_augmentation)[0] if args.small_crops else None
+        if args.rp2k_permute is None:  # transposed, as every run before the flag
+            args.rp2k_permute = 1
+        train_dataset = RP2kDataset('/root/rp2k/data',
+                                    'train',
+                                    args,
+                                    aug=rp2k_augmentation,
+                                    permute=bool(args.rp2k_permute),
+                                    small_aug=rp2k_small,
+                                    small_views=args.small_crops)
     elif args.dataset == 'cifar100':
         train_dataset = datasets.CIFAR100(
             args.dataset_dir,
             train=True,
             transform=transforms.Compose([
-                transforms.ToTensor(),
+                transforms.PILToTensor(),  # uint8, converted on device by the prefetcher
             ]),
         )
 
+    # the data order of an epoch, and the random transforms of every sample in the
+    # loader workers, only depend on (seed, epoch), so runs can resume part-way
+    # through one
+    seed = args.seed if args.seed is not None else 0
+    train_dataset = SeededDataset(train_dataset)
     if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        train_sampler = ResumableSampler(train_dataset, seed=seed, seeded=True)
     else:
-        train_sampler = torch.utils.data.RandomSampler(train_dataset)
-
-    train_loader = torch.utils.data.DataLoader(train_dataset,
-                                               batch_size=args.batch_size,
-                                               shuffle=(train_sampler is None),
-                                               num_workers=args.workers,
-                                               pin_memory=True,
-                                               sampler=train_sampler,
-                                               drop_last=True)
+        train_sampler = ResumableSampler(train_dataset, num_replicas=1, rank=0, seed=seed,
+                                         seeded=True)
+    if sampler_state is not None:
+        train_sampler.load_state_dict(sampler_state)
+
+    # loader iterators draw their worker seeds from this generator rather than from
+    # the global RNG, whose stream is restored on resume (the samples do not depend
+    # on them, see SeededDataset)
+    generator = torch.Generator()
+    generator.manual_seed(seed + max(args.rank, 0))
+
+    def make_loader(num_workers, prefetch_factor=None, persistent_workers=False, generator=None):
+        return torch.utils.data.DataLoader(train_dataset,
+                                           batch_size=args.batch_size,
+                                           shuffle=(train_sampler is None),
+                                           num_workers=num_workers,
+                                           prefetch_factor=prefetch_factor,
+                                           persistent_workers=persistent_workers,
+                                           pin_memory=True,
+                                           sampler=train_sampler,
+                                           drop_last=True,
+                                           generator=generator)
+
+    train_loader = make_loader(args.workers, generator=generator)
+    tuner = None
+    if args.autotune_loader:
+        tuner = LoaderTuner(make_loader,
+                            args.workers,
+                            args.loader_cpus or loader_cpus(ngpus_per_node),
+                            steps=args.autotune_steps,
+                            epochs=args.epochs - args.start_epoch)
+    # copy the next batch to the model's device while the current step runs
+    train_loader = DataPrefetcher(train_loader,
+                                  next(model.parameters()).device,
+                                  mean=mean,
+                                  std=std,
+                                  memory_format=memory_format(args))
 
     if args.wandb and args.rank == 0:
+        # imported on use: wandb is slow to import and optional
+        import wandb
         wandb.init(project='MoCo-CIFAR100', entity='air-sun')
         wandb.config.update(args)
         wandb.watch(model)
         wandb.run.name = args.run_name
         wandb.run.save()
 
+    profiler = StepProfiler(args.profile_steps,
+                            args.profile_dir or 'profile_{}'.format(args.run_name),
+                            rank=max(args.rank, 0))
+
+    if rng_states is not None:
+        rank = max(args.rank, 0)
+        if len(rng_states) == max(args.world_size, 1):
+            set_rng_state(rng_states[rank])
+        else:
+            print("=> checkpoint RNG states are for {} processes, not restored".format(
+                len(rng_states)))
+
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if sampler_state is None or epoch > args.start_epoch:
             train_sampler.set_epoch(epoch)
+        if tuner is not None and tuner.config is not None:
+            # the tuned loader takes over from the epoch after tuning
+            train_loader.loader = tuner.loader(generator)
+            tuner = None
         # adjust_learning_rate(optimizer, epoch, args)
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, scheduler, augmentation, epoch, args)
+        train(train_loader, model, criterion, optimizer, scheduler, augmentation,
+              small_augmentation, epoch, profiler, tuner, args)
 
         if epoch % 5 == 0:
-            if not args.multiprocessing_distributed or (args.multiprocessing_distributed and
-                                                        args.rank % ngpus_per_node == 0):
-                save_checkpoint(
-                    {
-                        'epoch': epoch + 1,
-                        'arch': args.arch,
-                        'state_dict': model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'scheduler': scheduler.state_dict(),
-                    },
-                    is_best=False,
-                    filename=f'checkpoint_{args.run_name}_{epoch:04d}.pth.tar')
+            state = {
+                'epoch': epoch + 1,
+                'rp2k_permute': args.rp2k_permute,
+                'arch': args.arch,
+                'state_dict': model_state(model, args),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+            }
+            if not args.distributed or args.local_rank == 0:
+                save_checkpoint(state,
+                                is_best=False,
+                                filename=f'checkpoint_{args.run_name}_{epoch:04d}.pth.tar')
     if args.distributed:
         dist.destroy_process_group()
     if args.wandb and args.rank == 0:
+        import wandb
         wandb.finish()
 
 
-def train(train_loader, model, criterion, optimizer, scheduler, augment, epoch, args):
+def train(train_loader, model, criterion, optimizer, scheduler, augment, small_augment, epoch,
+          profiler, tuner, args):
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
-    top5 = AverageMeter('Acc@5', ':6.2f')
-    progress = ProgressMeter(len(train_loader), [batch_time, data_time, losses, top1, top5],
+    # with sampled negatives the positives are only ranked among neg_count queue
+    # entries, an easier task than the (K+1)-way one of the other modes, so the
+    # accuracy is logged under other names
+    sampled = args.hyper and args.neg_mode == 'sample' and args.neg_count < args.moco_k
+    suffix = '_sampled' if sampled else ''
+    top1 = AverageMeter('Acc@1' + suffix, ':6.2f')
+    top5 = AverageMeter('Acc@5' + suffix, ':6.2f')
+    # a resumed epoch starts at the batch its checkpoint was written after
+    steps_per_epoch = train_loader.sampler.num_samples // args.batch_size
+    first = train_loader.sampler.start // args.batch_size
+    progress = ProgressMeter(steps_per_epoch, [batch_time, data_time, losses, top1, top5],
                              prefix="Epoch: [{}]".format(epoch))
     print('start training')
     # switch to train mode
     model.train()
 
     end = time.time()
-    for i, (image, _) in enumerate(train_loader):
-        # measure data loading time
-        data_time.update(time.time() - end)
-        if args.gpu is not None:
-            image = image.cuda(args.gpu, non_blocking=True).contiguous()
-        with torch.no_grad():
-            images = [augment(image), augment(image)]
-
-        # compute output
-        output, target = model(im_q=images[0], im_k=images[1])
-        loss = criterion(output, target)
+    for i, (image, _) in enumerate(train_loader, start=first):
+        step = epoch * steps_per_epoch + i
+        profiler.start_step(step)
+        # measure how long this step waited for its batch
+        data_time.update(train_loader.wait_time)
+        with torch.no_grad(), phase('train/augment'):
+            if isinstance(image, (list, tuple)):  # views made by the dataset
+                images = list(image)
+            else:
+                images = [augment(image), augment(image)]
+                if small_augment is not None:
+                    images += [small_augment(image) for _ in range(args.small_crops)]
+            images = [im.contiguous(memory_format=memory_format(args)) for im in images]
+
+        # compute output; the extra (small) views are queries only
+        with phase('train/forward'):
+            output = model(im_q=images[0], im_k=images[1], im_extra=images[2:] or None)
+            # output is (l_pos, l_neg) or (logits, target), followed by the ranks of the
+            # positives when the model counts them (sharded queue, shifted negatives)
+            if args.fused_loss:
+                loss, rank = criterion(*output)
+            else:
+                output, target, rank = output if len(output) == 3 else output + (None,)
+                loss = criterion(output, target)
 
         def get_lr():
             for group in optimizer.param_groups:
@@ -288,27 +417,48 @@ def train(train_loader, model, criterion, optimizer, scheduler, augment, epoch,
 
         # acc1/acc5 are (K+1)-way contrast classifier accuracy
         # measure accuracy and record loss
-        acc1, acc5 = accuracy(output, target, topk=(1, 5))
+        # (of the two global views, comparable with and without multi-crop)
+        n = images[0].size(0)
+        if rank is not None:
+            acc1, acc5 = rank_accuracy(rank[:n], topk=(1, 5))
+        else:
+            acc1, acc5 = accuracy(output[:n], target[:n], topk=(1, 5))
         if args.wandb and args.rank == 0:
+            import wandb
             wandb.log({
                 'loss': loss,
                 'lr': get_lr(),
-                'global_step': epoch * 654 + i,
-                'acc1': acc1[0],
-                'acc5': acc5[0]
+                'global_step': step,
+                'acc1' + suffix: acc1[0],
+                'acc5' + suffix: acc5[0]
             })
         losses.update(loss.item(), images[0].size(0))
         top1.update(acc1[0], images[0].size(0))
         top5.update(acc5[0], images[0].size(0))
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        scheduler.step()
+        with phase('train/backward'):
+            optimizer.zero_grad()
+            loss.backward()
+        with phase('train/optimizer'):
+            optimizer.step()
+            scheduler.step()
+            if args.train_c:
+                getattr(model, 'module', model).curvature.clamp_()
+        if (args.distributed and not args.shard_queue and args.queue_check_freq and
+                step % args.queue_check_freq == 0):
+            model.module.queue.check()
+        if args.save_freq and (step + 1) % args.save_freq == 0:
+            state = training_state(model, optimizer, scheduler, train_loader.sampler, epoch, i + 1,
+                                   args)
+            if args.rank <= 0:
+                save_checkpoint(state, False, 'checkpoint_{}_last.pth.tar'.format(args.run_name))
+        profiler.end_step()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
+        if tuner is not None:
+            tuner.observe(batch_time.val, data_time.val)
         end = time.time()
 
         if i % args.print_freq == 0:
@@ -319,8 +469,38 @@ def fine_tune():
     pass
 
 
+def model_state(model, args):
+    """The model's state dict, with the queue shards of all processes under --shard-queue"""
+    return sharded_state_dict(model) if args.shard_queue else model.state_dict()
+
+
+def training_state(model, optimizer, scheduler, sampler, epoch, batch, args):
+    """
+    Checkpoint after `batch` batches of `epoch`, including the data order and the RNG
+    states of every process so that training resumes exactly there. All processes
+    must call this; only one needs to save the result.
+    """
+    rng = [rng_state()]
+    if args.distributed:
+        rng = [None] * dist.get_world_size()
+        dist.all_gather_object(rng, rng_state())
+    return {
+        'epoch': epoch,
+        'batch': batch,
+        'rp2k_permute': args.rp2k_permute,
+        'arch': args.arch,
+        'state_dict': model_state(model, args),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'sampler': sampler.state_dict(start=batch * args.batch_size),
+        'rng': rng,
+    }
+
+
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
+    # written aside and renamed, so a preemption never leaves a truncated checkpoint
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
     if is_best:
         shutil.copyfile(filename, 'model_best.pth.tar')
 
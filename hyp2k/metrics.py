@@ -0,0 +1,132 @@
+import torch
+import torch.distributed as dist
+
+
+class FineCoarseAccuracy(object):
+    """Accumulates fine and coarse top-k hit counts from a single top-k pass.
+
+    The fine->coarse label mapping is uploaded once per device and reused, and hit
+    counts are kept as an integer tensor on the device of the logits, so nothing is
+    synchronized with the host until the averages are read.
+    """
+
+    def __init__(self, mapping, topk=(1,), name='Acc'):
+        self.mapping = torch.as_tensor(mapping, dtype=torch.long)
+        self.topk = tuple(topk)
+        self.name = name
+        self._lut = {}
+        self.reset()
+
+    def reset(self):
+        self.hits = None  # 2 x len(topk), rows are fine / coarse
+        self.count = 0
+
+    def _tables(self, device):
+        tables = self._lut.get(device)
+        if tables is None:
+            tables = (self.mapping.to(device),
+                      torch.tensor([k - 1 for k in self.topk], dtype=torch.long, device=device))
+            self._lut[device] = tables
+        return tables
+
+    @torch.no_grad()
+    def update(self, output, fine_target, coarse_target):
+        """Adds one batch; returns its 2 x len(topk) hit counts (still on device)."""
+        mapping, k_index = self._tables(output.device)
+        _, pred = output.topk(max(self.topk), 1, True, True)  # N x maxk
+
+        # N x 2 x maxk: a sample is a top-k hit if any of its first k guesses matches.
+        # Several fine guesses may share a coarse class, so take the running max
+        # instead of summing, otherwise coarse top-5 can exceed 100%.
+        correct = torch.stack([
+            pred.eq(fine_target.view(-1, 1)),
+            mapping[pred].eq(coarse_target.view(-1, 1)),
+        ], dim=1)
+        correct = correct.cummax(dim=2)[0]
+        hits = correct.index_select(2, k_index).sum(0)
+
+        if self.hits is None:
+            self.hits = torch.zeros_like(hits)
+        self.hits += hits
+        self.count += output.size(0)
+        return hits
+
+    def all_reduce(self):
+        """Sums hit counts and sample counts over all ranks of the default group."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        hits = self.hits if self.hits is not None else torch.zeros(
+            2, len(self.topk), dtype=torch.long, device=reduction_device())
+        packed = torch.cat([hits.view(-1), hits.new_tensor([self.count])])
+        dist.all_reduce(packed)
+        self.hits = packed[:-1].view_as(hits)
+        self.count = int(packed[-1])
+
+    def percent(self):
+        """Returns ([fine top-k ...], [coarse top-k ...]) in percent."""
+        if self.hits is None or self.count == 0:
+            return [0.] * len(self.topk), [0.] * len(self.topk)
+        fine, coarse = (self.hits.double() * (100.0 / self.count)).tolist()
+        return fine, coarse
+
+    def __str__(self):
+        fine, coarse = self.percent()
+        entries = ['Fine-{}@{} {:6.2f}'.format(self.name, k, v) for k, v in zip(self.topk, fine)]
+        entries += [
+            'Coarse-{}@{} {:6.2f}'.format(self.name, k, v) for k, v in zip(self.topk, coarse)
+        ]
+        return '\t'.join(entries)
+
+
+def reduction_device():
+    """Device the default process group expects collective tensors on."""
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+class MultiHeadAccuracy(object):
+    """FineCoarseAccuracy of each head of a MultiHeadLinear (logits N x H x C)."""
+
+    def __init__(self, mapping, num_heads, topk=(1,), name='Acc'):
+        self.heads = [FineCoarseAccuracy(mapping, topk, name) for _ in range(num_heads)]
+        self.topk = tuple(topk)
+        self.name = name
+
+    def reset(self):
+        for acc in self.heads:
+            acc.reset()
+
+    @property
+    def count(self):
+        return self.heads[0].count
+
+    @torch.no_grad()
+    def update(self, output, fine_target, coarse_target):
+        """Adds one batch; returns the batch hit counts of the best head so far."""
+        hits = torch.stack([
+            acc.update(output[:, h], fine_target, coarse_target)
+            for h, acc in enumerate(self.heads)
+        ])
+        return hits[self._best()]
+
+    def all_reduce(self):
+        for acc in self.heads:
+            acc.all_reduce()
+
+    def _best(self):
+        # on device, so that updates do not synchronize with the host
+        return torch.stack([acc.hits[0, 0] for acc in self.heads]).argmax()
+
+    def best(self):
+        """Index of the head with the most fine top-1 hits."""
+        if self.count == 0:
+            return 0
+        return int(self._best())
+
+    def percent(self):
+        """Accuracies of the best head, as FineCoarseAccuracy.percent()."""
+        return self.heads[self.best()].percent()
+
+    def __str__(self):
+        return 'Head {} {}'.format(self.best(), self.heads[self.best()])
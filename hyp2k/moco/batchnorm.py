@@ -0,0 +1,86 @@
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+class SplitBatchNorm(nn.BatchNorm2d):
+    """
+    BatchNorm whose training statistics are computed over `num_splits` groups of the
+    batch, as if each group were on its own GPU. Emulates the per-device BN of
+    multi-GPU training inside one process.
+    """
+
+    def __init__(self, num_features, num_splits, **kwargs):
+        super(SplitBatchNorm, self).__init__(num_features, **kwargs)
+        self.num_splits = num_splits
+
+    def forward(self, input):
+        N, C, H, W = input.shape
+        if not self.training:
+            return super(SplitBatchNorm, self).forward(input)
+        assert N % self.num_splits == 0, 'batch size must be divisible by the BN splits'
+        running_mean = self.running_mean.repeat(self.num_splits)
+        running_var = self.running_var.repeat(self.num_splits)
+        # sample i * num_splits + j goes to group j
+        output = nn.functional.batch_norm(input.reshape(-1, C * self.num_splits, H, W),
+                                          running_mean, running_var,
+                                          self.weight.repeat(self.num_splits),
+                                          self.bias.repeat(self.num_splits), True, self.momentum,
+                                          self.eps).view(N, C, H, W)
+        with torch.no_grad():
+            self.running_mean.copy_(running_mean.view(self.num_splits, C).mean(0))
+            self.running_var.copy_(running_var.view(self.num_splits, C).mean(0))
+        return output
+
+
+class KeySyncBatchNorm(nn.BatchNorm2d):
+    """
+    BatchNorm with the training statistics of the whole distributed batch, for the
+    key encoder. The statistics are exchanged with one all_reduce of
+    (sum, sum of squares, count) per layer and carry no gradient, which the key
+    encoder does not need. Unlike nn.SyncBatchNorm this also runs on CPU (gloo).
+    """
+
+    def forward(self, input):
+        if not self.training or not (dist.is_available() and dist.is_initialized()):
+            return super(KeySyncBatchNorm, self).forward(input)
+        C = input.size(1)
+        with torch.no_grad():
+            x = input.transpose(0, 1).reshape(C, -1).float()
+            stats = torch.cat([x.sum(1), x.pow(2).sum(1), x.new_full((1,), x.size(1))])
+            dist.all_reduce(stats)
+            count = stats[-1]
+            mean = stats[:C] / count
+            var = (stats[C:2 * C] / count - mean.pow(2)).clamp_min_(0)
+            if self.track_running_stats:
+                self.num_batches_tracked.add_(1)
+                factor = self.momentum
+                if factor is None:  # cumulative moving average
+                    factor = 1. / float(self.num_batches_tracked)
+                self.running_mean.lerp_(mean, factor)
+                self.running_var.lerp_(var * count / (count - 1).clamp_min(1), factor)
+        return nn.functional.batch_norm(input, mean.to(input.dtype), var.to(input.dtype),
+                                        self.weight, self.bias, False, 0., self.eps)
+
+
+def convert_batchnorm(module, cls, **kwargs):
+    """
+    Returns `module` with every BatchNorm2d replaced by `cls(num_features, **kwargs)`,
+    keeping the affine parameters and running statistics.
+    """
+    converted = module
+    if isinstance(module, nn.BatchNorm2d) and type(module) is not cls:
+        converted = cls(module.num_features,
+                        eps=module.eps,
+                        momentum=module.momentum,
+                        affine=module.affine,
+                        track_running_stats=module.track_running_stats,
+                        **kwargs)
+        if module.affine:
+            converted.weight = module.weight
+            converted.bias = module.bias
+        for name in ('running_mean', 'running_var', 'num_batches_tracked'):
+            setattr(converted, name, getattr(module, name))
+    for name, child in module.named_children():
+        converted.add_module(name, convert_batchnorm(child, cls, **kwargs))
+    return converted
@@ -2,24 +2,52 @@
 import torch
 import torch.nn as nn
 
+from .batchnorm import KeySyncBatchNorm, SplitBatchNorm, convert_batchnorm
+from .comm import CommScheduler
+from .queue import KeyQueue, upgrade_queue_state_dict
+from .sharded import num_shards, sharded_negatives
+from ..profiling import phase
+from ..runtime import compile_batch_dynamic
+
 
 class MoCo(nn.Module):
     """
     Build a MoCo model with: a query encoder, a key encoder, and a queue
     https://arxiv.org/abs/1911.05722
     """
-    def __init__(self, base_encoder, dim=128, K=65536, m=0.999, T=0.07, mlp=False):
+    def __init__(self,
+                 base_encoder,
+                 dim=128,
+                 K=65536,
+                 m=0.999,
+                 T=0.07,
+                 mlp=False,
+                 queue_dtype=torch.float32,
+                 shuffle_bn='shuffle',
+                 bn_splits=8,
+                 fused_loss=False,
+                 shard_queue=False):
         """
         dim: feature dimension (default: 128)
         K: queue size; number of negative keys (default: 65536)
         m: moco momentum of updating key encoder (default: 0.999)
         T: softmax temperature (default: 0.07)
+        queue_dtype: storage dtype of the queue, see KeyQueue (default: torch.float32)
+        shuffle_bn: BN of the key encoder, 'shuffle', 'sync' or 'split' (default: 'shuffle')
+        bn_splits: number of BN groups of the 'split' mode (default: 8)
+        fused_loss: return (l_pos, l_neg) for InfoNCELoss instead of logits and
+                    targets (default: False)
+        shard_queue: every process holds K / world_size entries of the queue, and
+                     the negatives of all shards are combined by sharded_negatives;
+                     needs fused_loss. Checkpoint the state of sharded_state_dict,
+                     which holds all shards (default: False)
         """
         super(MoCo, self).__init__()
 
         self.K = K
         self.m = m
         self.T = T
+        self.fused_loss = fused_loss
 
         # create the encoders
         # num_classes is the output fc dimension
@@ -31,145 +59,163 @@ class MoCo(nn.Module):
             self.encoder_q.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), self.encoder_q.fc)
             self.encoder_k.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), self.encoder_k.fc)
 
+        # BN of the key encoder: shuffled across processes (see forward), synchronized
+        # across them, or split into groups within this process
+        assert shuffle_bn in ('shuffle', 'sync', 'split'), shuffle_bn
+        self.shuffle_bn = shuffle_bn
+        if shuffle_bn == 'sync':
+            self.encoder_k = convert_batchnorm(self.encoder_k, KeySyncBatchNorm)
+        elif shuffle_bn == 'split':
+            self.encoder_k = convert_batchnorm(self.encoder_k, SplitBatchNorm, num_splits=bn_splits)
+
         for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
             param_k.data.copy_(param_q.data)  # initialize
             param_k.requires_grad = False  # not update by gradient
 
         # create the queue
-        self.register_buffer("queue", torch.randn(dim, K))
-        self.queue = nn.functional.normalize(self.queue, dim=0)
+        assert fused_loss or not shard_queue, 'a sharded queue needs the fused loss'
+        self.shard_queue = shard_queue
+        self.queue = KeyQueue(dim, K // num_shards() if shard_queue else K, dtype=queue_dtype)
+        self._register_load_state_dict_pre_hook(upgrade_queue_state_dict)
 
-        self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
+        # batch shuffle and key gathering across processes
+        self.comm = CommScheduler()
 
-    @torch.no_grad()
-    def _momentum_update_key_encoder(self):
+    def encode_q(self, im):
         """
-        Momentum update of the key encoder
+        Query features: encoder (including the projection head) and normalization
         """
-        for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-
-    @torch.no_grad()
-    def _dequeue_and_enqueue(self, keys):
-        # gather keys before updating queue
-        keys = concat_all_gather(keys)
-
-        batch_size = keys.shape[0]
+        return nn.functional.normalize(self.encoder_q(im), dim=1)
 
-        ptr = int(self.queue_ptr)
-        assert self.K % batch_size == 0  # for simplicity
-
-        # replace the keys at ptr (dequeue and enqueue)
-        self.queue[:, ptr:ptr + batch_size] = keys.T
-        ptr = (ptr + batch_size) % self.K  # move pointer
+    def encode_k(self, im):
+        """
+        Key features: encoder (including the projection head) and normalization
+        """
+        return nn.functional.normalize(self.encoder_k(im), dim=1)
 
-        self.queue_ptr[0] = ptr
+    def _encode_extra(self, views):
+        """
+        Query features of a list of extra views, one encoder pass per resolution
+        """
+        groups = {}
+        for i, view in enumerate(views):
+            groups.setdefault(tuple(view.shape[-2:]), []).append(i)
+        q = [None] * len(views)
+        for idx in groups.values():
+            out = self.encode_q(torch.cat([views[i] for i in idx]))
+            for i, q_i in zip(idx, out.split([views[i].size(0) for i in idx])):
+                q[i] = q_i
+        return q
+
+    def compile_encoders(self, **kwargs):
+        """
+        Replace encode_q / encode_k with torch.compile'd versions. The state dict is
+        unchanged, and a smaller last batch reuses the compiled graphs.
+        """
+        self.encode_q = compile_batch_dynamic(self.encode_q, **kwargs)
+        self.encode_k = compile_batch_dynamic(self.encode_k, **kwargs)
 
     @torch.no_grad()
-    def _batch_shuffle_ddp(self, x):
+    def _momentum_update_key_encoder(self):
         """
-        Batch shuffle, for making use of BatchNorm.
-        *** Only support DistributedDataParallel (DDP) model. ***
+        Momentum update of the key encoder
         """
-        # gather from all gpus
-        batch_size_this = x.shape[0]
-        x_gather = concat_all_gather(x)
-        batch_size_all = x_gather.shape[0]
-
-        num_gpus = batch_size_all // batch_size_this
-
-        # random shuffle index
-        idx_shuffle = torch.randperm(batch_size_all).cuda()
-
-        # broadcast to all gpus
-        torch.distributed.broadcast(idx_shuffle, src=0)
-
-        # index for restoring
-        idx_unshuffle = torch.argsort(idx_shuffle)
-
-        # shuffled index for this gpu
-        gpu_idx = torch.distributed.get_rank()
-        idx_this = idx_shuffle.view(num_gpus, -1)[gpu_idx]
-
-        return x_gather[idx_this], idx_unshuffle
+        for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
+            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
 
     @torch.no_grad()
-    def _batch_unshuffle_ddp(self, x, idx_unshuffle):
+    def _dequeue_and_enqueue(self, keys):
         """
-        Undo batch shuffle.
-        *** Only support DistributedDataParallel (DDP) model. ***
+        keys: the keys of all processes, see CommScheduler.gather_keys
         """
-        # gather from all gpus
-        batch_size_this = x.shape[0]
-        x_gather = concat_all_gather(x)
-        batch_size_all = x_gather.shape[0]
-
-        num_gpus = batch_size_all // batch_size_this
-
-        # restored index for this gpu
-        gpu_idx = torch.distributed.get_rank()
-        idx_this = idx_unshuffle.view(num_gpus, -1)[gpu_idx]
+        self.queue.push(keys)
 
-        return x_gather[idx_this]
-
-    def forward(self, im_q, im_k):
+    def forward(self, im_q, im_k, im_extra=None):
         """
         Input:
             im_q: a batch of query images
             im_k: a batch of key images
+            im_extra: optional list of batches of further (e.g. small) views, used as
+                      queries only and scored against the same keys and queue
         Output:
-            logits, targets
+            logits, targets (the rows of im_q first, then those of each extra view),
+            or unscaled l_pos (Nx1) and l_neg (NxK) with fused_loss,
+            or l_pos, l_neg (Nx1) and rank with shard_queue, see sharded_negatives
         """
 
-        # compute query features
-        q = self.encoder_q(im_q)  # queries: NxC
-        q = nn.functional.normalize(q, dim=1)
-
         # compute key features
         with torch.no_grad():  # no gradient to keys
-            self._momentum_update_key_encoder()  # update the key encoder
+            # shuffle for making use of BN, exchanged during the momentum update
+            if self.shuffle_bn == 'shuffle':
+                with phase('moco/batch_shuffle'):
+                    shuffled = self.comm.shuffle(im_k)
 
-            # shuffle for making use of BN
-            im_k, idx_unshuffle = self._batch_shuffle_ddp(im_k)
+            with phase('moco/momentum_update'):
+                self._momentum_update_key_encoder()  # update the key encoder
 
-            k = self.encoder_k(im_k)  # keys: NxC
-            k = nn.functional.normalize(k, dim=1)
+            with phase('moco/batch_shuffle'):
+                if self.shuffle_bn == 'shuffle':
+                    im_k = shuffled.wait()
+                elif self.shuffle_bn == 'split':
+                    # random BN groups within this process
+                    idx_shuffle = torch.randperm(im_k.size(0), device=im_k.device)
+                    im_k = im_k[idx_shuffle]
 
-            # undo shuffle
-            k = self._batch_unshuffle_ddp(k, idx_unshuffle)
+            with phase('moco/encode_k'):
+                k = self.encode_k(im_k)  # keys: NxC
 
-        # compute logits
-        # Einstein sum is more intuitive
-        # positive logits: Nx1
-        l_pos = torch.einsum('nc,nc->n', [q, k]).unsqueeze(-1)
-        # negative logits: NxK
-        l_neg = torch.einsum('nc,ck->nk', [q, self.queue.clone().detach()])
+            if self.shuffle_bn == 'split':
+                k = k[torch.argsort(idx_shuffle)]
+
+            # gathered during the query forward (and unshuffled)
+            with phase('moco/all_gather'):
+                gathered = self.comm.gather_keys(k, shuffled=self.shuffle_bn == 'shuffle')
 
-        # logits: Nx(1+K)
-        logits = torch.cat([l_pos, l_neg], dim=1)
+        # compute query features
+        with phase('moco/encode_q'):
+            q = self.encode_q(im_q)  # queries: NxC
+            if im_extra:
+                q = torch.cat([q] + self._encode_extra(im_extra))  # (1+M)NxC
+
+        with phase('moco/all_gather'):
+            k, keys = gathered.wait()
+        k_pos = k.repeat(q.size(0) // k.size(0), 1) if q.size(0) != k.size(0) else k
 
-        # apply temperature
-        logits /= self.T
+        # compute logits
+        with phase('moco/logits'):
+            # positive logits: Nx1
+            l_pos = torch.einsum('nc,nc->n', [q, k_pos]).unsqueeze(-1)
+            # negative logits: NxK
+            self.queue.flush()
+            if self.shard_queue:
+                # Nx1, this process' shard combined with the others
+                l_neg, rank = sharded_negatives(q, l_pos, self.queue.mm, self.T)
+            else:
+                l_neg = self.queue.mm(q)
+
+        if self.shard_queue:
+            with phase('moco/enqueue'):
+                # every shard takes the keys of its own process
+                self._dequeue_and_enqueue(k)
+            return l_pos, l_neg, rank
+
+        if self.fused_loss:
+            with phase('moco/enqueue'):
+                self._dequeue_and_enqueue(keys)
+            return l_pos, l_neg
+
+        with phase('moco/logits'):
+            # logits: Nx(1+K)
+            logits = torch.cat([l_pos, l_neg], dim=1)
+
+            # apply temperature
+            logits /= self.T
 
         # labels: positive key indicators
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).cuda()
+        labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
 
         # dequeue and enqueue
-        self._dequeue_and_enqueue(k)
+        with phase('moco/enqueue'):
+            self._dequeue_and_enqueue(keys)
 
         return logits, labels
-
-
-# utils
-@torch.no_grad()
-def concat_all_gather(tensor):
-    """
-    Performs all_gather operation on the provided tensors.
-    *** Warning ***: torch.distributed.all_gather has no gradient.
-    """
-    tensors_gather = [torch.ones_like(tensor)
-        for _ in range(torch.distributed.get_world_size())]
-    torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
-
-    output = torch.cat(tensors_gather, dim=0)
-    return output
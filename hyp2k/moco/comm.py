@@ -0,0 +1,174 @@
+import collections
+
+import torch
+import torch.distributed as dist
+
+from ..profiling import phase
+
+
+class Pending(object):
+    """An issued exchange; `wait()` blocks until it is done and returns its result."""
+
+    def __init__(self, work, finish):
+        self.work = work
+        self.finish = finish
+
+    def wait(self):
+        if self.work is not None:
+            self.work.wait()
+        return self.finish()
+
+
+class CommScheduler(object):
+    """
+    Collective communication of one MoCo step (batch shuffle BN and key gathering).
+
+    - shuffle: only the random permutation is broadcast (on the host), and every rank
+      then receives just the images it needs with one all_to_all, instead of
+      all-gathering every image of every rank (falls back to that when all_to_all is
+      unavailable).
+    - gather_keys: one all_gather of the shuffled keys gives both this rank's
+      unshuffled keys and all keys, in order, for the queue.
+    - Both are issued asynchronously into gather buffers allocated once and reused.
+
+    Without an initialized process group both are local no-ops, for single process
+    runs that do not shuffle (see the --shuffle-bn split mode).
+
+    `bytes` counts the bytes each collective received on this rank, and
+    `legacy_bytes` those of the former all_gather based exchange (images, then
+    unshuffle and enqueue gathers), for comparison.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.bytes = collections.Counter()
+        self.legacy_bytes = collections.Counter()
+        self.use_all_to_all = True
+        self._order = None
+        self._host_group = None
+
+    def _buffer(self, name, shape, like):
+        buf = self.buffers.get(name)
+        if buf is None or (buf.shape, buf.dtype, buf.device) != (shape, like.dtype, like.device):
+            buf = self.buffers[name] = torch.empty(shape, dtype=like.dtype, device=like.device)
+        return buf
+
+    def _broadcast_host(self, t, x):
+        """
+        Broadcasts the host tensor `t` from rank 0, through a gloo group if the default
+        backend only takes device tensors.
+        """
+        if x.device.type == 'cpu' or dist.get_backend() == 'gloo':
+            dist.broadcast(t, src=0)
+            return t
+        if self._host_group is None:
+            try:
+                self._host_group = dist.new_group(backend='gloo')
+            except (RuntimeError, ValueError):
+                self._host_group = False
+        if self._host_group is False:  # no gloo: broadcast on the device and wait for it
+            t_device = t.to(x.device)
+            dist.broadcast(t_device, src=0)
+            return t_device.cpu()
+        dist.broadcast(t, src=0, group=self._host_group)
+        return t
+
+    @staticmethod
+    def _to_device(t, x):
+        """The host tensor `t` on the device of `x`, copied without blocking the host"""
+        if x.device.type == 'cpu':
+            return t
+        return t.pin_memory().to(x.device, non_blocking=True)
+
+    def _all_gather(self, name, x):
+        out = self._buffer(name, torch.Size((dist.get_world_size() * x.size(0),) + x.shape[1:]), x)
+        x = x.contiguous()
+        try:
+            work = dist.all_gather_into_tensor(out, x, async_op=True)
+        except (AttributeError, RuntimeError):  # no single-tensor gather in this backend
+            work = dist.all_gather(list(out.chunk(dist.get_world_size())), x, async_op=True)
+        return work, out
+
+    @torch.no_grad()
+    def shuffle(self, x):
+        """
+        Batch shuffle of `x` across ranks, for making use of BatchNorm. Returns a
+        Pending of this rank's shuffled batch.
+        """
+        if not dist.is_initialized():
+            return Pending(None, lambda: x)
+        batch_size, world_size, rank = x.size(0), dist.get_world_size(), dist.get_rank()
+        image_bytes = x[0].numel() * x.element_size()
+        # exchanged in the default layout, channels_last batches are restored after
+        if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(
+                memory_format=torch.channels_last):
+            layout = torch.channels_last
+        else:
+            layout = torch.contiguous_format
+
+        # random shuffle index, drawn and broadcast on the host: the all_to_all split
+        # sizes are host ints, and reading them from a device tensor would sync the
+        # host with the device every step
+        idx_shuffle = torch.randperm(batch_size * world_size)
+        idx_shuffle = self._broadcast_host(idx_shuffle, x).view(world_size, batch_size)
+        self.legacy_bytes['images'] += (world_size - 1) * batch_size * image_bytes
+
+        if self.use_all_to_all:
+            # rank d receives the images idx_shuffle[d], grouped by the rank holding them
+            owner = torch.div(idx_shuffle, batch_size, rounding_mode='floor')
+            order = idx_shuffle.gather(1, torch.argsort(owner, dim=1, stable=True))
+            counts = [[int((owner[d] == r).sum()) for r in range(world_size)]
+                      for d in range(world_size)]
+            send = torch.cat([order[d][order[d] // batch_size == rank] for d in range(world_size)])
+            out = self._buffer('images', x.shape, x)
+            try:
+                send = self._to_device(send - rank * batch_size, x)
+                work = dist.all_to_all_single(out,
+                                              x[send].contiguous(),
+                                              output_split_sizes=counts[rank],
+                                              input_split_sizes=[c[rank] for c in counts],
+                                              async_op=True)
+                self._order = self._to_device(order.flatten(), x)
+                self.bytes['images'] += (batch_size - counts[rank][rank]) * image_bytes
+                return Pending(work, lambda: out.contiguous(memory_format=layout))
+            except (RuntimeError, NotImplementedError):
+                print('=> all_to_all is not supported, gathering full batches for the shuffle')
+                self.use_all_to_all = False
+
+        work, gathered = self._all_gather('images_all', x)
+        idx_shuffle = self._to_device(idx_shuffle, x)
+        self._order = idx_shuffle.flatten()
+        self.bytes['images'] += (world_size - 1) * batch_size * image_bytes
+        return Pending(work,
+                       lambda: gathered[idx_shuffle[rank]].contiguous(memory_format=layout))
+
+    @torch.no_grad()
+    def gather_keys(self, k, shuffled=True):
+        """
+        Gathers the keys of the batch from the last `shuffle` (or of an unshuffled
+        batch). Returns a Pending of (this rank's keys in the original order, the keys
+        of all ranks in order).
+        """
+        if not dist.is_initialized():
+            return Pending(None, lambda: (k, k))
+        world_size, rank = dist.get_world_size(), dist.get_rank()
+        key_bytes = k.numel() * k.element_size()
+        self.bytes['keys'] += (world_size - 1) * key_bytes
+        self.legacy_bytes['keys'] += 2 * (world_size - 1) * key_bytes  # unshuffle + enqueue
+        work, gathered = self._all_gather('keys', k)
+        if not shuffled:
+            return Pending(work, lambda: (k, gathered.clone()))
+        idx_unshuffle = torch.argsort(self._order)
+
+        def finish():
+            with phase('moco/batch_unshuffle'):
+                keys = gathered[idx_unshuffle]
+            return keys.view(world_size, -1, *k.shape[1:])[rank], keys
+
+        return Pending(work, finish)
+
+    def report(self, steps=1):
+        """Bytes received per step by this rank, against the all_gather exchange."""
+        new, old = sum(self.bytes.values()), sum(self.legacy_bytes.values())
+        return '{:.2f} MB/step received ({:.2f} MB with full all_gathers, {:.1f}x less)'.format(
+            new / steps / 2**20, old / steps / 2**20, old / max(new, 1))
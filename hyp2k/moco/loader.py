@@ -2,6 +2,8 @@
 from PIL import ImageFilter
 import random
 
+import torchvision.transforms as transforms
+
 
 class TwoCropsTransform:
     """Take two random crops of one image as the query and key."""
@@ -15,6 +17,20 @@ class TwoCropsTransform:
         return [q, k]
 
 
+def moco_v1_augmentation(normalize, size=224, scale=(0.2, 1.)):
+    """
+    MoCo v1's aug: the same as InstDisc https://arxiv.org/abs/1805.01978
+    Works on image tensors, including whole batches on the GPU. Smaller `size` and
+    `scale` give the small views of the multi-crop mode.
+    """
+    return transforms.Compose([
+        transforms.RandomResizedCrop(size, scale=scale),
+        transforms.RandomGrayscale(p=0.2),
+        transforms.ColorJitter(0.4, 0.4, 0.4, 0.4),
+        transforms.RandomHorizontalFlip(), normalize
+    ])
+
+
 class GaussianBlur(object):
     """Gaussian blur augmentation in SimCLR https://arxiv.org/abs/2002.05709"""
 
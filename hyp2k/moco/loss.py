@@ -0,0 +1,73 @@
+import torch
+import torch.nn as nn
+
+
+class _InfoNCE(torch.autograd.Function):
+    """
+    Mean cross-entropy of [l_pos, l_neg] / T with the positive as target, computed
+    with a streaming logsumexp over tiles of the K negatives. Neither the
+    concatenated logits nor their softmax is materialized; the backward writes
+    softmax(l_neg / T) tile by tile straight into the gradient of l_neg.
+    """
+
+    @staticmethod
+    def forward(ctx, l_pos, l_neg, T, tile):
+        N, K = l_neg.shape
+        # reduced precision logits are accumulated in float32
+        z_pos = l_pos.to(torch.promote_types(l_neg.dtype, torch.float32)) / T
+        peak = z_pos.clone()  # running max
+        total = torch.ones_like(z_pos)  # running sum of exp(z - peak), the positive first
+        rank = torch.zeros(N, dtype=torch.long, device=l_neg.device)
+        buf = torch.empty(N, min(tile, K), dtype=z_pos.dtype, device=l_neg.device)
+        for start in range(0, K, tile):
+            z = buf[:, :min(tile, K - start)]
+            torch.div(l_neg[:, start:start + tile], T, out=z)
+            # negatives scoring above the positive, for top-k accuracy
+            rank += (z > z_pos[:, None]).sum(1)
+            new_peak = torch.maximum(peak, z.amax(1))
+            total.mul_((peak - new_peak).exp_()).add_(
+                z.sub_(new_peak[:, None]).exp_().sum(1))
+            peak = new_peak
+        lse = peak + total.log()
+        ctx.save_for_backward(l_neg, z_pos, lse)
+        ctx.T, ctx.tile, ctx.pos_shape = T, tile, l_pos.shape
+        ctx.mark_non_differentiable(rank)
+        return (lse - z_pos).mean(), rank
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_rank):
+        l_neg, z_pos, lse = ctx.saved_tensors
+        scale = grad_loss / (lse.numel() * ctx.T)
+        grad_neg = torch.empty_like(l_neg)
+        for start in range(0, l_neg.size(1), ctx.tile):
+            g = grad_neg[:, start:start + ctx.tile]
+            torch.div(l_neg[:, start:start + ctx.tile], ctx.T, out=g)
+            g.sub_(lse[:, None]).exp_().mul_(scale)
+        grad_pos = ((z_pos - lse).exp_().sub_(1) * scale).view(ctx.pos_shape)
+        return grad_pos.to(l_neg.dtype), grad_neg, None, None
+
+
+class InfoNCELoss(nn.Module):
+    """
+    Contrastive loss of the (l_pos, l_neg) a MoCo model returns with fused_loss=True,
+    equal to CrossEntropyLoss on cat([l_pos, l_neg], 1) / T with zero targets.
+    Returns (loss, rank), where rank counts the negatives above each positive, so a
+    row is a top-k hit when rank < k. The ranks a model returns itself, as
+    (l_pos, l_neg, rank) with a sharded queue or shifted negatives, are passed through.
+    """
+
+    def __init__(self, T=0.07, tile=4096):
+        super(InfoNCELoss, self).__init__()
+        self.T = T
+        self.tile = tile
+
+    def forward(self, l_pos, l_neg, rank=None):
+        # a sharded queue counts the negatives above each positive itself
+        loss, own_rank = _InfoNCE.apply(l_pos.reshape(-1), l_neg, self.T, self.tile)
+        return loss, own_rank if rank is None else rank
+
+
+def rank_accuracy(rank, topk=(1,)):
+    """Top-k accuracy in percent from the ranks of InfoNCELoss."""
+    with torch.no_grad():
+        return [(rank < k).float().mean().mul_(100.0).view(1) for k in topk]
@@ -0,0 +1,225 @@
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from .sharded import _all_gather, num_shards
+
+
+class KeyQueue(nn.Module):
+    """
+    Ring buffer of the K most recent keys, shared by MoCo and HyperMoCo.
+
+    Keys are stored row-wise (K x dim), so an enqueue writes one contiguous block
+    and the negative logits are a single `q @ keys.T`. The squared norm of every
+    entry is written next to it at enqueue time, and `stat` caches one more
+    per-entry function of it (e.g. the conformal factors of a Poincare ball), so the
+    logits never reduce over the whole queue.
+
+    Enqueued keys are only written at the next `flush` (the start of the next step,
+    or a state_dict), so the queue read by this step's logits is not modified
+    before its backward and needs no defensive copy.
+
+    The keys can be stored in a reduced precision `dtype`: torch.bfloat16 or
+    torch.float16, or torch.int8 with one fp32 scale per entry (a column of the
+    dim x K queue). `mm` always returns fp32 products, and the norms are those of
+    the stored values.
+    """
+
+    DTYPES = (torch.float32, torch.bfloat16, torch.float16, torch.int8)
+
+    def __init__(self, dim, K, radius=1.0, dtype=torch.float32):
+        super(KeyQueue, self).__init__()
+        assert dtype in self.DTYPES, dtype
+        self.K = K
+        self.dtype = dtype
+        keys, scale = self._encode(nn.functional.normalize(torch.randn(K, dim), dim=1) * radius)
+        self.register_buffer("keys", keys)
+        self.register_buffer("scale", scale)  # None unless int8
+        self.register_buffer("ptr", torch.zeros(1, dtype=torch.long))
+        # derived from keys: not saved, recomputed on load
+        self.register_buffer("norm2", self.values().pow(2).sum(1), persistent=False)
+        self.register_buffer("stat_", torch.zeros(K), persistent=False)
+        self._stat_fn = None
+        self._stat_key = None
+        self._pending = None
+
+    def _encode(self, keys):
+        """fp32 keys -> (stored keys, per-entry scale or None)"""
+        if self.dtype != torch.int8:
+            return keys.to(self.dtype), None
+        scale = keys.abs().amax(1).clamp_min(1e-12) / 127
+        return (keys / scale[:, None]).round_().clamp_(-127, 127).to(torch.int8), scale
+
+    def values(self, start=0, end=None):
+        """Entries start:end as fp32"""
+        keys = self.keys[start:end].float()
+        if self.scale is not None:
+            keys = keys * self.scale[start:end, None]
+        return keys
+
+    def rows(self, idx):
+        """Entries idx (a LongTensor) as fp32"""
+        keys = self.keys[idx].float()
+        if self.scale is not None:
+            keys = keys * self.scale[idx, None]
+        return keys
+
+    def mm(self, x):
+        """x @ keys.T for fp32 x (N x dim), accumulated in fp32"""
+        if self.dtype == torch.float32:
+            return torch.mm(x, self.keys.t())
+        out = torch.mm(x, self.keys.t().float())
+        if self.scale is not None:
+            out = out * self.scale
+        return out
+
+    @torch.no_grad()
+    def push(self, keys):
+        """
+        Enqueue `keys` (already gathered from all processes), written at the next flush
+        """
+        assert self.K % keys.shape[0] == 0  # for simplicity
+        self.flush()
+        self._pending = keys
+
+    @torch.no_grad()
+    def flush(self):
+        keys, self._pending = self._pending, None
+        if keys is None:
+            return
+        batch_size = keys.shape[0]
+        ptr = int(self.ptr)
+
+        # replace the keys at ptr (dequeue and enqueue)
+        keys, scale = self._encode(keys.float())
+        self.keys[ptr:ptr + batch_size] = keys
+        if scale is not None:
+            self.scale[ptr:ptr + batch_size] = scale
+        self.norm2[ptr:ptr + batch_size] = self.values(ptr, ptr + batch_size).pow(2).sum(1)
+        if self._stat_fn is not None:
+            self.stat_[ptr:ptr + batch_size] = self._stat_fn(self.norm2[ptr:ptr + batch_size])
+
+        self.ptr[0] = (ptr + batch_size) % self.K  # move pointer
+
+    def stat(self, fn, key):
+        """
+        fn(norm2) for every entry, computed once per `key` (e.g. a curvature version)
+        and then kept current at enqueue time
+        """
+        if self._stat_key != key:
+            with torch.no_grad():
+                self.stat_.copy_(fn(self.norm2))
+            self._stat_fn, self._stat_key = fn, key
+        return self.stat_
+
+    @torch.no_grad()
+    def broadcast(self, src=0):
+        """
+        Copies the queue of process `src` to all processes. Every process enqueues the
+        same gathered keys, so after this their queues stay identical without the
+        per-step buffer broadcast of DDP (see `queue_buffers`).
+        """
+        self.flush()
+        for buf in (self.keys, self.scale, self.ptr):
+            if buf is not None:
+                dist.broadcast(buf, src)
+        self.norm2.copy_(self.values().pow(2).sum(1))
+        self._stat_fn = self._stat_key = None
+
+    @torch.no_grad()
+    def check(self, repair=True):
+        """
+        Compares a checksum of the queue across processes. Returns True if they hold
+        the same queue; otherwise, with `repair`, rank 0's queue is broadcast.
+        """
+        self.flush()
+        values = self.values().double()
+        stats = torch.stack([values.sum(), values.abs().sum(), self.ptr[0].double()])
+        bounds = torch.cat([stats, -stats])
+        dist.all_reduce(bounds, op=dist.ReduceOp.MAX)
+        consistent = bool(torch.equal(bounds[:3], -bounds[3:]))
+        if not consistent:
+            print("=> queue differs across processes (checksums {} to {}){}".format(
+                (-bounds[3:]).tolist(), bounds[:3].tolist(), ', resynchronizing' if repair else ''))
+            if repair:
+                self.broadcast()
+        return consistent
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self.flush()
+        super(KeyQueue, self)._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with another queue dtype are converted
+        keys, scale = state_dict.get(prefix + 'keys'), state_dict.pop(prefix + 'scale', None)
+        ptr = state_dict.get(prefix + 'ptr')
+        if keys is not None:
+            keys = keys.float() * scale[:, None] if scale is not None else keys.float()
+            shards = num_shards()
+            if shards > 1 and keys.size(0) == self.K * shards:
+                # the whole queue (e.g. the shards of sharded_state_dict): this
+                # process' part, and its pointer if the shards are the same
+                rank = dist.get_rank()
+                keys = keys[rank * self.K:(rank + 1) * self.K]
+                if ptr is not None:
+                    ptr = ptr[rank:rank + 1] if ptr.numel() == shards else ptr.new_zeros(1)
+            elif keys.size(0) != self.K:
+                # a queue shard saved with another world size: repeated or cut to
+                # size, the queue replaces it within K / batch size steps
+                keys = keys.repeat(-(-self.K // keys.size(0)), 1)[:self.K]
+                if ptr is not None:
+                    ptr = ptr % self.K
+            if ptr is not None:
+                # the pointers of shards laid out otherwise do not carry over
+                state_dict[prefix + 'ptr'] = ptr if ptr.numel() == 1 else ptr.new_zeros(1)
+            state_dict[prefix + 'keys'], scale = self._encode(keys)
+            if scale is not None:
+                state_dict[prefix + 'scale'] = scale
+        super(KeyQueue, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._pending = None
+        with torch.no_grad():
+            self.norm2.copy_(self.values().pow(2).sum(1))
+        self._stat_fn = self._stat_key = None
+
+
+def queue_buffers(model):
+    """
+    Names of the buffers of every KeyQueue in `model`, to be excluded from DDP's
+    buffer broadcast with
+    DistributedDataParallel._set_params_and_buffers_to_ignore_for_model
+    """
+    return [
+        name for prefix, module in model.named_modules() if isinstance(module, KeyQueue)
+        for name, _ in module.named_buffers(prefix)
+    ]
+
+
+def sharded_state_dict(model):
+    """
+    model.state_dict() with the queue shards of all processes (see MoCo's
+    shard_queue) instead of this process' own: the keys (and scales) of every
+    KeyQueue concatenated in rank order, and one ptr per shard. KeyQueue loads its
+    part of it back. All processes must call this.
+    """
+    state_dict = model.state_dict()
+    if num_shards() == 1:
+        return state_dict
+    for prefix, module in model.named_modules():
+        if isinstance(module, KeyQueue):
+            for name in ('keys', 'scale', 'ptr'):
+                key = prefix + '.' + name if prefix else name
+                if key in state_dict:
+                    state_dict[key] = _all_gather(state_dict[key])
+    return state_dict
+
+
+def upgrade_queue_state_dict(state_dict, prefix, *args):
+    """
+    Load state dict pre-hook for models holding a KeyQueue as `queue`: converts
+    checkpoints with the former `queue` (dim x K) and `queue_ptr` buffers.
+    """
+    old = state_dict.get(prefix + 'queue')
+    if old is not None and prefix + 'queue.keys' not in state_dict:
+        state_dict[prefix + 'queue.keys'] = state_dict.pop(prefix + 'queue').t().contiguous()
+        if prefix + 'queue_ptr' in state_dict:
+            state_dict[prefix + 'queue.ptr'] = state_dict.pop(prefix + 'queue_ptr')
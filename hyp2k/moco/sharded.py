@@ -0,0 +1,88 @@
+import torch
+import torch.distributed as dist
+
+
+def num_shards():
+    """Processes a sharded queue is spread over"""
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def _all_gather(x):
+    out = x.new_empty((dist.get_world_size() * x.size(0),) + x.shape[1:])
+    x = x.contiguous()
+    try:
+        dist.all_gather_into_tensor(out, x)
+    except (AttributeError, RuntimeError):  # no single-tensor gather in this backend
+        dist.all_gather(list(out.chunk(dist.get_world_size())), x)
+    return out
+
+
+class _GatherRows(torch.autograd.Function):
+    """all_gather of the rows of every process, whose backward sums the gradients
+    of all processes and keeps those of this process' rows"""
+
+    @staticmethod
+    def forward(ctx, x):
+        ctx.rows = x.size(0)
+        return _all_gather(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        start = dist.get_rank() * ctx.rows
+        return grad[start:start + ctx.rows]
+
+
+class _ShardLogSumExp(torch.autograd.Function):
+    """
+    Row-wise logsumexp over the columns of all processes: every process holds the
+    same rows and its own columns. The result is the same on every process; the
+    gradient of a row may come from any process (e.g. the one owning its loss).
+    """
+
+    @staticmethod
+    def forward(ctx, z):
+        peak = z.amax(1)
+        dist.all_reduce(peak, op=dist.ReduceOp.MAX)
+        total = (z - peak[:, None]).exp_().sum(1)
+        dist.all_reduce(total)
+        lse = peak + total.log()
+        ctx.save_for_backward(z, lse)
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad):
+        z, lse = ctx.saved_tensors
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        return (z - lse[:, None]).exp_().mul_(grad[:, None])
+
+
+def sharded_negatives(q, l_pos, score, T):
+    """
+    Negative logits against a queue sharded across processes, see KeyQueue.
+
+    q: this process' queries (N x dim), l_pos: their positive logits (N x 1), and
+    score(queries): logits of any queries against this process' shard. The queries
+    of all processes are scored against every shard, and the shards are combined by
+    a distributed logsumexp. Returns
+
+        l_neg: N x 1, T * logsumexp(l_neg_full / T) over the K negatives of all shards,
+               so that cat([l_pos, l_neg]) has the loss and gradients of the full logits
+        rank: N, number of negatives (of all shards) scoring above each positive
+    """
+    if num_shards() == 1:  # the whole queue
+        z = score(q) / T
+        with torch.no_grad():
+            above = (z > l_pos.detach() / T).sum(1)
+        return T * z.logsumexp(1, keepdim=True), above
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    n = q.size(0)
+    z = score(_GatherRows.apply(q)) / T
+    with torch.no_grad():
+        z_pos = _all_gather(l_pos.detach().reshape(-1) / T)
+        above = (z > z_pos[:, None]).sum(1)
+        dist.all_reduce(above)
+    lse = _ShardLogSumExp.apply(z)
+    return (T * lse[rank * n:(rank + 1) * n]).unsqueeze(1), above.view(world_size, n)[rank]
@@ -0,0 +1,128 @@
+import torch
+from torch.optim.sgd import sgd
+
+OPTIMIZERS = ['sgd', 'sgd-foreach', 'sgd-fused', 'lars']
+
+
+def lars_groups(groups):
+    """
+    Splits parameter groups (a list of dicts, or an iterable of parameters) for LARS:
+    the tensors with at most one dimension, the BatchNorm affine parameters and the
+    biases, go to a copy of their group that is neither adapted nor decayed.
+    """
+    groups = list(groups)
+    if not groups or not isinstance(groups[0], dict):
+        groups = [{'params': groups}]
+    split = []
+    for group in groups:
+        params = list(group['params'])
+        adapted = [p for p in params if p.ndim > 1]
+        excluded = [p for p in params if p.ndim <= 1]
+        if adapted:
+            split.append(dict(group, params=adapted))
+        if excluded:
+            split.append(dict(group, params=excluded, weight_decay=0., lars_adapt=False))
+    return split
+
+
+def param_groups(model, args):
+    """
+    The parameters of `model` for build_optimizer: a learnt curvature (log_c, see
+    hypmoco's Curvature) in a group of its own with --c-lr and no weight decay, as
+    its gradient is orders of magnitude above those of the weights, and all others.
+    """
+    params = list(model.named_parameters())
+    groups = [{'params': [p for name, p in params if not name.endswith('log_c')]}]
+    curvature = [p for name, p in params if name.endswith('log_c')]
+    if curvature:
+        groups.append({'params': curvature, 'lr': args.c_lr, 'weight_decay': 0.})
+    return groups
+
+
+def build_optimizer(groups, args):
+    """
+    The optimizer --optimizer selects: SGD with PyTorch's default per-tensor or
+    foreach implementation, its foreach or fused multi-tensor kernels, or LARS.
+    """
+    kwargs = dict(lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    if args.optimizer == 'lars':
+        return LARS(lars_groups(groups), eta=args.lars_eta, **kwargs)
+    if args.optimizer == 'sgd-foreach':
+        kwargs['foreach'] = True
+    elif args.optimizer == 'sgd-fused':
+        kwargs['fused'] = True
+    return torch.optim.SGD(groups, **kwargs)
+
+
+class LARS(torch.optim.Optimizer):
+    """
+    SGD with momentum and layer-wise adaptive rates (You et al., 2017,
+    https://arxiv.org/abs/1708.03888): the decayed gradient g + wd * w of every
+    tensor is scaled by its trust ratio eta * |w| / |g + wd * w| before the momentum
+    update. Groups with lars_adapt=False (see lars_groups) are plain SGD.
+
+    With foreach (the default), the norms and trust ratios of a group take a few
+    multi-tensor kernels and the momentum update is SGD's fused kernel, instead of
+    several kernels per tensor.
+    """
+
+    def __init__(self, params, lr, momentum=0.9, weight_decay=0., eta=0.001, foreach=True):
+        defaults = dict(lr=lr,
+                        momentum=momentum,
+                        weight_decay=weight_decay,
+                        eta=eta,
+                        lars_adapt=True)
+        super(LARS, self).__init__(params, defaults)
+        self.foreach = foreach
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            bufs = []
+            for p in params:
+                state = self.state[p]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.zeros_like(p)
+                bufs.append(state['momentum_buffer'])
+            update = self._foreach_update if self.foreach else self._update
+            update(params, grads, bufs, group)
+        return loss
+
+    @staticmethod
+    def _trust_ratio(param_norm, update_norm, eta):
+        ratio = eta * param_norm / update_norm
+        return torch.where((param_norm > 0) & (update_norm > 0), ratio, torch.ones_like(ratio))
+
+    def _foreach_update(self, params, grads, bufs, group):
+        wd, m = group['weight_decay'], group['momentum']
+        if wd:
+            grads = torch._foreach_add(grads, params, alpha=wd)
+        if group['lars_adapt']:
+            param_norms = torch.stack(torch._foreach_norm(params))
+            update_norms = torch.stack(torch._foreach_norm(grads))
+            ratios = list(self._trust_ratio(param_norms, update_norms, group['eta']).unbind())
+            if wd:  # the decayed gradients are copies already
+                torch._foreach_mul_(grads, ratios)
+            else:
+                grads = torch._foreach_mul(grads, ratios)
+        # the momentum and parameter updates of SGD, in one fused kernel
+        sgd(params, grads, bufs, fused=True, weight_decay=0., momentum=m, lr=group['lr'],
+            dampening=0., nesterov=False, maximize=False)
+
+    def _update(self, params, grads, bufs, group):
+        wd, m = group['weight_decay'], group['momentum']
+        for p, g, buf in zip(params, grads, bufs):
+            if wd:
+                g = g.add(p, alpha=wd)
+            if group['lars_adapt']:
+                g = g * self._trust_ratio(p.norm(), g.norm(), group['eta'])
+            buf.mul_(m).add_(g)
+            p.add_(buf, alpha=-group['lr'])
@@ -0,0 +1,104 @@
+import contextlib
+import os
+import time
+
+import torch
+
+_recording = False
+_null = contextlib.nullcontext()
+
+
+def phase(name):
+    """
+    Named profiler range around one phase of a training step. Outside of a recorded
+    step this is a shared no-op context, so instrumented code costs a global lookup.
+    """
+    if _recording:
+        return torch.profiler.record_function(name)
+    return _null
+
+
+def parse_steps(spec):
+    """'10-12,40' -> {10, 11, 12, 40}"""
+    steps = set()
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        if '-' in part:
+            first, last = part.split('-')
+            steps.update(range(int(first), int(last) + 1))
+        else:
+            steps.add(int(part))
+    return steps
+
+
+class StepProfiler(object):
+    """
+    Records the selected global steps with the PyTorch profiler. Each contiguous run
+    of steps is written to `out_dir` as a Chrome trace plus a text summary of the
+    named phases (see `phase`) and the most expensive operators.
+    """
+
+    def __init__(self, steps, out_dir, rank=0):
+        self.steps = parse_steps(steps) if isinstance(steps, str) else set(steps)
+        self.out_dir = out_dir
+        self.rank = rank
+        self.prof = None
+        self.first = None
+        self.wall = 0.
+
+    def start_step(self, step):
+        global _recording
+        self.current = step
+        if step not in self.steps:
+            return
+        if self.prof is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities)
+            self.prof.start()
+            self.first, self.wall = step, 0.
+            _recording = True
+        self.step_start = time.perf_counter()
+
+    def end_step(self):
+        global _recording
+        if self.prof is None or self.current not in self.steps:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.wall += time.perf_counter() - self.step_start
+        if self.current + 1 in self.steps:
+            return
+        self.prof.stop()
+        _recording = False
+        self._export(self.prof, self.first, self.current)
+        self.prof = None
+
+    def _export(self, prof, first, last):
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = 'rank{}_steps{}-{}'.format(self.rank, first, last)
+        trace = os.path.join(self.out_dir, 'trace_{}.json'.format(name))
+        prof.export_chrome_trace(trace)
+
+        events = prof.key_averages()
+        rows = []
+        for e in events:
+            if e.key.split('/')[0] in ('train', 'moco', 'data'):
+                device_us = getattr(e, 'device_time_total', getattr(e, 'cuda_time_total', 0))
+                rows.append((e.key, e.count, e.cpu_time_total / 1e3, device_us / 1e3))
+        rows.sort(key=lambda r: -r[2])
+        wall_ms = self.wall * 1e3
+        lines = [
+            'steps {}-{} ({} steps, {:.1f} ms wall)'.format(first, last, last - first + 1, wall_ms),
+            '{:<28} {:>7} {:>12} {:>8} {:>14}'.format('phase', 'calls', 'cpu ms', '% wall',
+                                                     'device ms'),
+        ]
+        for key, count, cpu_ms, device_ms in rows:
+            lines.append('{:<28} {:>7d} {:>12.2f} {:>7.1f}% {:>14.2f}'.format(
+                key, count, cpu_ms, 100. * cpu_ms / max(wall_ms, 1e-9), device_ms))
+        lines += ['', events.table(sort_by='self_cpu_time_total', row_limit=30)]
+        summary = os.path.join(self.out_dir, 'summary_{}.txt'.format(name))
+        with open(summary, 'w') as f:
+            f.write('\n'.join(lines))
+        print("=> wrote profile of steps {}-{} to '{}' and '{}'".format(
+            first, last, trace, summary))
@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import torch
+
+
+def memory_format(args):
+    """Memory format of model inputs selected by --channels-last."""
+    return torch.channels_last if getattr(args, 'channels_last', False) else torch.contiguous_format
+
+
+def compile_batch_dynamic(fn, **kwargs):
+    """
+    torch.compile `fn` (a function of one image batch) with a symbolic batch dimension.
+
+    The graph compiled for the first batch is reused when the batch size changes,
+    e.g. for the short last batch of an epoch, instead of triggering a recompile.
+    """
+    compiled = torch.compile(fn, **kwargs)
+
+    def call(x):
+        if x.size(0) > 1:  # sizes 0/1 are always specialized by dynamo
+            torch._dynamo.mark_dynamic(x, 0)
+        return compiled(x)
+
+    return call
+
+
+def compile_forward(module, **kwargs):
+    """
+    Compiles `module.forward` in place. Parameter names and the state dict stay the
+    same, unlike wrapping the module with torch.compile.
+    """
+    module.forward = compile_batch_dynamic(module.forward, **kwargs)
+    return module
+
+
+def rng_state():
+    """
+    RNG states of python, numpy, torch and the CUDA devices of this process, as
+    tensors and plain values that torch.load(weights_only=True) accepts.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': {
+            'name': name,
+            'keys': torch.from_numpy(keys.astype(np.int64)),
+            'pos': int(pos),
+            'has_gauss': int(has_gauss),
+            'cached_gaussian': float(cached_gaussian),
+        },
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    numpy_state = state['numpy']
+    if isinstance(numpy_state, dict):
+        numpy_state = (numpy_state['name'], numpy_state['keys'].numpy().astype(np.uint32),
+                       numpy_state['pos'], numpy_state['has_gauss'],
+                       numpy_state['cached_gaussian'])
+    np.random.set_state(numpy_state)
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])